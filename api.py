@@ -8,17 +8,35 @@ from passlib.hash import pbkdf2_sha512
 import calendar
 
 from flask import *
-from flask.ext.mysqldb import MySQL
 from flask.ext.mysqldb import MySQLdb
 from flask_restful import Resource, Api
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.security import (Security, SQLAlchemyUserDatastore,
     UserMixin, RoleMixin, login_required, utils)
 from flask.json import JSONEncoder
-import flask.ext.whooshalchemy
+from werkzeug.contrib.fixers import ProxyFix
 
-from api.event import EventList, Event, EventPic
-from api.user import (UserList, User, EventsUsers,
+from api.event import (EventList, Event, EventPic, EventChanges,
+    init_event_cache)
+from api.push import PushHub, EventStream
+from api.metrics import MetricsReport
+from api.profiler import Profiler, ProfilerControl
+from api.search import create_search_index
+from api.search_cache import SearchCache
+from api.suggest import EventSuggestions, EventSuggest
+from api import feed
+from api.leaderboard import Leaderboards, LeaderboardList
+from api import analytics
+from api import archive
+from api import snapshot
+from api.batch import Batch
+from api.images import Image
+from api import query_budget
+from api.query_budget import CountingMySQL
+from api.shmcache import SharedCache
+from jobs import JobQueue
+import jobs.tasks
+from api.user import (UserList, User, EventsUsers, EventSignups,
     ProfilePic, Login)
 from models.models import (User as db_user, Event as db_event,
     Role, RoleMixin, db)
@@ -43,18 +61,66 @@ class CustomJSONEncoder(JSONEncoder):
 app = Flask(__name__)
 app.json_encoder = CustomJSONEncoder
 
-# WooshAlchemy Configuration
+# Gunicorn only listens on localhost, so every request comes through
+# Nginx. Take the client address from the X-Forwarded-For header it
+# sets, for rate limits among others.
+app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=1)
+
+# Search configuration. SEARCH_BACKEND is "whoosh", for Whoosh
+# indexes sharded by the geohash of event locations, see
+# api/shards.py, or "fts5", for a SQLite FTS5 index, see api/fts.py.
+# Indexes are kept under WHOOSH_BASE either way.
+app.config['SEARCH_BACKEND'] = 'whoosh'
 app.config['WHOOSH_BASE'] = 'index'
-flask.ext.whooshalchemy.whoosh_index(app, db_event)
+app.config['SEARCH_SHARD_PRECISION'] = 3
+app.config['SEARCH_THREADS'] = 4
+
+# Weights of the parts of the score of event search hits, and the
+# miles and days over which the distance and start date parts fade,
+# see api/ranking.py
+app.config['RANKING_WEIGHTS'] = {"text": 1.0, "distance": 0.5, "date": 0.25,
+                                 "capacity": 0.25}
+app.config['RANKING_DISTANCE_SCALE'] = 10
+app.config['RANKING_DATE_SCALE'] = 14
+app.config['RANKING_TEXT_SATURATION'] = 5
+
+# Snapshots of zipcode and event locations loaded by workers at
+# boot, written by `manage.py snapshot`, see api/snapshot.py.
+# Workers read event changes made since, and newer snapshot files,
+# at most every SNAPSHOT_CATCHUP_INTERVAL seconds.
+app.config['SNAPSHOT_DIR'] = 'snapshots'
+app.config['SNAPSHOT_CATCHUP_INTERVAL'] = 5
+
+# Events are moved to the archive this many days after they end,
+# see api/archive.py
+app.config['ARCHIVE_GRACE_DAYS'] = 30
 
 # MySQL Configuration
 app.config['MYSQL_HOST'] = "localhost"
 app.config['MYSQL_USER'] = "root"
 app.config['MYSQL_DB'] = "volunteer_app"
-app.mysql = MySQL(app)
+app.mysql = CountingMySQL(app)
 
 # SQLAlchemy Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = "mysql://root@localhost:3306/volunteer_app"
+if COOPERATIVE:
+
+    # Many requests share a worker in cooperative mode, so they
+    # also need a larger pool of database connections to share.
+    app.config['SQLALCHEMY_DATABASE_URI'] = "mysql+pymysql://root@localhost:3306/volunteer_app"
+    app.config['SQLALCHEMY_POOL_SIZE'] = 20
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = 20
+else:
+    app.config['SQLALCHEMY_DATABASE_URI'] = "mysql://root@localhost:3306/volunteer_app"
+
+# Read replicas serving the queries of GET requests, see models/routing.py.
+# For local testing these can be SQLite stand-ins, such as
+# SQLALCHEMY_DATABASE_URI = "sqlite:///primary.db" and
+# SQLALCHEMY_REPLICA_URIS = ["sqlite:///replica.db"]. Clients read
+# from the primary for PIN_SECONDS after each write request.
+app.config['SQLALCHEMY_REPLICA_URIS'] = []
+app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'] = 10
+app.config['SQLALCHEMY_REPLICA_CONNECT_TIMEOUT'] = 2
+app.config['SQLALCHEMY_REPLICA_PIN_SECONDS'] = 5
 
 # Flask-Security Configuration
 app.config["SECURITY_REGISTERABLE"] = True
@@ -71,6 +137,48 @@ app.config['SECRET_KEY'] = 'FmG9yqMxVfb9aoEVpn6J'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['EVENT_PIC_UPLOAD_FOLDER'] = EVENT_PIC_UPLOAD_FOLDER
 
+# Internal Nginx location of static/images, see api/images.py. When
+# set, images are sent by Nginx instead of the Python workers.
+app.config['IMAGE_ACCEL_REDIRECT'] = None
+
+# Push Configuration. Set the broker to 'unix' to share event
+# changes between the Gunicorn workers on a host.
+app.config['PUSH_BROKER'] = 'local'
+app.config['PUSH_SOCKET_DIR'] = '/tmp/volunteer_push'
+
+# Rate limits applied to each user, or to each client address for
+# requests without a valid token, across the workers of a host, see
+# api/admission.py. The slots of the routes' concurrency limits are
+# locks on files in ADMISSION_SLOTS_DIR, which should be on a tmpfs.
+app.config['RATE_LIMIT_PER_SECOND'] = 10
+app.config['RATE_LIMIT_BURST'] = 20
+app.config['ADMISSION_SLOTS_DIR'] = '/dev/shm/volunteer_admission'
+
+# Background job configuration, see jobs/__init__.py. Set JOBS_EAGER
+# to run jobs right away instead of leaving them to the workers.
+app.config['JOBS_DATABASE'] = 'jobs.sqlite3'
+app.config['JOBS_MAX_ATTEMPTS'] = 5
+app.config['JOBS_RETRY_BACKOFF'] = 2
+app.config['JOBS_EAGER'] = False
+
+# Cache shared by the workers on a host, see api/shmcache.py. The
+# file should be on a tmpfs, and holds SLOTS entries of up to
+# SLOT_SIZE bytes each.
+app.config['SHARED_CACHE_PATH'] = '/dev/shm/volunteer_cache'
+app.config['SHARED_CACHE_SLOTS'] = 16384
+app.config['SHARED_CACHE_SLOT_SIZE'] = 2048
+
+# Query budgets, see api/query_budget.py. In strict mode, meant for
+# tests, a request over its route's budget fails instead of logging.
+app.config['QUERY_BUDGET_STRICT'] = False
+app.config['QUERY_REPEAT_LIMIT'] = 3
+
+# Sampling profiler of live requests, see api/profiler.py. Set an
+# admin key to enable it.
+app.config['PROFILER_KEY'] = None
+app.config['PROFILER_DIR'] = 'profiles'
+app.config['PROFILER_INTERVAL'] = 0.005
+
 # Instatiate the database connection object defined
 # in the models file.
 db.init_app(app)
@@ -80,6 +188,52 @@ app.db = db
 user_datastore = SQLAlchemyUserDatastore(db, db_user, Role)
 security = Security(app, user_datastore)
 
+# Initialize the cache shared by the workers, and drop
+# cached events when they change
+shared_cache = SharedCache()
+shared_cache.init_app(app)
+init_event_cache(app)
+
+# Map the snapshots of zipcode and event locations
+snapshot.init_app(app)
+
+# Initialize the queue of deferred side effects
+job_queue = JobQueue()
+job_queue.init_app(app)
+
+# Initialize the event search index
+search_index = create_search_index(app, 'events', db_event.__searchable__)
+search_index.init_app(app)
+
+# Cache the results of event searches until events change
+search_cache = SearchCache()
+search_cache.init_app(app)
+
+# Initialize the cold search index of archived events
+archive.init_app(app)
+
+# Initialize the search box autocompletion
+suggestions = EventSuggestions()
+suggestions.init_app(app)
+
+# Keep the users' materialized event feeds up to date
+feed.init_app(app)
+
+# Initialize the volunteer hours leaderboards
+leaderboards = Leaderboards()
+leaderboards.init_app(app)
+
+# Initialize the hub streaming event changes to clients
+push_hub = PushHub()
+push_hub.init_app(app)
+
+# Count the SQL statements of every request
+query_budget.init_app(app)
+
+# Initialize the on demand profiler of requests
+profiler = Profiler()
+profiler.init_app(app)
+
 # Initialize the Flask-Restful API object
 api = Api(app)
 
@@ -88,12 +242,33 @@ api.add_resource(Login, '/user/login')
 api.add_resource(UserList ,'/users')
 api.add_resource(User, '/user/<user_id>')
 api.add_resource(ProfilePic, '/user/<user_id>/picture')
+api.add_resource(feed.Feed, '/user/<user_id>/feed')
+api.add_resource(archive.UserHistory, '/user/<user_id>/history')
+api.add_resource(LeaderboardList, '/leaderboard')
+api.add_resource(analytics.OrganizationStats,
+                 '/organization/<organization>/stats')
 api.add_resource(EventPic, '/event/<event_id>/picture')
+api.add_resource(EventSignups, '/event/<event_id>/signups')
 
 # Add routes for events defined in api/events.py
 api.add_resource(EventsUsers, '/event/<event_id>/<user_id>')
 api.add_resource(EventList, '/events')
+api.add_resource(EventChanges, '/events/changes')
+api.add_resource(EventStream, '/events/stream')
+api.add_resource(EventSuggest, '/events/suggest')
+api.add_resource(archive.ArchivedEventList, '/events/archive')
+api.add_resource(archive.ArchivedEvent, '/events/archive/<event_id>')
 api.add_resource(Event, '/event/<event_id>')
 
+# Add route serving the uploaded pictures
+api.add_resource(Image, '/images/<kind>/<filename>')
+
+# Add route running several requests in one round trip
+api.add_resource(Batch, '/batch')
+
+# Add monitoring routes
+api.add_resource(MetricsReport, '/metrics')
+api.add_resource(ProfilerControl, '/profiler')
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8889, debug=True)
@@ -1,4 +1,6 @@
-from math import cos, sqrt, radians
+import time
+import hashlib
+from math import cos, sqrt, radians, ceil
 from functools import wraps
 
 from flask import *
@@ -11,6 +13,17 @@ from itsdangerous import (TimedJSONWebSignatureSerializer
 from models.models import User as db_user
 from globals import *
 
+ZIP_CACHE_TTL = 86400
+"""Seconds the location of a zipcode is cached for."""
+
+AUTHENTICATED = "volunteer.authenticated"
+"""WSGI environ key set on requests that were already authenticated.
+
+Only set on the sub-requests of a batch, see api/batch.py. Clients
+can't set it, as request headers only appear as HTTP_* keys.
+
+"""
+
 def key_required(f):
     """Decorator to require API KEY for every request.
 
@@ -23,7 +36,7 @@ def key_required(f):
         app = current_app._get_current_object()
         key = request.headers.get("api_key")
 
-        if key == API_KEY:
+        if key == API_KEY or request.environ.get(AUTHENTICATED):
             return f(*args, **kwargs)
         else:
             return get_error_response("Unauthorized.")
@@ -40,7 +53,7 @@ def auth_required(f):
         app = current_app._get_current_object()
         token = request.headers.get("authorization")
 
-        if verify_auth_token(app, token):
+        if request.environ.get(AUTHENTICATED) or verify_auth_token(app, token):
             return f(*args, **kwargs)
         else:
             return get_error_response("Unauthorized.")
@@ -49,14 +62,36 @@ def auth_required(f):
 def verify_auth_token(app, token):
     """Verify that the presented token is valid."""
 
+    return auth_user_id(app, token) is not None
+
+def auth_user_id(app, token):
+    """Return the id of the user a token was issued to.
+
+    Returns None if the token is missing, invalid or expired. Valid
+    tokens are remembered in the shared cache until they expire, so
+    each token is only checked once per host.
+
+    """
+
+    if token is None:
+        return None
+
+    cache = app.extensions['cache']
+    key = "auth:" + hashlib.sha1(token.encode("utf-8")).hexdigest()
+    user_id = cache.get(key)
+    if user_id is not None:
+        return user_id
+
     s = Serializer(app.config['SECRET_KEY'])
     try:
-        data = s.loads(token)
+        data, header = s.loads(token, return_header=True)
     except SignatureExpired:
-        return False # valid token, but expired
+        return None # valid token, but expired
     except BadSignature:
-        return False # invalid token
-    return True
+        return None # invalid token
+
+    cache.set(key, data["id"], header["exp"] - time.time())
+    return data["id"]
 
 def calculate_equirectangular_distance(lat1, lon1, lat2, lon2):
     """Calculate the equirectangular distance between two coordinates."""
@@ -73,15 +108,31 @@ def calculate_equirectangular_distance(lat1, lon1, lat2, lon2):
 
     return dist
 
-def get_location_from_zip(zipcode):
+def get_location_from_zip(zipcode, cached_only=False):
     """Get coordinates for the provided zipcode.
 
     Returns None if no coordinates were found that
-    match the zipcode.
+    match the zipcode. With cached_only, also returns None
+    rather than query the database.
 
     """
 
     app = current_app._get_current_object()
+
+    # Every zipcode is in the snapshot, when there is one
+    snapshot = app.extensions.get('zip_snapshot')
+    if snapshot is not None:
+        result = snapshot.get(zipcode)
+        if result is not None:
+            return result
+
+    cache = app.extensions['cache']
+    key = "zip:%s" % zipcode
+
+    result = cache.get(key)
+    if result is not None or cached_only:
+        return result
+
     conn = app.mysql.connection
     cur = conn.cursor(MySQLdb.cursors.DictCursor)
 
@@ -90,8 +141,24 @@ def get_location_from_zip(zipcode):
 
     result = cur.fetchone()
 
+    # Zipcode locations never change, so every worker
+    # on the host can share them for a long time.
+    if result is not None:
+        result["lat"] = float(result["lat"])
+        result["lon"] = float(result["lon"])
+        cache.set(key, result, ZIP_CACHE_TTL)
+
     return result
 
+def is_valid_zipcode(zipcode):
+    """Check that a zipcode is given and numeric."""
+
+    try:
+        int(zipcode)
+    except (TypeError, ValueError):
+        return False
+    return True
+
 def get_success_response(results = {}):
     """Format the success JSON response object """
 
@@ -106,3 +173,16 @@ def get_error_response(message):
         "error": message
     })
     return response
+
+def get_overload_response(message, status, retry_after):
+    """Format the error JSON response for a rejected request.
+
+    Sets the status code and tells the client how many seconds
+    to wait before retrying.
+
+    """
+
+    response = get_error_response(message)
+    response.status_code = status
+    response.headers["Retry-After"] = str(int(ceil(retry_after)))
+    return response
@@ -0,0 +1,227 @@
+import os
+import time
+import fcntl
+import threading
+from functools import wraps
+
+from flask import *
+
+from api import *
+from api.metrics import metrics
+
+ADMISSION_POLL_INTERVAL = 0.01
+"""Seconds between tries for a slot by requests waiting in line."""
+
+
+class ConcurrencyLimiter(object):
+
+    """Limit the number of requests running a route at once on a host.
+
+    Requests over the limit wait in line for up to max_queue_time
+    seconds. Requests that would make the line longer than
+    max_queued, or that time out waiting, are shed.
+
+    Sync workers run one request at a time, so the limits are kept
+    across the workers of the host, in a file of one byte per slot
+    under ADMISSION_SLOTS_DIR: max_concurrent bytes for running
+    requests, then max_queued for waiting ones. A request holds a
+    slot by holding a lock on its byte, which the kernel releases if
+    the worker dies. POSIX locks belong to a whole process, so the
+    slots held by each process are also kept track of, for the
+    threads or greenlets sharing it.
+
+    """
+
+    def __init__(self, name, max_concurrent, max_queue_time, max_queued):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue_time = max_queue_time
+        self.max_queued = max_queued
+        self.held = set()
+        self.lock = threading.Lock()
+        self.fd = None
+        self.fd_pid = None
+
+        # Gauges are per worker, like the other metrics
+        metrics.gauge("admission.%s.active" % name, lambda: len(
+            [slot for slot in self.held if slot < self.max_concurrent]))
+        metrics.gauge("admission.%s.waiting" % name, lambda: len(
+            [slot for slot in self.held if slot >= self.max_concurrent]))
+
+    def _open(self, app):
+        # Each worker opens its own, so a fork can't share locks
+        if self.fd is None or self.fd_pid != os.getpid():
+            directory = app.config['ADMISSION_SLOTS_DIR']
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+            self.fd = os.open(os.path.join(directory, self.name + ".slots"),
+                              os.O_RDWR | os.O_CREAT, 0o600)
+            self.fd_pid = os.getpid()
+            self.held = set()
+        return self.fd
+
+    def _take(self, first, count):
+        """Take a free slot in [first, first + count), or return None."""
+
+        with self.lock:
+            for slot in range(first, first + count):
+                if slot in self.held:
+                    continue
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                                slot)
+                except IOError:
+                    continue
+                self.held.add(slot)
+                return slot
+        return None
+
+    def _give_back(self, slot):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+            self.held.discard(slot)
+
+    def acquire(self, app):
+        """Return the slot taken once the request may run, or None to shed it."""
+
+        self._open(app)
+
+        slot = self._take(0, self.max_concurrent)
+        if slot is not None:
+            return slot
+
+        waiting = self._take(self.max_concurrent, self.max_queued)
+        if waiting is None:
+            return None
+
+        metrics.increment("admission.%s.queued" % self.name)
+        deadline = time.time() + self.max_queue_time
+        try:
+            while time.time() < deadline:
+                time.sleep(ADMISSION_POLL_INTERVAL)
+                slot = self._take(0, self.max_concurrent)
+                if slot is not None:
+                    return slot
+            return None
+        finally:
+            self._give_back(waiting)
+
+    def release(self, slot):
+        self._give_back(slot)
+
+
+class RateLimiter(object):
+
+    """Token bucket rate limits keyed by client, shared by the host.
+
+    Each key may make rate requests per second on average, with
+    bursts of up to burst requests, across all the workers of the
+    host. Buckets are kept in the shared cache and updated under its
+    lock. A bucket evicted from the cache starts over full, which
+    only happens to clients seen least recently.
+
+    """
+
+    def take(self, cache, key, rate, burst):
+        """Take a token for the key.
+
+        Returns 0 if the request may go ahead, otherwise the
+        number of seconds until a token is available.
+
+        """
+
+        def take_token(bucket):
+            now = time.time()
+            tokens, updated = bucket if bucket is not None else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                return [tokens - 1, now], 0
+            return [tokens, now], (1 - tokens) / rate
+
+        # Past this long a bucket would be full again anyway
+        ttl = burst / float(rate) + 1
+        return cache.update("rate:" + key, take_token, ttl)
+
+rate_limiter = RateLimiter()
+
+
+def rate_limit_key(app):
+    """Return the key of the client making the request.
+
+    Tokens are verified first, so that clients can't get a fresh
+    bucket by sending made up tokens. The client address is the one
+    Nginx forwards, see ProxyFix in api.py.
+
+    """
+
+    user_id = auth_user_id(app, request.headers.get("authorization"))
+    if user_id is not None:
+        return "user:%s" % user_id
+    return "addr:%s" % request.remote_addr
+
+
+def admission_control(name, max_concurrent=None, max_queue_time=0.5,
+                      max_queued=None):
+    """Decorator to apply rate limits and concurrency limits to a route.
+
+    Requests are rate limited per user, or per client address when
+    they don't carry a valid auth token, and rejected with a 429. If
+    max_concurrent is given, requests over the limit queue for at
+    most max_queue_time seconds and are otherwise rejected with a 503.
+    Both limits apply to the whole host, so max_concurrent is the
+    number of workers of the host that may serve the route at once.
+
+    Applied outside key_required and auth_required so that rejected
+    requests don't pay for them. Telling users apart still takes a
+    check of the token, which is cached for valid tokens.
+
+    The sub-requests of a batch aren't rate limited, as the batch
+    already took a token for them, but they are still subject to
+    the concurrency limits.
+
+    """
+
+    limiter = None
+    if max_concurrent is not None:
+        if max_queued is None:
+            max_queued = 2 * max_concurrent
+        limiter = ConcurrencyLimiter(name, max_concurrent, max_queue_time,
+                                     max_queued)
+
+    def decorator(f):
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            app = current_app._get_current_object()
+
+            if not request.environ.get(AUTHENTICATED):
+                key = rate_limit_key(app)
+                retry_after = rate_limiter.take(
+                    app.extensions['cache'], key,
+                    app.config['RATE_LIMIT_PER_SECOND'],
+                    app.config['RATE_LIMIT_BURST'])
+                if retry_after > 0:
+                    metrics.increment("admission.%s.rate_limited" % name)
+                    return get_overload_response("Too many requests.", 429,
+                                                 retry_after)
+
+            if limiter is None:
+                return f(*args, **kwargs)
+
+            slot = limiter.acquire(app)
+            if slot is None:
+                metrics.increment("admission.%s.shed" % name)
+                return get_overload_response("Server busy.", 503,
+                                             max_queue_time)
+
+            try:
+                return f(*args, **kwargs)
+            finally:
+                limiter.release(slot)
+
+        return decorated_function
+    return decorator
@@ -0,0 +1,225 @@
+from datetime import datetime, date, timedelta
+
+from flask import *
+from flask.ext.mysqldb import MySQLdb
+from flask_restful import Resource
+
+from api import *
+from api.admission import admission_control
+
+VELOCITY_DAYS = 30
+"""Number of days of daily sign-up counts returned with the stats."""
+
+
+def is_upcoming(end_date, now):
+    return end_date is not None and end_date > now
+
+
+# The counters are updated by the request making the change, in its
+# own transaction, so that they can't drift from the source tables
+# when either write fails.
+
+def count_event_created(session, event):
+    """Add a new event to its organization's counters, without committing.
+
+    Call with the session the event is added with, before committing.
+
+    """
+
+    if event.organization is None:
+        return
+
+    capacity = event.max_volunteers_needed or 0
+    upcoming = 1 if is_upcoming(event.end_date, datetime.now()) else 0
+
+    session.execute("INSERT INTO organization_stats (organization, \
+                    num_events, total_capacity, upcoming_events, \
+                    upcoming_capacity) VALUES (:organization, 1, :capacity, \
+                    :upcoming, :upcoming_capacity) ON DUPLICATE KEY UPDATE \
+                    num_events=num_events+1, \
+                    total_capacity=total_capacity+VALUES(total_capacity), \
+                    upcoming_events=upcoming_events+VALUES(upcoming_events), \
+                    upcoming_capacity=upcoming_capacity+VALUES(upcoming_capacity)",
+                    {"organization": event.organization, "capacity": capacity,
+                     "upcoming": upcoming,
+                     "upcoming_capacity": upcoming * capacity})
+
+
+def count_event_deleted(conn, event):
+    """Take a deleted event out of its organization's counters.
+
+    event is a dict of the event's columns. Call on the connection
+    deleting the event, before committing.
+
+    """
+
+    if event["organization"] is None:
+        return
+
+    capacity = event["max_volunteers_needed"] or 0
+    signups = event["current_num_volunteers"] or 0
+    upcoming = 1 if is_upcoming(event["end_date"], datetime.now()) else 0
+
+    cur = conn.cursor()
+    cur.execute("UPDATE organization_stats SET num_events=num_events-1, \
+                total_capacity=total_capacity-%s, \
+                total_signups=total_signups-%s, \
+                upcoming_events=upcoming_events-%s, \
+                upcoming_capacity=upcoming_capacity-%s, \
+                upcoming_signups=upcoming_signups-%s \
+                WHERE organization=%s",
+                (capacity, signups, upcoming, upcoming * capacity,
+                 upcoming * signups, event["organization"]))
+
+
+def count_signups(conn, event_id, delta):
+    """Apply a change in an event's sign-ups to its organization's counters.
+
+    Call on the connection changing the sign-ups, before committing.
+
+    """
+
+    cur = conn.cursor(MySQLdb.cursors.DictCursor)
+
+    cur.execute("SELECT organization, end_date FROM event WHERE id=%s",
+                (event_id,))
+    event = cur.fetchone()
+    if event is None or event["organization"] is None:
+        return
+
+    upcoming = 1 if is_upcoming(event["end_date"], datetime.now()) else 0
+
+    cur.execute("UPDATE organization_stats SET \
+                total_signups=total_signups+%s, \
+                upcoming_signups=upcoming_signups+%s \
+                WHERE organization=%s",
+                (delta, upcoming * delta, event["organization"]))
+
+    # Velocity only counts new sign-ups, not cancellations
+    if delta > 0:
+        cur.execute("INSERT INTO organization_signups_daily (organization, \
+                    day, signups) VALUES (%s, %s, %s) ON DUPLICATE KEY \
+                    UPDATE signups=signups+VALUES(signups)",
+                    (event["organization"], date.today(), delta))
+
+
+def reconcile_organization_stats(conn):
+    """Recompute every organization's counters from the source tables.
+
+    Corrects any drift in the incremental counters, and moves events
+    that have ended out of the upcoming totals. Meant to be run
+    periodically. Returns the number of organizations.
+
+    The totals include archived events and their sign-ups, so that
+    archiving, which only moves events that ended long ago, leaves
+    the counters as they are.
+
+    """
+
+    now = datetime.now()
+    cur = conn.cursor()
+
+    # Changes update the counters in the transaction that makes
+    # them. With the counters locked before the snapshot below is
+    # taken, changes committed earlier are in the snapshot, and
+    # those still running wait for us and then apply on top.
+    cur.execute("SELECT organization FROM organization_stats FOR UPDATE")
+    existing = set(row[0] for row in cur.fetchall())
+
+    cur.execute("SELECT e.organization, COUNT(*), \
+                SUM(IFNULL(e.max_volunteers_needed, 0)), \
+                SUM(IFNULL(s.signups, 0)), \
+                SUM(e.end_date > %s), \
+                SUM(IF(e.end_date > %s, IFNULL(e.max_volunteers_needed, 0), 0)), \
+                SUM(IF(e.end_date > %s, IFNULL(s.signups, 0), 0)) \
+                FROM (SELECT id, organization, max_volunteers_needed, \
+                end_date FROM event UNION ALL SELECT id, organization, \
+                max_volunteers_needed, end_date FROM event_archive) e \
+                LEFT JOIN (SELECT event_id, COUNT(*) AS signups \
+                FROM events_users GROUP BY event_id UNION ALL \
+                SELECT event_id, COUNT(*) FROM events_users_archive \
+                GROUP BY event_id) s ON s.event_id=e.id \
+                WHERE e.organization IS NOT NULL GROUP BY e.organization",
+                (now, now, now))
+    rows = cur.fetchall()
+
+    cur.executemany("INSERT INTO organization_stats (organization, \
+                    num_events, total_capacity, total_signups, \
+                    upcoming_events, upcoming_capacity, upcoming_signups, \
+                    reconciled_date) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) \
+                    ON DUPLICATE KEY UPDATE num_events=VALUES(num_events), \
+                    total_capacity=VALUES(total_capacity), \
+                    total_signups=VALUES(total_signups), \
+                    upcoming_events=VALUES(upcoming_events), \
+                    upcoming_capacity=VALUES(upcoming_capacity), \
+                    upcoming_signups=VALUES(upcoming_signups), \
+                    reconciled_date=VALUES(reconciled_date)",
+                    [tuple(row) + (now,) for row in rows])
+
+    # Organizations left without any event
+    gone = existing - set(row[0] for row in rows)
+    if len(gone) > 0:
+        cur.executemany("DELETE FROM organization_stats \
+                        WHERE organization=%s", [(o,) for o in gone])
+
+    conn.commit()
+
+    return len(rows)
+
+
+class OrganizationStats(Resource):
+
+    """Class providing analytics for an organization's events."""
+
+    query_budget = {"get": 2}
+
+    @admission_control("organization_stats")
+    @key_required
+    @auth_required
+    def get(self, organization):
+        """Return fill rates, sign-up velocity and capacity totals.
+
+        Reads the maintained counters, so the cost does not depend
+        on the number of events or sign-ups.
+
+        """
+
+        app = current_app._get_current_object()
+        cur = app.mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+
+        cur.execute("SELECT * FROM organization_stats WHERE organization=%s",
+                    (organization,))
+        stats = cur.fetchone()
+        if stats is None:
+            return get_error_response("Organization not found.")
+
+        since = date.today() - timedelta(days=VELOCITY_DAYS - 1)
+        cur.execute("SELECT day, signups FROM organization_signups_daily \
+                    WHERE organization=%s AND day>=%s ORDER BY day",
+                    (organization, since))
+        daily = cur.fetchall()
+
+        def fill_rate(signups, capacity):
+            if capacity <= 0:
+                return None
+            return float(signups) / capacity
+
+        week = date.today() - timedelta(days=6)
+        return get_success_response({
+            "organization": organization,
+            "num_events": stats["num_events"],
+            "total_capacity": stats["total_capacity"],
+            "total_signups": stats["total_signups"],
+            "fill_rate": fill_rate(stats["total_signups"],
+                                   stats["total_capacity"]),
+            "upcoming_events": stats["upcoming_events"],
+            "upcoming_capacity": stats["upcoming_capacity"],
+            "upcoming_signups": stats["upcoming_signups"],
+            "upcoming_fill_rate": fill_rate(stats["upcoming_signups"],
+                                            stats["upcoming_capacity"]),
+            "signups_last_7_days": sum(d["signups"] for d in daily
+                                       if d["day"] >= week),
+            "signups_last_30_days": sum(d["signups"] for d in daily),
+            "daily_signups": [{"day": d["day"].strftime("%m/%d/%Y"),
+                               "signups": d["signups"]} for d in daily]
+        })
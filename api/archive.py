@@ -0,0 +1,221 @@
+import json
+from datetime import datetime
+
+from flask import *
+from flask.ext.mysqldb import MySQLdb
+from flask_restful import Resource
+
+from models.models import (ArchivedEvent as db_archived_event,
+    events_users_archive, db)
+from api import *
+from api.admission import admission_control
+from api.search import create_search_index
+
+ARCHIVE_MAX_RESULTS = 100
+"""Max number of archived events returned by a single request."""
+
+EVENT_COLUMNS = ("id", "name", "short_desc", "organization", "description",
+                 "start_date", "end_date", "max_volunteers_needed",
+                 "current_num_volunteers", "close_date", "creator_id",
+                 "created_date", "last_updated_date", "pic_url",
+                 "street_addr", "city", "state", "zipcode", "lat", "lon")
+"""Columns copied from the event table to the archive."""
+
+
+def _in(values):
+    return "(" + ", ".join(["%s"] * len(values)) + ")"
+
+
+def archive_events(conn, cutoff, batch_size):
+    """Move events that ended before cutoff into the archive tables.
+
+    Events are moved a batch at a time, each batch in its own
+    transaction, along with their skills and sign-ups. A tombstone
+    is recorded for each, so syncing clients and the other workers
+    drop them. Yields the rows of each batch of events moved.
+
+    Organization stats and leaderboards count archived events and
+    sign-ups as well as live ones, so they aren't adjusted here.
+
+    """
+
+    columns = ", ".join(EVENT_COLUMNS)
+    cur = conn.cursor(MySQLdb.cursors.DictCursor)
+
+    while True:
+        cur.execute("SELECT " + columns + " FROM event WHERE end_date<%s \
+                    ORDER BY end_date LIMIT %s", (cutoff, batch_size))
+        events = cur.fetchall()
+        if len(events) == 0:
+            return
+
+        ids = [event["id"] for event in events]
+
+        cur.execute("SELECT se.event_id, s.id, s.name FROM skills_events se \
+                    JOIN skill s ON s.id=se.skill_id WHERE se.event_id IN " +
+                    _in(ids), ids)
+        skills = {}
+        skill_ids = []
+        for row in cur.fetchall():
+            skills.setdefault(row["event_id"], []).append(row["name"])
+            skill_ids.append(row["id"])
+
+        now = datetime.now()
+        cur.executemany("INSERT INTO event_archive (" + columns +
+                        ", skills, archived_date) VALUES " +
+                        _in(EVENT_COLUMNS + ("skills", "archived_date")),
+                        [tuple(event[c] for c in EVENT_COLUMNS) +
+                         (json.dumps(skills.get(event["id"], [])), now)
+                         for event in events])
+
+        cur.execute("INSERT INTO events_users_archive (event_id, user_id) \
+                    SELECT event_id, user_id FROM events_users \
+                    WHERE event_id IN " + _in(ids), ids)
+        cur.execute("DELETE FROM events_users WHERE event_id IN " + _in(ids),
+                    ids)
+
+        # Skills belong to a single event, so they go too
+        cur.execute("DELETE FROM event WHERE id IN " + _in(ids), ids)
+        if len(skill_ids) > 0:
+            cur.execute("DELETE FROM skill WHERE id IN " + _in(skill_ids),
+                        skill_ids)
+
+        cur.executemany("INSERT INTO event_tombstone (event_id, deleted_date) \
+                        VALUES (%s, %s)", [(event_id, now) for event_id in ids])
+
+        conn.commit()
+        yield events
+
+
+def init_app(app):
+    """Set up the cold search index of archived events."""
+
+    app.extensions['archive_search'] = create_search_index(
+        app, 'archive', db_archived_event.__searchable__)
+
+
+def get_archived_events_by_id(event_ids):
+    """Fetch archived events in one query, in the order of the given ids."""
+
+    if len(event_ids) == 0:
+        return []
+
+    found = db_archived_event.query.filter(
+        db_archived_event.id.in_(event_ids)).all()
+    by_id = dict((e.id, e) for e in found)
+    return [by_id[i] for i in event_ids if i in by_id]
+
+
+def get_limit(limit):
+    try:
+        return max(min(int(limit), ARCHIVE_MAX_RESULTS), 1)
+    except (TypeError, ValueError):
+        return 10
+
+
+class ArchivedEventList(Resource):
+
+    """Class for searching the events of the past."""
+
+    query_budget = {"get": 2}
+
+    @admission_control("archive_search", max_concurrent=2)
+    @key_required
+    @auth_required
+    def get(self):
+        """Return archived events, most recent first.
+
+        URL parameters:
+        - query: text to search the archive for
+        - zip and radius: only return events near the zipcode
+        - limit: max number of events returned
+
+        """
+
+        query = request.values.get("query")
+        zip = request.values.get("zip")
+        radius = request.values.get("radius")
+        limit = get_limit(request.values.get("limit"))
+
+        location = None
+        if zip is not None and radius is not None:
+            try:
+                radius = int(radius)
+                location = get_location_from_zip(int(zip))
+            except ValueError:
+                pass
+            if location is None:
+                return get_error_response("Invalid zipcode.")
+
+        if query is None:
+            events = db_archived_event.query \
+                .order_by(db_archived_event.end_date.desc()).limit(limit)
+            return get_success_response({
+                "events": [e.serialize for e in events]
+            })
+
+        archive_index = current_app.extensions['archive_search']
+        if location is not None:
+            hits = archive_index.search(query, limit, location["lat"],
+                                        location["lon"], radius)
+        else:
+            hits = archive_index.search(query, limit)
+
+        events = get_archived_events_by_id(
+            [event_id for event_id, score, dist in hits])
+        return get_success_response({
+            "events": [e.serialize for e in events]
+        })
+
+
+class ArchivedEvent(Resource):
+
+    """Class for fetching an archived event."""
+
+    query_budget = {"get": 1}
+
+    @admission_control("archived_event")
+    @key_required
+    @auth_required
+    def get(self, event_id):
+        """Return an archived event."""
+
+        e = db_archived_event.query.filter_by(id=str(event_id)).first()
+        if e is None:
+            return get_error_response("Event not found.")
+
+        return get_success_response({"event": e.serialize})
+
+
+class UserHistory(Resource):
+
+    """Class for fetching the archived events of a user."""
+
+    query_budget = {"get": 2}
+
+    @admission_control("user_history")
+    @key_required
+    @auth_required
+    def get(self, user_id):
+        """Return the archived events a user attended or created.
+
+        URL parameters:
+        - limit: max number of events of each kind returned
+
+        """
+
+        limit = get_limit(request.values.get("limit"))
+
+        attended = db_archived_event.query.join(events_users_archive,
+                events_users_archive.c.event_id == db_archived_event.id) \
+            .filter(events_users_archive.c.user_id == user_id) \
+            .order_by(db_archived_event.end_date.desc()).limit(limit)
+
+        created = db_archived_event.query \
+            .filter(db_archived_event.creator_id == user_id) \
+            .order_by(db_archived_event.end_date.desc()).limit(limit)
+
+        return get_success_response({
+            "attended_events": [e.serialize for e in attended],
+            "created_events": [e.serialize for e in created]
+        })
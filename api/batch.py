@@ -0,0 +1,167 @@
+import os
+import json
+from multiprocessing.pool import ThreadPool
+
+from flask import *
+from flask_restful import Resource
+from werkzeug.test import EnvironBuilder
+
+from api import *
+from api.admission import admission_control
+from api.metrics import metrics
+from models.routing import USE_PRIMARY
+
+BATCH_MAX_REQUESTS = 20
+"""Max number of sub-requests in a batch."""
+
+BATCH_THREADS = 4
+"""Number of sub-requests of a batch run at once."""
+
+BATCH_EXCLUDED_PATHS = ("/batch", "/events/stream", "/images")
+"""Routes that can't be part of a batch, along with the paths below them.
+
+Their responses are streamed rather than JSON documents.
+
+"""
+
+_pool = None
+_pool_pid = None
+
+
+def _thread_pool():
+    global _pool, _pool_pid
+
+    # Threads don't survive a fork, so each worker makes its own pool
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(BATCH_THREADS)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def run_subrequest(app, environ):
+    """Dispatch a request to the app in-process and return its result.
+
+    Each sub-request gets its own application context, so it has
+    its own g, database connection and query budget. Responses
+    streaming a file can't be returned in the batch, and are closed
+    unread.
+
+    """
+
+    try:
+        with app.app_context():
+            with app.request_context(environ):
+                response = app.full_dispatch_request()
+
+        try:
+            if response.direct_passthrough:
+                return {"status": 400,
+                        "body": {"error": "Route can't be batched.",
+                                 "success": False}}
+            body = response.get_data(as_text=True)
+        finally:
+            response.close()
+    except Exception:
+        app.logger.exception("Batched request to %s failed",
+                             environ["PATH_INFO"])
+        return {"status": 500, "body": {"error": "Internal error.",
+                                        "success": False}}
+
+    try:
+        body = json.loads(body)
+    except ValueError:
+        pass
+
+    return {"status": response.status_code, "body": body}
+
+
+class Batch(Resource):
+
+    """Class to run several API requests in one round trip."""
+
+    query_budget = {"post": 0}
+
+    @admission_control("batch")
+    @key_required
+    @auth_required
+    def post(self):
+        """Run a list of requests and return all of their responses.
+
+        Post body parameters:
+        - requests: list of {"method", "path", "body"} objects, where
+          path may include a query string and body is the JSON body
+          of the request, if any.
+
+        The requests are authenticated and rate limited once, with
+        the batch, though each still waits for its route's
+        concurrency limit. GET
+        requests next to each other run concurrently, while any
+        other request waits for the ones before it and runs alone,
+        so reads after a write see it. Responses are returned in
+        the order of the requests, each with its status and body.
+
+        """
+
+        app = current_app._get_current_object()
+        req_json = request.get_json(silent=True) or {}
+        specs = req_json.get("requests")
+
+        if not isinstance(specs, list) or len(specs) == 0:
+            return get_error_response("Missing requests.")
+
+        if len(specs) > BATCH_MAX_REQUESTS:
+            return get_error_response("Too many requests.")
+
+        # Sub-requests are already authenticated, but routes
+        # may still read the headers, such as the replica pinning.
+        headers = dict((name, request.headers[name])
+                       for name in ("api_key", "authorization")
+                       if name in request.headers)
+
+        environs = []
+        wrote = False
+        for spec in specs:
+            if not isinstance(spec, dict) or "path" not in spec:
+                return get_error_response("Invalid request.")
+
+            method = str(spec.get("method", "GET")).upper()
+            path = spec["path"]
+            route = path.split("?")[0].rstrip("/")
+            if any(route == excluded or route.startswith(excluded + "/")
+                   for excluded in BATCH_EXCLUDED_PATHS):
+                return get_error_response("Route can't be batched: %s" % path)
+
+            body = spec.get("body")
+            builder = EnvironBuilder(
+                path=path, method=method,
+                headers=headers,
+                data=json.dumps(body) if body is not None else None,
+                content_type="application/json" if body is not None else None,
+                environ_base={
+                    "REMOTE_ADDR": request.remote_addr,
+                    AUTHENTICATED: True,
+
+                    # Replicas may not have the batch's writes yet
+                    USE_PRIMARY: wrote
+                })
+            environs.append(builder.get_environ())
+            wrote = wrote or method not in ("GET", "HEAD")
+
+        # Group runs of reads, so each group can run concurrently
+        groups = []
+        for environ in environs:
+            if environ["REQUEST_METHOD"] in ("GET", "HEAD") and \
+               len(groups) > 0 and groups[-1][0]["REQUEST_METHOD"] in \
+               ("GET", "HEAD"):
+                groups[-1].append(environ)
+            else:
+                groups.append([environ])
+
+        pool = _thread_pool()
+        responses = []
+        for group in groups:
+            responses.extend(pool.map(
+                lambda environ: run_subrequest(app, environ), group))
+
+        metrics.observe("batch.size", len(specs))
+        return get_success_response({"responses": responses})
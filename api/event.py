@@ -1,4 +1,6 @@
-from datetime import datetime
+import heapq
+from math import cos, radians
+from datetime import datetime, timedelta
 
 from flask import *
 from flask.ext.mysqldb import MySQL
@@ -6,26 +8,215 @@ from flask.ext.mysqldb import MySQLdb
 from flask_restful import Resource, Api
 from flask.ext.security.utils import encrypt_password, verify_password
 
+from sqlalchemy import or_
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.exc import IntegrityError
 from werkzeug import secure_filename
 import requests
 
-from models.models import Event as db_event, Skill
+from models.models import Event as db_event, Skill, EventTombstone, db
+from models.queries import get_event
 from globals import *
 from api import *
+from api.signals import event_saved, event_deleted, signups_changed
+from api.admission import admission_control
+from api.analytics import count_event_created, count_event_deleted
+from api.zipcodes import get_neighbor_zipcodes
+from api.search import MILES_PER_DEGREE
+from api.ranking import Ranker
+from jobs import enqueue
 
 DEFAULT_EVENT_LIMIT = 10
 """Default limit for number of search results returned."""
 
-MAX_SEARCH_RANGE = 6
-"""Max range for location based search, in degrees.
+MAX_EVENT_LIMIT = 100
+"""Largest number of search results returned at once."""
 
-Used to limit initial WooshAlchmey index based search 
-to a roughly (2*MAX_SEARCH_RANGE)^2 sized box to optimize 
-query time. 
+SEARCH_BATCH_SIZE = 1000
+"""Number of rows fetched at a time when streaming through events."""
+
+EVENT_CACHE_TTL = 60
+"""Seconds a serialized event is cached for.
+
+Cached events are dropped when they change, so this only bounds
+how stale they can get after a change made on another host.
+
+"""
+
+
+SYNC_TOKEN_FORMAT = "%Y%m%d%H%M%S"
+"""Format of the opaque sync token handed to clients.
+
+The token is a server time, truncated to the one second
+resolution of MySQL DATETIME columns.
 
 """
 
+SYNC_TOKEN_OVERLAP = 60
+"""Seconds before the start of a sync that the next sync reads from.
+
+Rows are stamped with the time they were written on an API host,
+not when their transaction committed, so a change stamped before a
+sync started may only become visible after it read. Handing out a
+token from a little earlier returns such changes on the next sync,
+along with some that the client already has.
+
+"""
+
+def iter_event_locations(neighbors=None, bounds=None):
+    """Yield the (id, lat, lon) of every event with a location.
+
+    Only the columns needed to rank events by distance are loaded,
+    and rows are streamed from the database in batches, so memory
+    use doesn't grow with the number of events. Pass neighbors to
+    only consider events in those zipcodes, and bounds as
+    (min lat, max lat, min lon, max lon) to only consider events
+    inside that box.
+
+    """
+
+    locations = db.session.query(db_event.id, db_event.lat, db_event.lon) \
+        .filter(db_event.lat != None, db_event.lon != None)
+
+    if neighbors is not None:
+        locations = locations.filter(db_event.zipcode.in_(neighbors))
+
+    if bounds is not None:
+        locations = locations.filter(
+            db_event.lat.between(bounds[0], bounds[1]),
+            db_event.lon.between(bounds[2], bounds[3]))
+
+    return locations.execution_options(stream_results=True) \
+        .yield_per(SEARCH_BATCH_SIZE)
+
+
+def nearest_events(lat, lon, radius, limit, neighbors=None):
+    """Return the ids of the nearest events within radius miles.
+
+    At most limit ids are returned, nearest first, and limit must be
+    at least 1. Candidates are kept in a bounded heap while streaming
+    through the events.
+
+    """
+
+    lat_range = radius / MILES_PER_DEGREE
+    lon_range = lat_range / max(cos(radians(lat)), 0.01)
+    bounds = (lat - lat_range, lat + lat_range, lon - lon_range, lon + lon_range)
+
+    # Workers started from a snapshot of the event locations only
+    # read the events changed since. Searches cached before this
+    # worker saw a change are dropped.
+    snapshot = current_app.extensions.get('event_snapshot')
+    if snapshot is not None:
+        if snapshot.catch_up(current_app.mysql.connection):
+            current_app.extensions['search_cache'].bump()
+        locations = snapshot.within(bounds)
+    else:
+        locations = iter_event_locations(neighbors, bounds)
+
+    # The heap's first entry is the farthest event kept so far.
+    # Among events at the same distance, lower ids win.
+    heap = []
+    for event_id, event_lat, event_lon in locations:
+        miles = 0.62 * calculate_equirectangular_distance(lat, lon, event_lat,
+                                                          event_lon)
+        if miles >= radius:
+            continue
+
+        entry = (-miles, -event_id)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    return [-event_id for miles, event_id in sorted(heap, reverse=True)]
+
+
+def search_events(query, limit, zip=None, location=None, radius=None):
+    """Return the ids of the events best matching a search, in order.
+
+    Pass the zipcode, its location and a radius to only search for
+    events near the zipcode.
+
+    """
+
+    if query is not None:
+
+        # The search index is partitioned by location, so a search
+        # near a zipcode only looks at the shards around it, and
+        # hits come back already limited to the radius and ranked
+        # on relevance, distance, start date and open slots.
+        search_index = current_app.extensions['search']
+        ranker = Ranker.from_config(current_app.config, location is not None)
+        if location is not None:
+            hits = search_index.search(query, limit, location["lat"],
+                                       location["lon"], radius, ranker)
+        else:
+            hits = search_index.search(query, limit, ranker=ranker)
+
+        return [event_id for event_id, score, dist in hits]
+
+    # Without a query, only the nearest events within the radius
+    # are kept while streaming through the candidates. For the
+    # standard radii, the precomputed zipcode neighbor table
+    # narrows those down to the events in nearby zipcodes.
+    neighbors = get_neighbor_zipcodes(zip, radius)
+    return nearest_events(location["lat"], location["lon"], radius, limit,
+                          neighbors)
+
+
+def serialize_events_by_id(event_ids):
+    """Return the serialized events with the given ids, in order.
+
+    Serialized events are shared by the workers through the cache,
+    and only the ones missing from it are loaded.
+
+    """
+
+    cache = current_app.extensions['cache']
+    found = {}
+    missing = []
+    for event_id in event_ids:
+        event = cache.get("event:%d" % event_id)
+        if event is not None:
+            found[event_id] = event
+        else:
+            missing.append(event_id)
+
+    for e in get_events_by_id(missing):
+        found[e.id] = e.serialize
+        cache.set("event:%d" % e.id, found[e.id], EVENT_CACHE_TTL)
+
+    return [found[i] for i in event_ids if i in found]
+
+
+def uncache_event(app, **kwargs):
+    event_id = kwargs.get("event_id")
+    if event_id is None:
+        event_id = kwargs["event"].id
+    app.extensions['cache'].delete("event:%d" % int(event_id))
+
+
+def init_event_cache(app):
+    """Drop cached events when they change."""
+
+    event_saved.connect(uncache_event, sender=app)
+    event_deleted.connect(uncache_event, sender=app)
+    signups_changed.connect(uncache_event, sender=app)
+
+
+def get_events_by_id(event_ids):
+    """Fetch events in one query, in the order of the given ids."""
+
+    if len(event_ids) == 0:
+        return []
+
+    found = db_event.query.options(subqueryload(db_event.skills)) \
+        .filter(db_event.id.in_(event_ids)).all()
+    by_id = dict((e.id, e) for e in found)
+    return [by_id[i] for i in event_ids if i in by_id]
+
+
 class EventList(Resource):
 
     """A class representing a list of events.
@@ -36,6 +227,9 @@ class EventList(Resource):
 
     """
 
+    query_budget = {"get": 5, "post": 20}
+
+    @admission_control("event_search", max_concurrent=4)
     @key_required
     @auth_required
     def get(self):
@@ -45,7 +239,8 @@ class EventList(Resource):
         - query: used to search for related events
         - zip: used to search for nearby events
         - raidus: used to limit range of nearby events
-        - limit: used to limit number of events returned
+        - limit: used to limit number of events returned,
+          DEFAULT_EVENT_LIMIT if not given, at most MAX_EVENT_LIMIT
 
         """
 
@@ -55,13 +250,17 @@ class EventList(Resource):
         radius = request.values.get("radius")
         limit = request.values.get("limit")
 
-        # If limit cannot be cast as an int, 
+        # If limit is missing or cannot be cast as an int,
         # fail gracefully and just use the default limit
-        if limit is not None:
-            try:
-                limit = int(limit)
-            except ValueError:
-                limit = DEFAULT_EVENT_LIMIT
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            limit = DEFAULT_EVENT_LIMIT
+
+        # Everything below relies on the limit being checked here
+        if limit < 1:
+            return get_error_response("Invalid limit.")
+        limit = min(limit, MAX_EVENT_LIMIT)
 
         # We only want to do location based search if
         # both a zipcode and a radius are provided
@@ -89,67 +288,32 @@ class EventList(Resource):
                 # If location fetching failed, abandon search.
                 return get_error_response("Invalid zipcode.")
 
-        
-        if query is None:
-            # If no search query is provided, use all events
-            results = db_event.query.all()
-
-        else:
-            if use_location == True:
-
-                # This limits the inital query to a roughly (2*MAX_SEARCH_RANGE)^2  
-                # mile box around the location and  prevents us from having 
-                # to calculate the equirectangular distance for every event 
-                # matching the query across the world.
-                results = db_event.query.whoosh_search(query).filter(
-                    db_event.lat < location["lat"] + MAX_SERACH_RANGE,
-                    db_event.lat > location["lat"] - MAX_SEARCH_RANGE,
-                    db_event.lon < location["lon"] + MAX_SEARCH_RANGE,
-                    db_event.lon > location["lon"] - MAX_SEARCH_RANGE
-                )
-
-            else:
-                results = db_event.query.whoosh_search(query)
-
-        if use_location == True:
 
-            # Now we further refine the search results by calculating
-            # the actual equirectangular distance.
-            for e in results:
+        if use_location != True:
+            zip = radius = location = None
 
-                # Make sure the event's location is set
-                if e.lat is not None and e.lon is not None: 
+        # Identical searches are common, so their ranked results are
+        # cached until an event changes.
+        if query is not None or use_location == True:
+            search_cache = current_app.extensions['search_cache']
+            params = search_cache.normalize(query, zip, radius, limit)
+            key = search_cache.key(params)
+            event_ids = search_cache.get(key, params)
+            if event_ids is None:
+                event_ids = search_events(query, limit, zip, location, radius)
+                search_cache.set(key, event_ids)
 
-                    # Get distance between coordinates
-                    dist = calculate_equirectangular_distance(location["lat"], 
-                                                              location["lon"],
-                                                              e.lat, e.lon)
-                    # Convert km to miles
-                    miles = 0.62 * dist
+            events = serialize_events_by_id(event_ids)
+            return get_success_response({"events": events})
 
-                    # Store the distance with each event for sorting later
-                    e.dist = miles
+        # Skills are loaded up front, since every result is serialized
+        results = db_event.query.options(subqueryload(db_event.skills)) \
+            .order_by(db_event.id).limit(limit)
+        events = [e.serialize for e in results]
 
-            # Sort the results by distance
-            results.sort(key=lambda event: event.dist)
-
-        events = []
-
-        # Each event must be serialized. Also, eliminate 
-        # locations oustide radius if doing location based 
-        # search and stop and return if we reach limit
-        for e in results:
-
-            if limit is not None and len(events) == limit:
-                 return get_success_response({"events": events})
-            
-            if use_location and e.dist < radius:
-                events.append(e.serialize)
-            else:
-                events.append(e.serialize)
-        
         return get_success_response({"events": events})
 
+    @admission_control("event_create")
     @key_required
     @auth_required
     def post(self):
@@ -245,14 +409,18 @@ class EventList(Resource):
 
             try:
 
-                # Push the event to the database
+                # Push the event to the database, counting it in
+                # its organization's stats in the same transaction
                 db.session.add(event)
+                count_event_created(db.session, event)
                 db.session.commit()
 
             except IntegrityError:
                 msg = "Foreign key error."
                 return get_error_response(msg)
 
+            event_saved.send(app, event=event, created=True)
+
             return get_success_response({"event": event.serialize})
 
         else:
@@ -265,19 +433,25 @@ class Event(Resource):
 
     """Class for fetching, updating and deleting events."""
 
+    query_budget = {"get": 3, "post": 25, "delete": 10}
+
+    @admission_control("event")
     @key_required
     @auth_required
     def get(self, event_id):
         """Return an event."""
 
-        app = current_app._get_current_object()
-        conn = app.mysql.connection
-        cur = conn.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            events = serialize_events_by_id([int(event_id)])
+        except ValueError:
+            return get_error_response("Event not found.")
 
-        e = db_event.query.filter_by(id=str(event_id)).first()
+        if len(events) == 0:
+            return get_error_response("Event not found.")
 
-        return get_success_response({"event": e.serialize})
+        return get_success_response({"event": events[0]})
 
+    @admission_control("event_update")
     @key_required
     @auth_required
     def post(self, event_id):
@@ -321,6 +495,7 @@ class Event(Resource):
 
         # If the user provided a zipcode, set their coordinates
         zipcode = req_json.get("zipcode",None)
+        location = None
         if zipcode is not None:
 
             try: 
@@ -343,10 +518,14 @@ class Event(Resource):
         if close_date is not None:
             close_date = datetime.strptime(close_date, '%m/%d/%Y')
 
-        event = db_event.query.filter_by(id=str(event_id)).first()
+        event = get_event(event_id)
 
         if event is not None:
 
+            # Remember where the event was, so derived state
+            # keyed by location can move it.
+            previous = (event.lat, event.lon)
+
             # Only update params that were given.
             event.name = event_name or event.name
             event.short_desc = short_desc or event.short_desc
@@ -358,6 +537,7 @@ class Event(Resource):
             event.street_addr = street_addr or event.street_addr
             event.zipcode = zipcode or event.zipcode
             event.organization = organization or event.organization
+            event.last_updated_date = datetime.now()
 
             if location is not None:
                 event.city = location["city"] or event.city
@@ -374,30 +554,127 @@ class Event(Resource):
 
             db.session.commit()
 
+            event_saved.send(app, event=event, created=False,
+                              previous=previous)
+
             return get_success_response({"event": event.serialize})
 
         else:
             return get_error_response("Event not found.")
 
+    @admission_control("event_delete")
     @key_required
     @auth_required
     def delete(self, event_id):
-        """Delete an event."""
+        """Delete an event.
+
+        A tombstone is recorded in the same transaction so that
+        syncing clients find out about the deletion.
+
+        """
 
         app = current_app._get_current_object()
         conn = app.mysql.connection
         cur = conn.cursor(MySQLdb.cursors.DictCursor)
 
+        cur.execute("SELECT * FROM event WHERE id=%s", (event_id,))
+        event = cur.fetchone()
+
         cur.execute("DELETE FROM event WHERE id=%s", ({event_id}))
+        deleted = cur.rowcount > 0
+
+        if deleted:
+            cur.execute("INSERT INTO event_tombstone (event_id, deleted_date) \
+                        VALUES (%s, %s)", (event_id, datetime.now()))
+            count_event_deleted(conn, event)
+
         conn.commit()
 
+        if deleted:
+            event_deleted.send(app, event_id=event_id, event=event)
+
         return get_success_response()
 
 
+class EventChanges(Resource):
+
+    """Class providing a change feed of events for syncing clients."""
+
+    query_budget = {"get": 4}
+
+    @admission_control("event_changes", max_concurrent=4)
+    @key_required
+    @auth_required
+    def get(self):
+        """Return events changed since the given sync token.
+
+        URL parameters:
+        - token: sync token returned by the previous sync. If not
+          provided, every event is returned as created.
+
+        Each sync also returns the changes of the last
+        SYNC_TOKEN_OVERLAP seconds before the previous one, which
+        the client may already have, so clients should upsert events
+        by id and ignore deletions of events they don't have.
+
+        """
+
+        token = request.values.get("token")
+
+        # Take the new token before querying, and from a little
+        # earlier still, so that changes committed while or after
+        # we read are picked up by the next sync.
+        now = datetime.now() - timedelta(seconds=SYNC_TOKEN_OVERLAP)
+        next_token = now.strftime(SYNC_TOKEN_FORMAT)
+
+        events = db_event.query.options(subqueryload(db_event.skills))
+
+        if token is None:
+            results = events.all()
+            return get_success_response({
+                "created": [e.serialize for e in results],
+                "updated": [],
+                "deleted": [],
+                "token": next_token
+            })
+
+        try:
+            since = datetime.strptime(token, SYNC_TOKEN_FORMAT)
+        except ValueError:
+            return get_error_response("Invalid sync token.")
+
+        results = events.filter(or_(
+            db_event.created_date >= since,
+            db_event.last_updated_date >= since
+        ))
+
+        created = []
+        updated = []
+        for e in results:
+            if e.created_date is not None and e.created_date >= since:
+                created.append(e.serialize)
+            else:
+                updated.append(e.serialize)
+
+        tombstones = EventTombstone.query.filter(
+            EventTombstone.deleted_date >= since)
+        deleted = [t.event_id for t in tombstones]
+
+        return get_success_response({
+            "created": created,
+            "updated": updated,
+            "deleted": deleted,
+            "token": next_token
+        })
+
+
 class EventPic(Resource):
 
     """Class to handle update picture route."""
 
+    query_budget = {"post": 3}
+
+    @admission_control("event_pic", max_concurrent=2)
     @key_required
     @auth_required
     def post(self,event_id):
@@ -421,18 +698,21 @@ class EventPic(Resource):
             # Save pic url to user
             db = app.db
 
-            event = db_event.query.filter_by(id=str(event_id)).first()
+            event = get_event(event_id)
 
             if event is not None:
-
-                # delete the old pic if there was one
-                if event.pic_url is not None:
-                    os.remove(os.path.join(app.config['EVENT_PIC_UPLOAD_FOLDER'],
-                                           event.pic_url))
+                old_pic_url = event.pic_url
 
                 event.pic_url = filename
 
                 db.session.commit()
+                uncache_event(app, event=event)
+
+                # delete the old pic if there was one
+                if old_pic_url is not None:
+                    enqueue("remove_file",
+                            os.path.join(app.config['EVENT_PIC_UPLOAD_FOLDER'],
+                                         old_pic_url))
 
                 return get_success_response({"filename": filename})
 
@@ -0,0 +1,265 @@
+import json
+from math import cos, radians
+from datetime import datetime
+
+from flask import *
+from flask_restful import Resource
+
+from models.models import (User as db_user, Event as db_event, UserFeed,
+    db)
+from models.queries import get_user, get_event
+from api import *
+from api.event import get_events_by_id
+from api.signals import event_saved, event_deleted, signups_changed, user_saved
+from api.admission import admission_control
+from api.zipcodes import get_neighbor_zipcodes
+from jobs import enqueue
+
+FEED_RADIUS = 25
+"""Radius, in miles, of the events included in a user's feed."""
+
+FEED_SIZE = 50
+"""Max number of events kept in a user's feed."""
+
+
+def is_open(event, now):
+    """Check that an event is upcoming and still needs volunteers."""
+
+    return event.end_date is not None and event.end_date > now \
+        and event.lat is not None and event.lon is not None \
+        and (event.max_volunteers_needed is None or
+             (event.current_num_volunteers or 0) < event.max_volunteers_needed)
+
+
+def distance_to(user, event):
+    """Distance from a user to an event, in miles."""
+
+    return 0.62 * calculate_equirectangular_distance(user.lat, user.lon,
+                                                     event.lat, event.lon)
+
+
+def build_feed(user):
+    """Compute the feed entries of a user from scratch."""
+
+    if user.lat is None or user.lon is None:
+        return []
+
+    neighbors = None
+    if user.zipcode is not None:
+        neighbors = get_neighbor_zipcodes(user.zipcode, FEED_RADIUS)
+
+    events = db_event.query.filter(db_event.end_date > datetime.now())
+    if neighbors is not None:
+        events = events.filter(db_event.zipcode.in_(neighbors))
+
+    now = datetime.now()
+    entries = []
+    for event in events:
+        if is_open(event, now):
+            dist = distance_to(user, event)
+            if dist <= FEED_RADIUS:
+                entries.append([event.id, round(dist, 2)])
+
+    entries.sort(key=lambda entry: entry[1])
+    return entries[:FEED_SIZE]
+
+
+def create_feed(user, entries):
+    """Store the feed entries of a user who has no feed yet, and commit.
+
+    Concurrent first reads of a feed each build it, so the later
+    write replaces the earlier one instead of failing on the
+    primary key.
+
+    """
+
+    app = current_app._get_current_object()
+    conn = app.mysql.connection
+    cur = conn.cursor()
+    cur.execute("INSERT INTO user_feed (user_id, zipcode, entries, \
+                updated_date) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY \
+                UPDATE zipcode=VALUES(zipcode), entries=VALUES(entries), \
+                updated_date=VALUES(updated_date)",
+                (user.id, user.zipcode, json.dumps(entries), datetime.now()))
+    conn.commit()
+
+
+def save_feed(user, entries, feed):
+    """Update the stored feed entries of a user, without committing."""
+
+    feed.zipcode = user.zipcode
+    feed.entries = json.dumps(entries)
+    feed.updated_date = datetime.now()
+    return feed
+
+
+def users_near(lat, lon, zipcode):
+    """Return the users who may have an event at this place in their feed."""
+
+    neighbors = None
+    if zipcode is not None:
+        try:
+            neighbors = get_neighbor_zipcodes(int(zipcode), FEED_RADIUS)
+        except ValueError:
+            pass
+
+    if neighbors is not None:
+        zipcodes = set(int(z) for z in neighbors)
+        return db_user.query.filter(db_user.zipcode.in_(zipcodes))
+
+    lat_range = FEED_RADIUS / 69.0
+    lon_range = lat_range / max(cos(radians(lat)), 0.01)
+    return db_user.query.filter(
+        db_user.lat.between(lat - lat_range, lat + lat_range),
+        db_user.lon.between(lon - lon_range, lon + lon_range))
+
+
+def update_feeds(event=None, event_id=None, lat=None, lon=None, zipcode=None):
+    """Apply a change to one event to the feeds of the users near it.
+
+    Pass the event if it still exists, otherwise its id and the
+    location it had. The event is removed from every nearby feed and
+    put back in order where it still belongs. A feed that drops below
+    its full size is rebuilt, since the next nearest event may have
+    been cut off before.
+
+    """
+
+    if event is not None:
+        event_id, lat, lon, zipcode = event.id, event.lat, event.lon, \
+            event.zipcode
+        keep = is_open(event, datetime.now())
+    else:
+        keep = False
+
+    if lat is None or lon is None:
+        return
+
+    users = users_near(lat, lon, zipcode).all()
+    if len(users) == 0:
+        return
+
+    feeds = UserFeed.query.filter(
+        UserFeed.user_id.in_([u.id for u in users])).all()
+    feeds = dict((feed.user_id, feed) for feed in feeds)
+
+    event_id = int(event_id)
+    for user in users:
+        feed = feeds.get(user.id)
+
+        # Feeds are built on first read, so there is nothing
+        # to keep up to date for users who haven't read theirs.
+        if feed is None:
+            continue
+
+        entries = json.loads(feed.entries)
+        full = len(entries) >= FEED_SIZE
+        entries = [entry for entry in entries if entry[0] != event_id]
+
+        if keep and user.lat is not None and user.lon is not None:
+            dist = distance_to(user, event)
+            if dist <= FEED_RADIUS:
+                entries.append([event_id, round(dist, 2)])
+                entries.sort(key=lambda entry: entry[1])
+                entries = entries[:FEED_SIZE]
+
+        if full and len(entries) < FEED_SIZE:
+            entries = build_feed(user)
+
+        save_feed(user, entries, feed)
+
+    db.session.commit()
+
+
+def update_event_feeds(event, previous=None):
+    """Apply a change to an event to the feeds of the users near it.
+
+    If the event moved, pass the coordinates it had as previous.
+
+    """
+
+    # Users near the event's old location lose it first, then
+    # users near its new location get it.
+    if previous is not None and previous[0] is not None and \
+       tuple(previous) != (event.lat, event.lon):
+        update_feeds(event_id=event.id, lat=previous[0], lon=previous[1])
+
+    update_feeds(event)
+
+
+def rebuild_feed(user):
+    """Rebuild the feed of a user whose zipcode changed, if they have one."""
+
+    feed = UserFeed.query.get(user.id)
+    if feed is not None and feed.zipcode != user.zipcode:
+        save_feed(user, build_feed(user), feed)
+        db.session.commit()
+
+
+# A change to an event can touch the feeds of every user near it,
+# so feeds are updated by the job workers rather than the request.
+
+def on_event_saved(app, event, created, previous=None):
+    enqueue("update_event_feeds", event.id, previous)
+
+
+def on_event_deleted(app, event_id, event):
+    if event["lat"] is not None and event["lon"] is not None:
+        enqueue("remove_event_from_feeds", int(event_id), event["lat"],
+                event["lon"], event["zipcode"])
+
+
+def on_signups_changed(app, event_id, user_ids, delta):
+    enqueue("update_event_feeds", int(event_id))
+
+
+def on_user_saved(app, user, created):
+    if not created:
+        enqueue("rebuild_feed", user.id)
+
+
+def init_app(app):
+    """Keep the materialized feeds up to date as events and users change."""
+
+    event_saved.connect(on_event_saved, sender=app)
+    event_deleted.connect(on_event_deleted, sender=app)
+    signups_changed.connect(on_signups_changed, sender=app)
+    user_saved.connect(on_user_saved, sender=app)
+
+
+class Feed(Resource):
+
+    """Class to handle a user's feed of nearby events."""
+
+    query_budget = {"get": 8}
+
+    @admission_control("user_feed")
+    @key_required
+    @auth_required
+    def get(self, user_id):
+        """Return upcoming events with open slots near the user."""
+
+        user = get_user(user_id)
+        if user is None:
+            return get_error_response("User not found.")
+
+        feed = UserFeed.query.get(user.id)
+        if feed is not None:
+            entries = json.loads(feed.entries)
+        else:
+            entries = build_feed(user)
+            create_feed(user, entries)
+
+        dists = dict((event_id, dist) for event_id, dist in entries)
+
+        # Entries may be a little stale, so skip any
+        # event that has filled up or ended since.
+        now = datetime.now()
+        events = []
+        for e in get_events_by_id([event_id for event_id, dist in entries]):
+            if is_open(e, now):
+                event = e.serialize
+                event["dist"] = dists[e.id]
+                events.append(event)
+
+        return get_success_response({"events": events})
@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from math import cos, radians
+from datetime import datetime
+
+from api import calculate_equirectangular_distance
+from api.ranking import TopK
+from api.search import (SearchBackend, MILES_PER_DEGREE, RANKING_FIELDS,
+    RANKING_FETCH_FACTOR)
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def match_expression(query):
+    """Return an FTS5 query matching documents with every word of query.
+
+    Each word is quoted, so that characters with a meaning in FTS5
+    queries are searched for as they are.
+
+    """
+
+    return " ".join('"%s"' % word for word in _WORD.findall(query))
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return time.mktime(value.timetuple())
+
+
+class Fts5Index(SearchBackend):
+
+    """Full text index of events in a SQLite FTS5 table.
+
+    Unlike Whoosh, matching and BM25 scoring run in SQLite's C code,
+    and the whole index is a single file. The database is in WAL
+    mode, so searches don't wait for the job workers writing to it.
+    Coordinates and RANKING_FIELDS are kept in unindexed columns of
+    the same table, and searches near a location filter on them by
+    bounding box before computing distances.
+
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = list(fields)
+        self.columns = self.fields + ["lat", "lon"] + list(RANKING_FIELDS)
+        self.local = threading.local()
+
+    def _connect(self):
+        # Connections can't be shared by threads, nor survive a fork
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS event_fts USING \
+                     fts5(" + ", ".join(self.fields) + ", " +
+                     ", ".join(c + " UNINDEXED" for c in self.columns
+                               if c not in self.fields) +
+                     ", tokenize='porter unicode61')")
+        conn.commit()
+
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def _row(self, event):
+        row = [event.id]
+        for field in self.fields:
+            value = getattr(event, field)
+            row.append(value if value is None else u"%s" % value)
+        row.append(event.lat)
+        row.append(event.lon)
+        for field in RANKING_FIELDS:
+            value = getattr(event, field, None)
+            if isinstance(value, datetime):
+                value = _timestamp(value)
+            row.append(value)
+        return row
+
+    def _insert(self, conn, events):
+        statement = "INSERT INTO event_fts (rowid, " + \
+            ", ".join(self.columns) + ") VALUES (" + \
+            ", ".join(["?"] * (len(self.columns) + 1)) + ")"
+
+        rows = [self._row(event) for event in events
+                if event.lat is not None and event.lon is not None]
+        conn.executemany(statement, rows)
+        return len(rows)
+
+    def add(self, event, previous=None):
+        """Index an event.
+
+        Events are found by id whatever their coordinates, so
+        previous is not needed.
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM event_fts WHERE rowid=?", (event.id,))
+            self._insert(conn, [event])
+
+    def add_many(self, events):
+        """Index many events, in one transaction."""
+
+        events = list(events)
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM event_fts WHERE rowid=?",
+                             [(event.id,) for event in events])
+            self._insert(conn, events)
+
+    def remove(self, event_id, lat, lon):
+        """Remove an event."""
+
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM event_fts WHERE rowid=?",
+                         (int(event_id),))
+
+    def remove_many(self, locations):
+        """Remove many events, given as (event id, lat, lon) tuples."""
+
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM event_fts WHERE rowid=?",
+                             [(int(event_id),) for event_id, lat, lon
+                              in locations])
+
+    def rebuild(self, events):
+        """Replace the whole index with the given events.
+
+        Returns the number of events indexed.
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM event_fts")
+            indexed = self._insert(conn, events)
+        conn.execute("INSERT INTO event_fts (event_fts) VALUES ('optimize')")
+        conn.commit()
+        return indexed
+
+    def _ranked_rows(self, statement, params, page):
+        """Yield the rows of a search in order, a page at a time.
+
+        Each page is a query with a LIMIT, twice as long as the one
+        before, so that SQLite only keeps the best rows of a page
+        sorted instead of sorting every match, and a search that
+        stops early doesn't read the pages after. Every match is
+        still scored by each query. With page None, all rows are
+        read by one query.
+
+        """
+
+        conn = self._connect()
+        if page is None:
+            for row in conn.execute(statement, params):
+                yield row
+            return
+
+        offset = 0
+        while True:
+            rows = conn.execute(statement + " LIMIT ? OFFSET ?",
+                                params + [page, offset]).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < page:
+                return
+            offset += page
+            page *= 2
+
+    def search(self, query, limit=None, lat=None, lon=None, radius=None,
+               ranker=None):
+        """Search for events matching a text query.
+
+        If lat, lon and radius (in miles) are given, only events
+        within radius are returned. Returns a list of (event id,
+        score, distance) tuples, best score first and nearest first
+        among equal scores. Distance is None for searches without a
+        location.
+
+        Hits are scored by text relevance alone, unless a Ranker
+        from api/ranking.py is given to score them.
+
+        """
+
+        if limit is not None and limit < 1:
+            return []
+
+        expression = match_expression(query)
+        if expression == "":
+            return []
+
+        # rank is bm25(), which is lower for better matches, so it
+        # is negated
+        statement = "SELECT rowid, -rank, lat, lon, " + \
+            ", ".join(RANKING_FIELDS) + \
+            " FROM event_fts WHERE event_fts MATCH ?"
+        params = [expression]
+
+        if lat is not None:
+            lat = float(lat)
+            lon = float(lon)
+            lat_range = radius / MILES_PER_DEGREE
+            lon_range = radius / (MILES_PER_DEGREE *
+                                  max(cos(radians(lat)), 0.01))
+            statement += " AND lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?"
+            params += [lat - lat_range, lat + lat_range,
+                       lon - lon_range, lon + lon_range]
+
+        statement += " ORDER BY rank, rowid"
+
+        # Without a ranker or a radius, the first limit rows are the
+        # hits. Otherwise some rows are passed over, so more are read.
+        page = limit
+        if limit is not None and (ranker is not None or lat is not None):
+            page = limit * RANKING_FETCH_FACTOR
+
+        top = TopK(limit)
+        hits = []
+        for row in self._ranked_rows(statement, params, page):
+            event_id, score, hit_lat, hit_lon = row[:4]
+
+            # Rows come best text score first, so we can stop once
+            # no row left could make the top
+            if ranker is not None:
+                threshold = top.threshold()
+                if threshold is not None and ranker.bound(score) <= threshold:
+                    break
+
+            dist = None
+            if lat is not None:
+                dist = 0.62 * calculate_equirectangular_distance(
+                    lat, lon, hit_lat, hit_lon)
+                if dist > radius:
+                    continue
+
+            if ranker is None:
+                hits.append((event_id, score, dist))
+                if limit is not None and len(hits) == limit:
+                    break
+                continue
+
+            fields = dict(zip(RANKING_FIELDS, row[4:]))
+            if fields["start_date"] is not None:
+                fields["start_date"] = datetime.fromtimestamp(
+                    fields["start_date"])
+            score = ranker.score(score, dist, fields)
+            top.push(score, (event_id, score, dist))
+
+        if ranker is not None:
+            return top.items()
+        return sorted(hits, key=lambda hit: (-hit[1], hit[2] or 0))
@@ -0,0 +1,77 @@
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def encode(lat, lon, precision):
+    """Return the geohash of a coordinate with the given precision."""
+
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+
+        # Bits alternate between longitude and latitude,
+        # starting with longitude.
+        if even:
+            value, bounds = lon, lon_range
+        else:
+            value, bounds = lat, lat_range
+
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits = bits << 1
+            bounds[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """Return the (lat, lon) size in degrees of a geohash cell."""
+
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = (5 * precision) // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def cells_covering(min_lat, min_lon, max_lat, max_lon, precision):
+    """Return the set of geohash cells overlapping a lat/lon box."""
+
+    lat_step, lon_step = cell_size(precision)
+
+    min_lat = max(min_lat, -90.0)
+    max_lat = min(max_lat, 90.0)
+    min_lon = max(min_lon, -180.0)
+    max_lon = min(max_lon, 180.0)
+
+    # Sample the box once per cell, plus its far edges, so that
+    # every cell it touches is hit at least once.
+    lats = []
+    lat = min_lat
+    while lat < max_lat:
+        lats.append(lat)
+        lat += lat_step
+    lats.append(max_lat)
+
+    lons = []
+    lon = min_lon
+    while lon < max_lon:
+        lons.append(lon)
+        lon += lon_step
+    lons.append(max_lon)
+
+    return set(encode(lat, lon, precision) for lat in lats for lon in lons)
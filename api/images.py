@@ -0,0 +1,135 @@
+import os
+from zlib import adler32
+
+from flask import *
+from flask_restful import Resource
+from werkzeug import secure_filename, wrap_file
+from werkzeug.http import parse_range_header
+
+from api import *
+
+IMAGE_MAX_AGE = 31536000
+"""Seconds clients may cache an image for.
+
+Every upload gets a new file name, so a name always refers to
+the same image and can be cached for as long as possible.
+
+"""
+
+IMAGE_FOLDERS = {
+    "profile": "UPLOAD_FOLDER",
+    "event": "EVENT_PIC_UPLOAD_FOLDER"
+}
+"""Config keys of the folder of each kind of image."""
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif")
+)
+
+
+def image_type(path):
+    """Return the mimetype of an image from its first bytes.
+
+    Uploads are saved without an extension, so the type
+    can't be guessed from the name.
+
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(8)
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    return "application/octet-stream"
+
+
+def not_found():
+    response = get_error_response("Image not found.")
+    response.status_code = 404
+    return response
+
+
+class Image(Resource):
+
+    """Class to serve uploaded profile and event pictures."""
+
+    query_budget = {"get": 0}
+
+    # Not rate limited, since a single screen can show many
+    # pictures and they are cheap to serve.
+    def get(self, kind, filename):
+        """Return an image, or the requested byte range of it.
+
+        When IMAGE_ACCEL_REDIRECT is set, the file is handed to
+        Nginx to send. Otherwise it is sent from the worker with
+        the server's zero-copy file wrapper where possible.
+
+        """
+
+        app = current_app._get_current_object()
+
+        folder = IMAGE_FOLDERS.get(kind)
+        if folder is None or filename != secure_filename(filename):
+            return not_found()
+
+        path = os.path.join(app.config[folder], filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return not_found()
+
+        etag = "%s-%x-%x" % (int(stat.st_mtime), stat.st_size,
+                             adler32(filename.encode("utf-8")) & 0xffffffff)
+
+        def cached(response):
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = \
+                "public, max-age=%d, immutable" % IMAGE_MAX_AGE
+            response.headers["Accept-Ranges"] = "bytes"
+            return response
+
+        if request.if_none_match.contains(etag):
+            return cached(app.response_class(status=304))
+
+        mimetype = image_type(path)
+
+        prefix = app.config['IMAGE_ACCEL_REDIRECT']
+        if prefix is not None:
+            response = app.response_class(mimetype=mimetype)
+            response.headers["X-Accel-Redirect"] = "%s/%s/%s" % (
+                prefix.rstrip("/"), os.path.basename(app.config[folder]),
+                filename)
+            return cached(response)
+
+        # A range only applies if the client's copy is this image
+        byte_range = parse_range_header(request.headers.get("Range"))
+        if_range = request.headers.get("If-Range")
+        if if_range is not None and if_range.strip('"') != etag:
+            byte_range = None
+
+        if byte_range is None:
+            f = open(path, "rb")
+            response = app.response_class(wrap_file(request.environ, f),
+                                          mimetype=mimetype,
+                                          direct_passthrough=True)
+            response.content_length = stat.st_size
+            return cached(response)
+
+        span = byte_range.range_for_length(stat.st_size)
+        if span is None:
+            response = app.response_class(status=416)
+            response.headers["Content-Range"] = "bytes */%d" % stat.st_size
+            return cached(response)
+
+        # Ranges are rare for images, so the slice is simply read
+        start, stop = span
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(stop - start)
+
+        response = app.response_class(data, status=206, mimetype=mimetype)
+        response.headers["Content-Range"] = "bytes %d-%d/%d" % (
+            start, stop - 1, stat.st_size)
+        return cached(response)
@@ -0,0 +1,489 @@
+import os
+import json
+import time
+import threading
+from math import log
+from random import random
+
+from flask import *
+from flask_restful import Resource
+
+from models.models import (User as db_user, Event as db_event, events_users,
+    ArchivedEvent as db_archived_event, events_users_archive, db)
+from models.queries import get_event
+from api import *
+from api.signals import signups_changed, user_saved
+from api.admission import admission_control
+
+LEADERBOARD_MAX_RESULTS = 100
+"""Max number of leaders returned by a single request."""
+
+LEADERBOARD_CHECK_INTERVAL = 10
+"""Seconds between checks by each worker for a newer leaderboard file.
+
+Each worker only sees its own updates as they happen, so the
+leaderboards are reloaded from the file written by `manage.py
+leaderboards` to pick up everyone else's.
+
+"""
+
+SKIPLIST_LEVELS = 32
+
+
+class _SkipNode(object):
+
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value, levels):
+        self.value = value
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class RankedSet(object):
+
+    """Sorted set with O(log n) insert, remove and rank.
+
+    An indexable skip list: every link records how many entries it
+    skips over, so the position of an entry is the sum of the links
+    followed to reach it.
+
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.head = _SkipNode(None, SKIPLIST_LEVELS)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+
+    def _find(self, value):
+        """Return the last node before value on each level, and their positions."""
+
+        chain = [None] * SKIPLIST_LEVELS
+        steps = [0] * SKIPLIST_LEVELS
+        node = self.head
+        position = 0
+        for level in reversed(range(SKIPLIST_LEVELS)):
+            while node.next[level] is not None and node.next[level].value < value:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            steps[level] = position
+        return chain, steps
+
+    def insert(self, value):
+        chain, steps = self._find(value)
+        position = steps[0]
+
+        levels = min(SKIPLIST_LEVELS, 1 - int(log(1.0 - random(), 2.0)))
+        node = _SkipNode(value, levels)
+
+        for level in range(levels):
+            prev = chain[level]
+            skipped = position - steps[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - skipped
+            prev.width[level] = skipped + 1
+
+        for level in range(levels, SKIPLIST_LEVELS):
+            chain[level].width[level] += 1
+
+        self.size += 1
+
+    def remove(self, value):
+        chain, steps = self._find(value)
+        node = chain[0].next[0]
+        if node is None or node.value != value:
+            raise KeyError(value)
+
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+
+        for level in range(len(node.next), SKIPLIST_LEVELS):
+            chain[level].width[level] -= 1
+
+        self.size -= 1
+
+    def count_before(self, value):
+        """Return the number of entries smaller than value."""
+
+        chain, steps = self._find(value)
+        return steps[0]
+
+
+class Leaderboard(object):
+
+    """Users ranked by volunteer hours, most hours first."""
+
+    def __init__(self):
+        self.entries = RankedSet()
+        self.hours = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, user_id, hours):
+        self.remove(user_id)
+        hours = hours or 0
+        self.entries.insert((-hours, user_id))
+        self.hours[user_id] = hours
+
+    def remove(self, user_id):
+        hours = self.hours.pop(user_id, None)
+        if hours is not None:
+            self.entries.remove((-hours, user_id))
+
+    def top(self, n):
+        """Return the first n (rank, user id, hours) entries."""
+
+        leaders = []
+        rank = 0
+        for i, (hours, user_id) in enumerate(self.entries):
+            if i == n:
+                break
+
+            # Users with the same hours share a rank
+            if i == 0 or -hours != leaders[-1][2]:
+                rank = i + 1
+            leaders.append((rank, user_id, -hours))
+        return leaders
+
+    def rank(self, user_id):
+        """Return the (rank, hours) of a user, or None if not ranked."""
+
+        hours = self.hours.get(user_id)
+        if hours is None:
+            return None
+
+        # User ids start at 1, so this counts everyone with more hours
+        return self.entries.count_before((-hours, 0)) + 1, hours
+
+
+def leaderboard_rows():
+    """Return the users and organization memberships to rank.
+
+    Users are (id, hours, zipcode) and memberships (user id,
+    organization) lists. Sign-ups for archived events count as
+    memberships too, so archiving doesn't take anyone off an
+    organization's leaderboard.
+
+    """
+
+    users = [[user_id, hours, zipcode] for user_id, hours, zipcode
+             in db.session.query(db_user.id, db_user.current_hours,
+                                 db_user.zipcode)]
+
+    live = db.session.query(events_users.c.user_id, db_event.organization) \
+        .join(db_event, db_event.id == events_users.c.event_id) \
+        .filter(db_event.organization != None)
+    archived = db.session.query(events_users_archive.c.user_id,
+                                db_archived_event.organization) \
+        .join(db_archived_event,
+              db_archived_event.id == events_users_archive.c.event_id) \
+        .filter(db_archived_event.organization != None)
+
+    members = [[user_id, organization] for user_id, organization
+               in live.union(archived)]
+
+    return users, members
+
+
+def write_leaderboards(path):
+    """Write the rows the leaderboards are built from to a file.
+
+    The file is replaced atomically. Returns the number of users.
+
+    """
+
+    users, members = leaderboard_rows()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path + ".tmp", "w") as f:
+        json.dump({"users": users, "members": members}, f)
+    os.rename(path + ".tmp", path)
+    return len(users)
+
+
+class Leaderboards(object):
+
+    """The global, per zipcode, per region and per organization leaderboards.
+
+    Regions are the first three digits of the zipcode. Organization
+    leaderboards rank the users who signed up for at least one of the
+    organization's events, including archived ones.
+
+    Each worker builds the leaderboards once, from the file written
+    by `manage.py leaderboards` if there is one and otherwise from
+    the database, then keeps them up to date with its own changes.
+    When a newer file is written, it is loaded in a background
+    thread and swapped in, so requests never wait on a rebuild.
+    Changes a worker made while loading may be missing until the
+    next file.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = None
+        self.loaded = None
+        self.checked = 0
+        self.loading = False
+        self.path = None
+
+    def init_app(self, app):
+        self.path = os.path.join(app.config['SNAPSHOT_DIR'],
+                                 "leaderboards.json")
+        app.extensions['leaderboards'] = self
+
+        user_saved.connect(self.on_user_saved, sender=app)
+        signups_changed.connect(self.on_signups_changed, sender=app)
+
+    def _mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def _read(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        return data["users"], data["members"]
+
+    def _fill(self, users, members):
+        self.boards = {"global": Leaderboard(), "zipcode": {}, "region": {},
+                       "organization": {}}
+        self.zipcodes = {}
+        self.organizations = {}
+
+        for user_id, hours, zipcode in users:
+            self._set_user(user_id, hours, zipcode)
+        for user_id, organization in members:
+            self._join(user_id, organization)
+
+        self.built = time.time()
+
+    def _swap(self, fresh, loaded):
+        self.boards = fresh.boards
+        self.zipcodes = fresh.zipcodes
+        self.organizations = fresh.organizations
+        self.built = fresh.built
+        self.loaded = loaded
+
+    def _reload(self, mtime):
+        try:
+            fresh = Leaderboards()
+            fresh._fill(*self._read())
+            with self.lock:
+                self._swap(fresh, mtime)
+        finally:
+            self.loading = False
+
+    def _ensure_built(self):
+        if self.built is None:
+            mtime = self._mtime()
+            rows = self._read() if mtime is not None else leaderboard_rows()
+            self._fill(*rows)
+            self.loaded = mtime
+            self.checked = time.time()
+            return
+
+        now = time.time()
+        if self.loading or now - self.checked < LEADERBOARD_CHECK_INTERVAL:
+            return
+        self.checked = now
+
+        mtime = self._mtime()
+        if mtime is not None and (self.loaded is None or mtime > self.loaded):
+            self.loading = True
+            thread = threading.Thread(target=self._reload, args=(mtime,))
+            thread.daemon = True
+            thread.start()
+
+    def _board(self, scope, key):
+        return self.boards[scope].setdefault(key, Leaderboard())
+
+    def _set_user(self, user_id, hours, zipcode):
+        self.boards["global"].set(user_id, hours)
+
+        old = self.zipcodes.get(user_id)
+        if old is not None and old != zipcode:
+            self._board("zipcode", old).remove(user_id)
+            self._board("region", region_of(old)).remove(user_id)
+
+        if zipcode is not None:
+            self.zipcodes[user_id] = zipcode
+            self._board("zipcode", zipcode).set(user_id, hours)
+            self._board("region", region_of(zipcode)).set(user_id, hours)
+        else:
+            self.zipcodes.pop(user_id, None)
+
+        for organization in self.organizations.get(user_id, ()):
+            self._board("organization", organization).set(user_id, hours)
+
+    def _join(self, user_id, organization):
+        self.organizations.setdefault(user_id, set()).add(organization)
+        hours = self.boards["global"].hours.get(user_id, 0)
+        self._board("organization", organization).set(user_id, hours)
+
+    def _leave(self, user_id, organization):
+        self.organizations.get(user_id, set()).discard(organization)
+        self._board("organization", organization).remove(user_id)
+
+    def on_user_saved(self, app, user, created):
+        with self.lock:
+            if self.built is not None:
+                self._set_user(user.id, user.current_hours, user.zipcode)
+
+    def on_signups_changed(self, app, event_id, user_ids, delta):
+        with self.lock:
+            if self.built is None:
+                return
+
+            event = get_event(event_id)
+            if event is None or event.organization is None:
+                return
+
+            for user_id in user_ids:
+                user_id = int(user_id)
+                if delta > 0:
+                    self._join(user_id, event.organization)
+                    continue
+
+                # Only leave the organization's board if this was
+                # the user's last event with them, archived or not.
+                remaining = db.session.query(events_users.c.event_id) \
+                    .join(db_event, db_event.id == events_users.c.event_id) \
+                    .filter(events_users.c.user_id == user_id,
+                            db_event.organization == event.organization) \
+                    .first()
+                if remaining is None:
+                    remaining = db.session.query(
+                            events_users_archive.c.event_id) \
+                        .join(db_archived_event, db_archived_event.id ==
+                              events_users_archive.c.event_id) \
+                        .filter(events_users_archive.c.user_id == user_id,
+                                db_archived_event.organization ==
+                                event.organization) \
+                        .first()
+                if remaining is None:
+                    self._leave(user_id, event.organization)
+
+    def top(self, scope, key, n):
+        with self.lock:
+            self._ensure_built()
+            board = self._get(scope, key)
+            return board.top(n) if board is not None else []
+
+    def rank(self, scope, key, user_id):
+        with self.lock:
+            self._ensure_built()
+            board = self._get(scope, key)
+            return board.rank(user_id) if board is not None else None
+
+    def key_for(self, scope, user_id):
+        """Return the zipcode or region of a user."""
+
+        with self.lock:
+            self._ensure_built()
+            zipcode = self.zipcodes.get(user_id)
+            if zipcode is None or scope == "zipcode":
+                return zipcode
+            return region_of(zipcode)
+
+    def _get(self, scope, key):
+        if scope == "global":
+            return self.boards["global"]
+        return self.boards[scope].get(key)
+
+
+def region_of(zipcode):
+    """Return the region of a zipcode, its first three digits."""
+
+    return ("%05d" % int(zipcode))[:3]
+
+
+class LeaderboardList(Resource):
+
+    """Class providing the volunteer hours leaderboards."""
+
+    query_budget = {"get": 5}
+
+    @admission_control("leaderboard")
+    @key_required
+    @auth_required
+    def get(self):
+        """Return the top users and, optionally, a user's rank.
+
+        URL parameters:
+        - scope: global, zipcode, region or organization
+        - key: the zipcode, region or organization to rank within.
+          Defaults to the user's own zipcode or region.
+        - limit: max number of leaders returned
+        - user_id: user whose rank is returned
+
+        """
+
+        leaderboards = current_app.extensions['leaderboards']
+
+        scope = request.values.get("scope", "global")
+        key = request.values.get("key")
+        limit = request.values.get("limit")
+        user_id = request.values.get("user_id")
+
+        if scope not in ("global", "zipcode", "region", "organization"):
+            return get_error_response("Invalid scope.")
+
+        try:
+            limit = min(int(limit), LEADERBOARD_MAX_RESULTS)
+        except (TypeError, ValueError):
+            limit = 10
+
+        try:
+            if user_id is not None:
+                user_id = int(user_id)
+            if scope == "zipcode" and key is not None:
+                key = int(key)
+        except ValueError:
+            return get_error_response("Invalid parameters.")
+
+        if key is None and user_id is not None and \
+           scope in ("zipcode", "region"):
+            key = leaderboards.key_for(scope, user_id)
+
+        if key is None and scope != "global":
+            return get_error_response("Missing key.")
+
+        leaders = leaderboards.top(scope, key, limit)
+
+        # Fetch all of the leaders' names in one query
+        ids = [leader_id for rank, leader_id, hours in leaders]
+        users = db_user.query.filter(db_user.id.in_(ids)).all() if ids else []
+        names = dict((u.id, (u.first_name, u.last_name)) for u in users)
+
+        result = {"leaders": [{
+            "rank": rank,
+            "user_id": leader_id,
+            "first_name": names.get(leader_id, (None, None))[0],
+            "last_name": names.get(leader_id, (None, None))[1],
+            "current_hours": hours
+        } for rank, leader_id, hours in leaders]}
+
+        if user_id is not None:
+            ranked = leaderboards.rank(scope, key, user_id)
+            if ranked is not None:
+                result["me"] = {"rank": ranked[0], "current_hours": ranked[1]}
+
+        return get_success_response(result)
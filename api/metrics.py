@@ -0,0 +1,73 @@
+import os
+import threading
+
+from flask import *
+from flask_restful import Resource
+
+from api import *
+
+
+class Metrics(object):
+
+    """Process wide counters, gauges and timings.
+
+    Every Gunicorn worker keeps its own values, so the numbers
+    reported by /metrics belong to the worker that served it.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Record one sample of a timing, in seconds, or of a count."""
+
+        with self.lock:
+            timing = self.timings.setdefault(name,
+                {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += value
+            timing["max"] = max(timing["max"], value)
+
+    def gauge(self, name, func):
+        """Register a function reporting a current value."""
+
+        self.gauges[name] = func
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.counters)
+            for name, timing in self.timings.items():
+                result[name + ".count"] = timing["count"]
+                result[name + ".max"] = timing["max"]
+                result[name + ".avg"] = timing["total"] / timing["count"]
+
+        for name, func in self.gauges.items():
+            result[name] = func()
+
+        return result
+
+metrics = Metrics()
+
+
+class MetricsReport(Resource):
+
+    """Class to report the metrics of the serving worker."""
+
+    query_budget = {"get": 0}
+
+    @key_required
+    def get(self):
+        """Return all metrics."""
+
+        return get_success_response({
+            "pid": os.getpid(),
+            "metrics": metrics.snapshot()
+        })
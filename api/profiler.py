@@ -0,0 +1,329 @@
+import os
+import sys
+import glob
+import hmac
+import time
+import threading
+from collections import Counter
+from functools import wraps
+
+from flask import *
+from flask_restful import Resource
+
+from api import *
+
+PROFILER_CACHE_KEY = "profiler:armed"
+"""Shared cache key of the profiles armed on this host."""
+
+PROFILER_CHECK_INTERVAL = 1.0
+"""Seconds between checks of the armed profiles by each worker."""
+
+PROFILER_MAX_SECONDS = 3600
+"""Max length of a profile's time window."""
+
+
+def admin_required(f):
+    """Decorator to require the admin key of the profiler.
+
+    The key must be present in the request as a header with a key
+    "profiler_key". Without PROFILER_KEY set, every request fails.
+
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if is_admin(current_app._get_current_object()):
+            return f(*args, **kwargs)
+        else:
+            return get_error_response("Unauthorized.")
+    return decorated_function
+
+
+def is_admin(app):
+    expected = app.config['PROFILER_KEY']
+    key = request.headers.get("profiler_key")
+    if expected is None or key is None:
+        return False
+    return hmac.compare_digest(key.encode("utf-8"), expected.encode("utf-8"))
+
+
+def collapse(frame):
+    """Return a frame's stack as a line of collapsed stack output."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler(object):
+
+    """Sampling profiler of live requests, armed on demand.
+
+    An admin arms a profile of a route, identified by its endpoint,
+    for the next N requests or for a time window, with /profiler.
+    Profiles are armed in the shared cache, so they apply to every
+    worker on the host. While a profiled request runs, a sampler
+    thread records the stack of the thread serving it every
+    PROFILER_INTERVAL seconds. Each worker writes its samples to
+    PROFILER_DIR/<endpoint>.<pid>.folded in the collapsed stack
+    format read by flamegraph.pl.
+
+    A single request can also be profiled by sending the admin key
+    in a "profile" header.
+
+    When nothing is armed, a request only costs a check of the
+    time, as workers look at the armed profiles once a second.
+    Samples are taken of OS threads, so requests served by gevent
+    workers aren't sampled.
+
+    """
+
+    def __init__(self):
+        self.armed = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.active = {}
+        self.samples = {}
+        self.started = {}
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['PROFILER_INTERVAL']
+        self.directory = app.config['PROFILER_DIR']
+        app.extensions['profiler'] = self
+
+        app.before_request(self.start_request)
+        app.teardown_request(self.end_request)
+
+    def arm(self, endpoint, requests=None, seconds=None):
+        """Profile the next requests to an endpoint on this host.
+
+        The profile stops after the given number of requests or
+        seconds, whichever comes first. Samples of any earlier
+        profile of the endpoint are discarded.
+
+        """
+
+        cache = self.app.extensions['cache']
+        now = time.time()
+
+        for path in glob.glob(self._path(endpoint, "*")):
+            os.remove(path)
+
+        armed = cache.get(PROFILER_CACHE_KEY) or {}
+        armed[endpoint] = {
+            "started": now,
+            "until": now + min(seconds or PROFILER_MAX_SECONDS,
+                               PROFILER_MAX_SECONDS),
+            "remaining": requests
+        }
+        cache.set(PROFILER_CACHE_KEY, armed, PROFILER_MAX_SECONDS)
+        self.checked = 0
+
+        return armed[endpoint]
+
+    def disarm(self, endpoint):
+        cache = self.app.extensions['cache']
+        armed = cache.get(PROFILER_CACHE_KEY) or {}
+        armed.pop(endpoint, None)
+        cache.set(PROFILER_CACHE_KEY, armed, PROFILER_MAX_SECONDS)
+        self.checked = 0
+
+    def _path(self, endpoint, pid):
+        return os.path.join(self.directory, "%s.%s.folded" % (endpoint, pid))
+
+    def _take(self, endpoint):
+        """Count a request against an armed profile.
+
+        Returns the time the profile was armed at, or None if the
+        request isn't to be profiled. Workers read and write the
+        count without a lock between them, so a profile may take a
+        few more requests than asked when they race.
+
+        """
+
+        cache = self.app.extensions['cache']
+        armed = cache.get(PROFILER_CACHE_KEY) or {}
+        profile = armed.get(endpoint)
+        if profile is None:
+            return None
+
+        if profile["until"] < time.time() or profile["remaining"] == 0:
+            self.disarm(endpoint)
+            return None
+
+        if profile["remaining"] is not None:
+            profile["remaining"] -= 1
+            cache.set(PROFILER_CACHE_KEY, armed, PROFILER_MAX_SECONDS)
+
+        return profile["started"]
+
+    def start_request(self):
+        now = time.time()
+        if now - self.checked > PROFILER_CHECK_INTERVAL:
+            self.armed = self.app.extensions['cache'].get(
+                PROFILER_CACHE_KEY) or {}
+            self.checked = now
+
+        endpoint = str(request.endpoint)
+        started = None
+        if endpoint in self.armed:
+            started = self._take(endpoint)
+        if started is None and request.headers.get("profile") is not None \
+           and is_admin(self.app):
+            started = self.started.get(endpoint, now)
+        if started is None:
+            return
+
+        with self.lock:
+            # Samples of an earlier profile of the endpoint are dropped
+            if self.started.get(endpoint) != started:
+                self.started[endpoint] = started
+                self.samples[endpoint] = Counter()
+            self.active[threading.current_thread().ident] = endpoint
+
+        g.profiled = True
+        self._ensure_sampler()
+        self.wakeup.set()
+
+    def end_request(self, exc=None):
+        if not getattr(g, "profiled", False):
+            return
+
+        endpoint = str(request.endpoint)
+        with self.lock:
+            self.active.pop(threading.current_thread().ident, None)
+            lines = ["%s %d" % (stack, count) for stack, count
+                     in self.samples.get(endpoint, {}).items()]
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Rewritten whole, so the file always holds one profile
+        path = self._path(endpoint, os.getpid())
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(sorted(lines)) + "\n")
+        os.rename(path + ".tmp", path)
+
+    def _ensure_sampler(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self.thread is None or self.thread_pid != os.getpid():
+            with self.lock:
+                if self.thread is None or self.thread_pid != os.getpid():
+                    self.thread = threading.Thread(target=self._sample_loop)
+                    self.thread.daemon = True
+                    self.thread_pid = os.getpid()
+                    self.thread.start()
+
+    def _sample_loop(self):
+        while True:
+            with self.lock:
+                active = dict(self.active)
+            if len(active) == 0:
+                self.wakeup.clear()
+                self.wakeup.wait()
+                continue
+
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, endpoint in active.items():
+                    frame = frames.get(ident)
+                    if frame is not None and endpoint in self.samples:
+                        self.samples[endpoint][collapse(frame)] += 1
+
+            del frames
+            time.sleep(self.interval)
+
+    def profile(self, endpoint):
+        """Return the samples of an endpoint from every worker, merged."""
+
+        merged = Counter()
+        for path in glob.glob(self._path(endpoint, "*")):
+            with open(path) as f:
+                for line in f:
+                    stack, sep, count = line.rstrip("\n").rpartition(" ")
+                    if sep:
+                        merged[stack] += int(count)
+        return merged
+
+
+class ProfilerControl(Resource):
+
+    """Class to arm the profiler and fetch its flame graphs."""
+
+    query_budget = {"get": 0, "post": 0, "delete": 0}
+
+    @key_required
+    @admin_required
+    def get(self):
+        """Return the collapsed stacks sampled for an endpoint.
+
+        URL parameters:
+        - endpoint: name of the route's endpoint, such as eventlist
+
+        The output can be fed to flamegraph.pl as is.
+
+        """
+
+        endpoint = request.values.get("endpoint")
+        if endpoint is None:
+            return get_error_response("Missing endpoint.")
+
+        profiler = current_app.extensions['profiler']
+        lines = ["%s %d" % item
+                 for item in sorted(profiler.profile(endpoint).items())]
+        return current_app.response_class("\n".join(lines) + "\n",
+                                          mimetype="text/plain")
+
+    @key_required
+    @admin_required
+    def post(self):
+        """Arm a profile of a route on this host.
+
+        Post body parameters:
+        - endpoint: name of the route's endpoint, such as eventlist
+        - requests: number of requests to profile
+        - seconds: length of the time window to profile for
+
+        """
+
+        req_json = request.get_json(silent=True) or {}
+        endpoint = req_json.get("endpoint")
+        if endpoint not in current_app.view_functions:
+            return get_error_response("Unknown endpoint.")
+
+        try:
+            requests = req_json.get("requests")
+            requests = int(requests) if requests is not None else None
+            seconds = req_json.get("seconds")
+            seconds = float(seconds) if seconds is not None else None
+        except (TypeError, ValueError):
+            return get_error_response("Invalid profile length.")
+
+        profile = current_app.extensions['profiler'].arm(endpoint, requests,
+                                                         seconds)
+        return get_success_response({"profile": profile})
+
+    @key_required
+    @admin_required
+    def delete(self):
+        """Stop profiling a route.
+
+        URL parameters:
+        - endpoint: name of the route's endpoint
+
+        """
+
+        endpoint = request.values.get("endpoint")
+        if endpoint is None:
+            return get_error_response("Missing endpoint.")
+
+        current_app.extensions['profiler'].disarm(endpoint)
+        return get_success_response()
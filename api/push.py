@@ -0,0 +1,291 @@
+import os
+import json
+import errno
+import socket
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from flask import *
+from flask.ext.mysqldb import MySQLdb
+from flask_restful import Resource
+
+from api import *
+from api.signals import event_saved, event_deleted, signups_changed
+from api.admission import admission_control
+
+PUSH_QUEUE_SIZE = 100
+"""Max number of undelivered messages buffered per subscriber.
+
+Messages for a subscriber that falls further behind are dropped.
+Clients can always recover by fetching the event.
+
+"""
+
+PUSH_KEEPALIVE = 15
+"""Seconds between keepalive comments on an idle stream."""
+
+PUSH_MAX_EVENTS = 50
+"""Max number of events a single stream can subscribe to."""
+
+
+class Broker(object):
+
+    """Interface for sharing event changes between worker processes.
+
+    Every worker publishes the changes it makes through the broker,
+    and the broker hands every published message, including the
+    worker's own, to the callbacks registered with listen.
+
+    """
+
+    def publish(self, event_id, message):
+        raise NotImplementedError
+
+    def listen(self, callback):
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+
+    """In-memory broker that only reaches the current process.
+
+    Suitable for tests and for running a single worker.
+
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def publish(self, event_id, message):
+        for callback in self.callbacks:
+            callback(event_id, message)
+
+    def listen(self, callback):
+        self.callbacks.append(callback)
+
+
+class UnixSocketBroker(Broker):
+
+    """Broker for workers sharing a host, using unix datagram sockets.
+
+    Each worker binds a socket named after its pid in socket_dir and
+    publishing sends the message to every socket in that directory.
+    Sockets left behind by dead workers are removed on first failure.
+
+    Sends never block the request publishing: a message for a worker
+    whose socket buffer is full is dropped, like messages for a
+    stream whose queue is full.
+
+    """
+
+    def __init__(self, socket_dir):
+        self.socket_dir = socket_dir
+        self.callbacks = []
+        self.sock = None
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def _bind(self):
+        if not os.path.isdir(self.socket_dir):
+            os.makedirs(self.socket_dir)
+
+        path = os.path.join(self.socket_dir, "%d.sock" % os.getpid())
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+        thread = threading.Thread(target=self._receive)
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self):
+        while True:
+            data = self.sock.recv(65536)
+            try:
+                event_id, message = json.loads(data.decode("utf-8"))
+            except ValueError:
+                continue
+            for callback in self.callbacks:
+                callback(event_id, message)
+
+    def publish(self, event_id, message):
+        if not os.path.isdir(self.socket_dir):
+            return
+
+        data = json.dumps([event_id, message]).encode("utf-8")
+
+        for name in os.listdir(self.socket_dir):
+            path = os.path.join(self.socket_dir, name)
+            try:
+                self.sender.sendto(data, path)
+            except socket.error as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    # The worker is busy or the message too large,
+                    # only this message is lost
+                    continue
+
+                # The worker that owned this socket is gone
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def listen(self, callback):
+        # Bind lazily so that each forked worker gets its own socket
+        if self.sock is None:
+            self._bind()
+        self.callbacks.append(callback)
+
+
+class PushHub(object):
+
+    """Fans out event changes to the streams subscribed to them.
+
+    Changes are published through the broker so that streams held
+    by other workers receive them too.
+
+    """
+
+    def __init__(self, broker=None):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.broker = broker
+        self.listening = False
+
+    def init_app(self, app):
+        if self.broker is None:
+            if app.config.get('PUSH_BROKER') == 'unix':
+                self.broker = UnixSocketBroker(app.config['PUSH_SOCKET_DIR'])
+            else:
+                self.broker = LocalBroker()
+
+        app.extensions['push'] = self
+
+        event_saved.connect(self.on_event_saved, sender=app)
+        event_deleted.connect(self.on_event_deleted, sender=app)
+        signups_changed.connect(self.on_signups_changed, sender=app)
+
+    def subscribe(self, event_ids):
+        """Return a queue receiving changes to the given events."""
+
+        q = queue.Queue(maxsize=PUSH_QUEUE_SIZE)
+        with self.lock:
+            # Start listening on first use so that each forked
+            # worker registers with the broker itself
+            if not self.listening:
+                self.broker.listen(self.dispatch)
+                self.listening = True
+
+            for event_id in event_ids:
+                self.subscribers.setdefault(str(event_id), set()).add(q)
+        return q
+
+    def unsubscribe(self, q, event_ids):
+        with self.lock:
+            for event_id in event_ids:
+                queues = self.subscribers.get(str(event_id))
+                if queues is not None:
+                    queues.discard(q)
+                    if len(queues) == 0:
+                        del self.subscribers[str(event_id)]
+
+    def publish(self, event_id, message):
+        self.broker.publish(str(event_id), message)
+
+    def dispatch(self, event_id, message):
+        """Deliver a published message to local subscribers."""
+
+        with self.lock:
+            queues = list(self.subscribers.get(str(event_id), ()))
+
+        for q in queues:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+
+    def on_event_saved(self, app, event, created, previous=None):
+        if not created:
+            self.publish(event.id, {"type": "event", "event": event.serialize})
+
+    def on_event_deleted(self, app, event_id, event):
+        self.publish(event_id, {"type": "deleted", "event_id": int(event_id)})
+
+    def on_signups_changed(self, app, event_id, user_ids, delta):
+        cur = app.mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+        cur.execute("SELECT current_num_volunteers, max_volunteers_needed \
+                    FROM event WHERE id=%s", (event_id,))
+        row = cur.fetchone()
+
+        if row is not None:
+            self.publish(event_id, {
+                "type": "volunteers",
+                "event_id": int(event_id),
+                "current_num_volunteers": row["current_num_volunteers"],
+                "max_volunteers_needed": row["max_volunteers_needed"]
+            })
+
+
+class EventStream(Resource):
+
+    """Class providing a Server-Sent Events stream of event changes.
+
+    Each open stream holds a worker for as long as the client stays
+    connected, so this route should be served by cooperative workers.
+
+    """
+
+    query_budget = {"get": 0}
+
+    @admission_control("event_stream")
+    @key_required
+    @auth_required
+    def get(self):
+        """Stream changes to the given events.
+
+        URL parameters:
+        - ids: comma separated list of event ids to subscribe to
+
+        """
+
+        app = current_app._get_current_object()
+        hub = app.extensions['push']
+
+        ids = request.values.get("ids", "")
+        try:
+            event_ids = [int(i) for i in ids.split(",") if len(i) > 0]
+        except ValueError:
+            return get_error_response("Invalid event ids.")
+
+        if len(event_ids) == 0 or len(event_ids) > PUSH_MAX_EVENTS:
+            return get_error_response("Invalid event ids.")
+
+        def stream():
+            # Subscribed once the response is consumed, so that a
+            # stream never sent doesn't leave its queue behind
+            q = hub.subscribe(event_ids)
+            try:
+                yield "retry: 5000\n\n"
+                while True:
+                    try:
+                        message = q.get(timeout=PUSH_KEEPALIVE)
+                    except queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+                    yield "event: %s\ndata: %s\n\n" % (message["type"],
+                                                       json.dumps(message))
+            finally:
+                hub.unsubscribe(q, event_ids)
+
+        response = Response(stream(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+
+        # Keep Nginx from buffering the stream
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
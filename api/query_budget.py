@@ -0,0 +1,188 @@
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request, current_app, has_request_context
+from flask.ext.mysqldb import MySQL
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from api import get_error_response
+from api.metrics import metrics
+
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def query_shape(statement):
+    """Return a statement with whitespace and IN lists normalized.
+
+    Two statements with the same shape differ only in their
+    parameters, such as the same lazy load for different rows.
+
+    """
+
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    return _PLACEHOLDER_LIST.sub("(...)", statement)
+
+
+def record_query(statement):
+    """Count a statement against the current request, if any."""
+
+    if has_request_context():
+        log = getattr(g, "query_log", None)
+        if log is None:
+            return
+
+        scope = getattr(g, "query_scope", None)
+        if scope is None:
+            log.append(statement)
+        else:
+            g.scoped_queries[scope] += 1
+
+
+@contextmanager
+def counted_as(scope):
+    """Count the statements run in the block apart from the route's.
+
+    They are reported as queries.<endpoint>.<scope> instead of being
+    checked against the route's budget, which the route can't keep
+    for code it doesn't own, such as signal receivers.
+
+    """
+
+    if not has_request_context() or getattr(g, "query_log", None) is None:
+        yield
+        return
+
+    previous = getattr(g, "query_scope", None)
+    g.query_scope = scope
+    try:
+        yield
+    finally:
+        g.query_scope = previous
+
+
+def on_before_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+    record_query(statement)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, args=None):
+        record_query(query)
+        return self._cursor.execute(query, args)
+
+    def executemany(self, query, args):
+        record_query(query)
+        return self._cursor.executemany(query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingMySQL(MySQL):
+
+    """Flask-MySQLdb extension whose cursors count their statements.
+
+    The raw queries made through app.mysql are counted against the
+    request budgets along with the ones made by SQLAlchemy.
+
+    """
+
+    @property
+    def connect(self):
+        return _CountingConnection(MySQL.connect.fget(self))
+
+
+def start_request():
+    g.query_log = []
+    g.query_scope = None
+    g.scoped_queries = Counter()
+
+
+def check_request(response):
+    """Check the statements of a request against its route's budget.
+
+    Budgets are declared on each Resource as a query_budget dict
+    mapping the method name to the max number of statements. A
+    request also fails the check if it issues the same SELECT more
+    than QUERY_REPEAT_LIMIT times, which usually means a lazy load
+    in a loop. Statements counted_as another scope, such as those
+    of signal receivers, are only reported.
+
+    Failures are logged. In strict mode the response is replaced by
+    a 500 error instead, so that the after_request functions still
+    run and tests see which budget was exceeded.
+
+    """
+
+    log = getattr(g, "query_log", None)
+    if log is None:
+        return response
+
+    app = current_app._get_current_object()
+    endpoint = str(request.endpoint)
+    metrics.observe("queries." + endpoint, len(log))
+    for scope, count in g.scoped_queries.items():
+        metrics.observe("queries.%s.%s" % (endpoint, scope), count)
+
+    view = app.view_functions.get(request.endpoint)
+    budgets = getattr(getattr(view, "view_class", None), "query_budget", {})
+    budget = budgets.get(request.method.lower())
+
+    problems = []
+    if budget is not None and len(log) > budget:
+        problems.append("%d queries, budget is %d" % (len(log), budget))
+
+    shapes = Counter(query_shape(statement) for statement in log
+                     if statement.lstrip()[:6].upper() == "SELECT")
+    for shape, count in shapes.items():
+        if count > app.config['QUERY_REPEAT_LIMIT']:
+            problems.append("%d times: %s" % (count, shape))
+
+    if app.config['QUERY_BUDGET_STRICT']:
+        response.headers["X-Query-Count"] = str(len(log))
+
+    if len(problems) > 0:
+        metrics.increment("query_budget.exceeded")
+        message = "%s %s: %s" % (request.method, request.path,
+                                 "; ".join(problems))
+        if app.config['QUERY_BUDGET_STRICT']:
+            failed = get_error_response("Query budget exceeded by " + message)
+            failed.status_code = 500
+            failed.headers["X-Query-Count"] = str(len(log))
+            return failed
+        app.logger.warning("Query budget exceeded by %s", message)
+
+    return response
+
+
+def init_app(app):
+    """Count the SQL statements of every request and check the budgets."""
+
+    if not event.contains(Engine, "before_cursor_execute",
+                          on_before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", on_before_cursor_execute)
+
+    app.before_request(start_request)
+    app.after_request(check_request)
@@ -0,0 +1,135 @@
+import heapq
+from math import exp
+from datetime import datetime
+
+RANKING_WEIGHTS = {
+    "text": 1.0,
+    "distance": 0.5,
+    "date": 0.25,
+    "capacity": 0.25
+}
+"""Default weight of each part of an event's score."""
+
+SECONDS_PER_DAY = 86400.0
+
+
+class Ranker(object):
+
+    """Scores event search hits on relevance, distance, date and capacity.
+
+    Each part of the score is between 0 and 1 before weighting:
+
+    - text: the Whoosh BM25 score s, saturated as s / (s + k), so
+      that a much better text match can't drown out the rest
+    - distance: exp(-miles / distance_scale), for searches near
+      a location only
+    - date: exp(-days / date_scale) for the days until the event
+      starts, and 0 for events that already started
+    - capacity: the fraction of volunteer slots still open, 1 for
+      events without a maximum
+
+    Since every part but the text one is at most its weight, hits
+    that come in order of decreasing BM25 score can be dropped as
+    soon as bound() of their score can't beat the current top k.
+
+    """
+
+    def __init__(self, weights=None, distance_scale=10.0, date_scale=14.0,
+                 text_saturation=5.0, located=False, now=None):
+        self.weights = dict(RANKING_WEIGHTS)
+        self.weights.update(weights or {})
+        self.distance_scale = float(distance_scale)
+        self.date_scale = float(date_scale)
+        self.text_saturation = float(text_saturation)
+        self.located = located
+        self.now = now or datetime.now()
+
+        # The most the parts other than text can add to a score
+        self.rest = self.weights["date"] + self.weights["capacity"]
+        if located:
+            self.rest += self.weights["distance"]
+
+    @classmethod
+    def from_config(cls, config, located=False):
+        """Return a Ranker with the RANKING_* settings of the app."""
+
+        return cls(config['RANKING_WEIGHTS'],
+                   config['RANKING_DISTANCE_SCALE'],
+                   config['RANKING_DATE_SCALE'],
+                   config['RANKING_TEXT_SATURATION'],
+                   located)
+
+    def text(self, score):
+        return self.weights["text"] * score / (score + self.text_saturation)
+
+    def bound(self, score):
+        """Return the best score possible for a hit of this BM25 score."""
+
+        return self.text(score) + self.rest
+
+    def score(self, score, dist, fields):
+        """Return the score of a hit.
+
+        fields are the hit's stored fields: start_date,
+        max_volunteers_needed and current_num_volunteers, any of
+        which may be missing.
+
+        """
+
+        total = self.text(score)
+
+        if self.located and dist is not None:
+            total += self.weights["distance"] * \
+                exp(-dist / self.distance_scale)
+
+        start_date = fields.get("start_date")
+        if start_date is not None and start_date >= self.now:
+            days = (start_date - self.now).total_seconds() / SECONDS_PER_DAY
+            total += self.weights["date"] * exp(-days / self.date_scale)
+
+        needed = fields.get("max_volunteers_needed")
+        if not needed:
+            total += self.weights["capacity"]
+        else:
+            taken = fields.get("current_num_volunteers") or 0
+            total += self.weights["capacity"] * \
+                min(max(needed - taken, 0) / float(needed), 1.0)
+
+        return total
+
+
+class TopK(object):
+
+    """The k best scored items seen, kept in a min heap.
+
+    k must be at least 1. With k None, every item is kept.
+
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.pushed = 0
+
+    def full(self):
+        return self.k is not None and len(self.heap) >= self.k
+
+    def threshold(self):
+        """Return the score an item must beat to get in, or None."""
+
+        return self.heap[0][0] if self.full() else None
+
+    def push(self, score, item):
+        # Among equal scores the item pushed last is evicted first
+        self.pushed += 1
+        entry = (score, -self.pushed, item)
+        if not self.full():
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        """Return the items kept, best first."""
+
+        return [item for score, order, item in
+                sorted(self.heap, key=lambda e: (-e[0], -e[1]))]
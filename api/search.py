@@ -0,0 +1,125 @@
+import os
+
+from api.signals import event_saved, event_deleted, signups_changed
+from jobs import enqueue
+
+MILES_PER_DEGREE = 69.0
+"""Approximate length of one degree of latitude, in miles."""
+
+RANKING_FIELDS = ("start_date", "max_volunteers_needed",
+                  "current_num_volunteers")
+"""Event columns stored in the index for ranking hits."""
+
+RANKING_FETCH_FACTOR = 4
+"""Hits fetched from an index at a time per result wanted, when ranking."""
+
+
+class SearchBackend(object):
+
+    """Full text index of events.
+
+    Backends index the text fields they are given, plus each
+    event's coordinates and RANKING_FIELDS, and return hits as
+    (event id, score, distance) tuples, best score first. The
+    backend used for events is chosen by SEARCH_BACKEND, see
+    create_search_index.
+
+    Once init_app is called, the index follows event changes
+    through the job workers, as index writes are slow.
+
+    """
+
+    def init_app(self, app):
+        app.extensions['search'] = self
+
+        event_saved.connect(self.on_event_saved, sender=app)
+        event_deleted.connect(self.on_event_deleted, sender=app)
+        signups_changed.connect(self.on_signups_changed, sender=app)
+
+    def on_event_saved(self, app, event, created, previous=None):
+        enqueue("index_event", event.id, previous)
+
+    def on_event_deleted(self, app, event_id, event):
+        if event["lat"] is not None and event["lon"] is not None:
+            enqueue("unindex_event", int(event_id), event["lat"], event["lon"])
+
+    # The number of volunteers is stored for ranking
+    def on_signups_changed(self, app, event_id, user_ids, delta):
+        enqueue("index_event", int(event_id))
+
+    def add(self, event, previous=None):
+        """Index an event.
+
+        If the event was indexed before at other coordinates, pass
+        them as previous.
+
+        """
+
+        raise NotImplementedError
+
+    def add_many(self, events):
+        """Index many events at once."""
+
+        raise NotImplementedError
+
+    def remove(self, event_id, lat, lon):
+        """Remove an event indexed at the given coordinates."""
+
+        raise NotImplementedError
+
+    def remove_many(self, locations):
+        """Remove many events, given as (event id, lat, lon) tuples."""
+
+        raise NotImplementedError
+
+    def rebuild(self, events):
+        """Replace the whole index with the given events.
+
+        Returns the number of events indexed.
+
+        """
+
+        raise NotImplementedError
+
+    def search(self, query, limit=None, lat=None, lon=None, radius=None,
+               ranker=None):
+        """Search for events matching a text query.
+
+        If lat, lon and radius (in miles) are given, only events
+        within radius are returned. At most limit hits are returned,
+        none if limit is below 1. Returns a list of (event id,
+        score, distance) tuples, best score first and nearest first
+        among equal scores. Distance is None for searches without a
+        location.
+
+        Hits are scored by text relevance alone, unless a Ranker
+        from api/ranking.py is given to score them.
+
+        """
+
+        raise NotImplementedError
+
+
+def create_search_index(app, name, fields):
+    """Return the SEARCH_BACKEND index called name, under WHOOSH_BASE.
+
+    SEARCH_BACKEND is either "whoosh", for the index sharded by
+    location in api/shards.py, or "fts5", for the SQLite index in
+    api/fts.py.
+
+    """
+
+    # The backends import this module, so they are imported here
+    from api.shards import ShardedIndex
+    from api.fts import Fts5Index
+
+    backend = app.config['SEARCH_BACKEND']
+    path = os.path.join(app.config['WHOOSH_BASE'], name)
+
+    if backend == "whoosh":
+        return ShardedIndex(path, fields, app.config['SEARCH_SHARD_PRECISION'],
+                            app.config['SEARCH_THREADS'])
+    if backend == "fts5":
+        return Fts5Index(path + ".sqlite3", fields)
+
+    raise ValueError("Unknown SEARCH_BACKEND: %s" % backend)
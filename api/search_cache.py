@@ -0,0 +1,127 @@
+import re
+import time
+
+from api.metrics import metrics
+from api.signals import event_saved, event_deleted, signups_changed
+
+SEARCH_CACHE_TTL = 60
+"""Seconds a search's results are cached for.
+
+Results also change as time passes, since the ranking favors
+events starting soon, so they aren't kept for long even if no
+event changes.
+
+"""
+
+GENERATION_KEY = "search:generation"
+
+GENERATION_TTL = 86400 * 365
+
+SEARCH_SHAPES = ("query", "location", "query+location")
+"""Kinds of searches, by the parameters given, that hit rates are kept for."""
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def search_shape(params):
+    query, zip, radius, limit = params
+    if query is not None and zip is not None:
+        return "query+location"
+    if query is not None:
+        return "query"
+    return "location"
+
+
+class SearchCache(object):
+
+    """Cache of the ranked event ids returned by event searches.
+
+    Searches are keyed on their normalized parameters, and the
+    lists of ids are kept in the shared cache, which evicts the
+    least recently used. Every key includes a generation, which is
+    changed whenever an event or its sign-ups change and whenever
+    the search index is updated, so all earlier results are dropped
+    at once.
+
+    """
+
+    def init_app(self, app):
+        self.cache = app.extensions['cache']
+        app.extensions['search_cache'] = self
+
+        event_saved.connect(self.on_change, sender=app)
+        event_deleted.connect(self.on_change, sender=app)
+        signups_changed.connect(self.on_change, sender=app)
+
+        metrics.gauge("search_cache.hit_rate", self.hit_rates)
+
+    def on_change(self, app, **kwargs):
+        self.bump()
+
+    def bump(self):
+        """Drop every cached search."""
+
+        # A new value rather than an increment, so that workers
+        # racing to bump, or the entry being evicted, can't bring
+        # back an older generation.
+        generation = "%x" % int(time.time() * 1000000)
+        self.cache.set(GENERATION_KEY, generation, GENERATION_TTL)
+        return generation
+
+    def generation(self):
+        generation = self.cache.get(GENERATION_KEY)
+        if generation is None:
+            generation = self.bump()
+        return generation
+
+    def normalize(self, query, zip, radius, limit):
+        """Return the parameters of a search in a canonical form.
+
+        Pass zip and radius as ints, or None for a search without
+        a location. Only whitespace is collapsed in the query, as
+        case matters to the query parsers, which take AND, OR and
+        NOT as operators only in capitals.
+
+        """
+
+        if query is not None:
+            query = _WHITESPACE.sub(" ", query).strip()
+        return (query, zip, radius, limit)
+
+    def key(self, params):
+        """Return the key a search's results are cached under.
+
+        Take the key once, before searching, and pass it to both get
+        and set. If an event changes during the search, the results
+        are then stored under the generation that was just dropped,
+        rather than served as current.
+
+        """
+
+        query, zip, radius, limit = params
+        return "search:%s:%s:%s:%s:%s" % (self.generation(), zip, radius,
+                                          limit, query)
+
+    def get(self, key, params):
+        """Return the ids cached under key for a search, or None."""
+
+        event_ids = self.cache.get(key)
+        shape = search_shape(params)
+        if event_ids is None:
+            metrics.increment("search_cache.%s.miss" % shape)
+        else:
+            metrics.increment("search_cache.%s.hit" % shape)
+        return event_ids
+
+    def set(self, key, event_ids):
+        self.cache.set(key, event_ids, SEARCH_CACHE_TTL)
+
+    def hit_rates(self):
+        counters = metrics.counters
+        rates = {}
+        for shape in SEARCH_SHAPES:
+            hits = counters.get("search_cache.%s.hit" % shape, 0)
+            misses = counters.get("search_cache.%s.miss" % shape, 0)
+            if hits + misses > 0:
+                rates[shape] = float(hits) / (hits + misses)
+        return rates
@@ -0,0 +1,462 @@
+import os
+import time
+import shutil
+import heapq
+import threading
+from math import cos, radians
+from multiprocessing.pool import ThreadPool
+
+from six import text_type
+from whoosh import index, collectors
+from whoosh.fields import Schema, ID, TEXT, STORED
+from whoosh.qparser import MultifieldParser
+from whoosh.scoring import BM25F, BM25FScorer, WeightScorer
+from whoosh.writing import AsyncWriter
+
+from api import calculate_equirectangular_distance
+from api import geohash
+from api.ranking import TopK
+from api.search import (SearchBackend, MILES_PER_DEGREE, RANKING_FIELDS,
+    RANKING_FETCH_FACTOR)
+
+GLOBAL_INDEX = "global"
+"""Name of the index of every event, kept next to the shards."""
+
+SHARDS_DIR = "shards"
+
+CURRENT_FILE = "CURRENT"
+"""File in the base directory naming the generation of the index in use."""
+
+DEFAULT_GENERATION = "live"
+"""Generation used until the index is first rebuilt."""
+
+GENERATION_CHECK_INTERVAL = 1.0
+"""Seconds between checks by each worker for a rebuilt index."""
+
+
+def _top_hits(searcher, q, limit):
+    """Return the limit best hits for a query, or every hit if limit is None.
+
+    Whoosh's collector replaces the query's matchers as it goes, to
+    skip documents that can't make the top, but the replacements
+    drop hits of queries joining several terms. Block quality alone
+    keeps them, so the collector is told not to replace matchers.
+
+    """
+
+    if limit is None:
+        return searcher.search(q, limit=None)
+
+    collector = collectors.TopCollector(limit, replace=0)
+    searcher.search_with_collector(q, collector)
+    return collector.results()
+
+
+class SharedStatsScorer(BM25FScorer):
+
+    """BM25F scorer of a shard using the term statistics of another index."""
+
+    def __init__(self, searcher, stats, fieldname, text, B, K1, qf=1):
+        self.idf = stats.idf(fieldname, text)
+        self.avgfl = stats.avg_field_length(fieldname) or 1
+
+        self.B = B
+        self.K1 = K1
+        self.qf = qf
+        self.setup(searcher, fieldname, text)
+
+
+class SharedStatsBM25F(BM25F):
+
+    """BM25F weighting taking term statistics from the global index.
+
+    Each shard's own statistics depend on what happens to be near,
+    so the same document would score differently in each shard.
+    With the statistics of the global index, scores of hits from
+    different shards can be compared.
+
+    """
+
+    def __init__(self, stats, **kwargs):
+        BM25F.__init__(self, **kwargs)
+        self.stats = stats
+
+    def scorer(self, searcher, fieldname, text, qf=1):
+        if not searcher.schema[fieldname].scorable:
+            return WeightScorer.for_(searcher, fieldname, text)
+
+        B = self._field_B.get(fieldname, self.B)
+        return SharedStatsScorer(searcher, self.stats, fieldname, text, B,
+                                 self.K1, qf=qf)
+
+
+class ShardedIndex(SearchBackend):
+
+    """Whoosh full text index of events, partitioned by location.
+
+    Each event is stored in the shard for the geohash cell of its
+    coordinates, and in a global index of every event. A search
+    near a location only consults the shards overlapping the search
+    radius, running them in parallel on a thread pool and merging
+    their hits, scored with the term statistics of the global index.
+    Searches without a location consult the global index alone.
+
+    Rebuilds write a new generation of the index in its own
+    directory and then switch to it by rewriting CURRENT_FILE, so
+    searches never see a partial index. Workers notice within
+    GENERATION_CHECK_INTERVAL seconds, and the generation before
+    is only removed by the next rebuild, so workers still reading
+    it aren't cut off. Changes indexed while a rebuild runs may be
+    missed by the new generation, until the events change again.
+
+    """
+
+    def __init__(self, base_dir, fields, precision=3, threads=4):
+        self.base_dir = base_dir
+        self.fields = fields
+        self.precision = precision
+        self.threads = threads
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.generation = None
+        self.checked = 0
+
+        schema_fields = dict((f, TEXT) for f in fields)
+        schema_fields["id"] = ID(stored=True, unique=True)
+        schema_fields["lat"] = STORED
+        schema_fields["lon"] = STORED
+        for f in RANKING_FIELDS:
+            schema_fields[f] = STORED
+        self.schema = Schema(**schema_fields)
+
+    def shard_for(self, lat, lon):
+        return geohash.encode(float(lat), float(lon), self.precision)
+
+    def _current_generation(self):
+        try:
+            with open(os.path.join(self.base_dir, CURRENT_FILE)) as f:
+                return f.read().strip()
+        except IOError:
+            return DEFAULT_GENERATION
+
+    def _generation_dir(self):
+        now = time.time()
+        if now - self.checked > GENERATION_CHECK_INTERVAL:
+            generation = self._current_generation()
+            with self.lock:
+                if generation != self.generation:
+                    self.generation = generation
+                    self.indexes = {}
+            self.checked = now
+
+        return os.path.join(self.base_dir, self.generation)
+
+    def shards(self):
+        """Return the names of all existing shards."""
+
+        path = os.path.join(self._generation_dir(), SHARDS_DIR)
+        if not os.path.isdir(path):
+            return []
+        return os.listdir(path)
+
+    def _open(self, name, create=False):
+        """Open the global index, or the shard of a geohash cell."""
+
+        if name != GLOBAL_INDEX:
+            name = os.path.join(SHARDS_DIR, name)
+        path = os.path.join(self._generation_dir(), name)
+
+        with self.lock:
+            ix = self.indexes.get(path)
+            if ix is not None:
+                return ix
+
+            if index.exists_in(path):
+                ix = index.open_dir(path)
+            elif create:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                ix = index.create_in(path, self.schema)
+            else:
+                return None
+
+            self.indexes[path] = ix
+            return ix
+
+    def _thread_pool(self):
+        # Threads don't survive a fork, so each worker makes its own pool
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ThreadPool(self.threads)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def _document(self, event):
+        doc = {
+            "id": text_type(event.id),
+            "lat": event.lat,
+            "lon": event.lon
+        }
+        for field in RANKING_FIELDS:
+            doc[field] = getattr(event, field, None)
+        for field in self.fields:
+            value = getattr(event, field)
+            if value is not None:
+                doc[field] = text_type(value)
+        return doc
+
+    def add(self, event, previous=None):
+        """Index an event.
+
+        If the event was indexed before at other coordinates, pass
+        them as previous so it is removed from its old shard.
+
+        """
+
+        if previous is not None and previous[0] is not None:
+            if event.lat is None or \
+               self.shard_for(*previous) != self.shard_for(event.lat, event.lon):
+                self.remove(event.id, *previous)
+
+        # Events without coordinates don't belong to any shard
+        if event.lat is None or event.lon is None:
+            return
+
+        doc = self._document(event)
+        for name in (self.shard_for(event.lat, event.lon), GLOBAL_INDEX):
+            writer = AsyncWriter(self._open(name, create=True))
+            writer.update_document(**doc)
+            writer.commit()
+
+    def add_many(self, events):
+        """Index many events, with one writer per shard."""
+
+        writers = {}
+        for event in events:
+            if event.lat is None or event.lon is None:
+                continue
+
+            doc = self._document(event)
+            for name in (self.shard_for(event.lat, event.lon), GLOBAL_INDEX):
+                if name not in writers:
+                    writers[name] = AsyncWriter(self._open(name, create=True))
+                writers[name].update_document(**doc)
+
+        for writer in writers.values():
+            writer.commit()
+
+    def remove_many(self, locations):
+        """Remove many events, given as (event id, lat, lon) tuples."""
+
+        writers = {}
+        for event_id, lat, lon in locations:
+            if lat is None or lon is None:
+                continue
+
+            for name in (self.shard_for(lat, lon), GLOBAL_INDEX):
+                if name not in writers:
+                    ix = self._open(name)
+                    if ix is None:
+                        continue
+                    writers[name] = AsyncWriter(ix)
+                writers[name].delete_by_term("id", text_type(event_id))
+
+        for writer in writers.values():
+            writer.commit()
+
+    def remove(self, event_id, lat, lon):
+        """Remove an event indexed at the given coordinates."""
+
+        for name in (self.shard_for(lat, lon), GLOBAL_INDEX):
+            ix = self._open(name)
+            if ix is not None:
+                writer = AsyncWriter(ix)
+                writer.delete_by_term("id", text_type(event_id))
+                writer.commit()
+
+    def rebuild(self, events):
+        """Replace the whole index with the given events.
+
+        Returns the number of events indexed.
+
+        """
+
+        previous = self._current_generation()
+        generation = "%x" % int(time.time() * 1000000)
+        path = os.path.join(self.base_dir, generation)
+
+        def create(name):
+            ix_path = os.path.join(path, name)
+            os.makedirs(ix_path)
+            return index.create_in(ix_path, self.schema).writer()
+
+        writers = {GLOBAL_INDEX: create(GLOBAL_INDEX)}
+        indexed = 0
+        for event in events:
+            if event.lat is None or event.lon is None:
+                continue
+
+            shard = self.shard_for(event.lat, event.lon)
+            if shard not in writers:
+                writers[shard] = create(os.path.join(SHARDS_DIR, shard))
+
+            doc = self._document(event)
+            writers[shard].add_document(**doc)
+            writers[GLOBAL_INDEX].add_document(**doc)
+            indexed += 1
+
+        for writer in writers.values():
+            writer.commit()
+
+        current = os.path.join(self.base_dir, CURRENT_FILE)
+        with open(current + ".tmp", "w") as f:
+            f.write(generation)
+        os.rename(current + ".tmp", current)
+        self.checked = 0
+
+        # Workers may still be reading the previous generation, but
+        # none of them the ones before
+        for name in os.listdir(self.base_dir):
+            if name not in (generation, previous) and \
+               os.path.isdir(os.path.join(self.base_dir, name)):
+                shutil.rmtree(os.path.join(self.base_dir, name))
+
+        return indexed
+
+    def search(self, query, limit=None, lat=None, lon=None, radius=None,
+               ranker=None):
+        """Search for events matching a text query.
+
+        If lat, lon and radius (in miles) are given, only events
+        within radius are returned. Returns a list of (event id,
+        score, distance) tuples, best score first and nearest first
+        among equal scores. Distance is None for searches without a
+        location.
+
+        Hits are scored by text relevance alone, unless a Ranker
+        from api/ranking.py is given to score them.
+
+        """
+
+        if limit is not None and limit < 1:
+            return []
+
+        if lat is None:
+            ix = self._open(GLOBAL_INDEX)
+            if ix is None:
+                return []
+            if ranker is not None:
+                return self._rank_index(ix, query, limit, lat, lon, radius,
+                                        ranker, BM25F())
+            return self._search_index(ix, query, limit, lat, lon, radius,
+                                      BM25F())
+
+        lat = float(lat)
+        lon = float(lon)
+        lat_range = radius / MILES_PER_DEGREE
+        lon_range = radius / (MILES_PER_DEGREE * max(cos(radians(lat)), 0.01))
+        cells = geohash.cells_covering(lat - lat_range, lon - lon_range,
+                                       lat + lat_range, lon + lon_range,
+                                       self.precision)
+        shards = list(cells.intersection(self.shards()))
+
+        global_ix = self._open(GLOBAL_INDEX)
+        if global_ix is None:
+            return []
+
+        with global_ix.searcher() as stats:
+            weighting = SharedStatsBM25F(stats)
+
+            def search_shard(shard):
+                ix = self._open(shard)
+                if ix is None:
+                    return []
+                if ranker is not None:
+                    return self._rank_index(ix, query, limit, lat, lon,
+                                            radius, ranker, weighting)
+                return self._search_index(ix, query, limit, lat, lon, radius,
+                                          weighting)
+
+            if len(shards) == 1:
+                results = [search_shard(shard) for shard in shards]
+            else:
+                results = self._thread_pool().map(search_shard, shards)
+
+        hits = [hit for result in results for hit in result]
+
+        def rank(hit):
+            return (-hit[1], hit[2] or 0)
+
+        if limit is None:
+            return sorted(hits, key=rank)
+        return heapq.nsmallest(limit, hits, key=rank)
+
+    def _search_index(self, ix, query, limit, lat, lon, radius, weighting):
+        parser = MultifieldParser(self.fields, ix.schema)
+        hits = []
+
+        # Hits come best first, a page at a time. Without a radius
+        # every hit is kept, so the first page of limit is enough;
+        # with one, pages grow until limit hits are within it.
+        fetch = limit
+        if limit is not None and lat is not None:
+            fetch = limit * RANKING_FETCH_FACTOR
+        seen = 0
+
+        with ix.searcher(weighting=weighting) as searcher:
+            q = parser.parse(query)
+            while True:
+                results = _top_hits(searcher, q, fetch)
+                for hit in results[seen:]:
+                    dist = None
+                    if lat is not None:
+                        dist = 0.62 * calculate_equirectangular_distance(
+                            lat, lon, hit["lat"], hit["lon"])
+                        if dist > radius:
+                            continue
+
+                    hits.append((int(hit["id"]), hit.score, dist))
+                    if limit is not None and len(hits) == limit:
+                        return hits
+
+                seen = results.scored_length()
+                if fetch is None or seen < fetch:
+                    return hits
+                fetch *= 2
+
+    def _rank_index(self, ix, query, limit, lat, lon, radius, ranker,
+                    weighting):
+        parser = MultifieldParser(self.fields, ix.schema)
+        top = TopK(limit)
+
+        # Hits come in order of decreasing text score, a page at a
+        # time, and we stop once no hit left could make the top.
+        fetch = limit * RANKING_FETCH_FACTOR if limit is not None else None
+        seen = 0
+
+        with ix.searcher(weighting=weighting) as searcher:
+            q = parser.parse(query)
+            while True:
+                results = _top_hits(searcher, q, fetch)
+                for hit in results[seen:]:
+                    threshold = top.threshold()
+                    if threshold is not None and \
+                       ranker.bound(hit.score) <= threshold:
+                        return top.items()
+
+                    fields = hit.fields()
+                    dist = None
+                    if lat is not None:
+                        dist = 0.62 * calculate_equirectangular_distance(
+                            lat, lon, fields["lat"], fields["lon"])
+                        if dist > radius:
+                            continue
+
+                    score = ranker.score(hit.score, dist, fields)
+                    top.push(score, (int(fields["id"]), score, dist))
+
+                seen = results.scored_length()
+                if fetch is None or seen < fetch:
+                    return top.items()
+                fetch *= 2
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+
+from api.metrics import metrics
+
+MAGIC = b"VSC1"
+
+HEADER = struct.Struct("<4sIII")
+"""File header: magic, number of slots, slot size and ways per set."""
+
+HEADER_SIZE = 64
+
+SLOT_HEADER = struct.Struct("<QddHI")
+"""Slot header: key hash, expiry time, last use time, key and value length."""
+
+LAST_USED_OFFSET = 16
+
+LOCK_STRIPES = 64
+"""Number of locks shared by the threads of a process."""
+
+
+def _hash(key):
+    # Python's own hash is randomized per process, so it can't be
+    # used to find a key written by another worker.
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+class SharedCache(object):
+
+    """Cache shared by all the worker processes on a host.
+
+    Entries live in a file mapped into every worker, laid out as a
+    set associative hash table: a key hashes to a set of a few
+    fixed size slots, and when the set is full the least recently
+    used or an expired entry is replaced. Each set is guarded by a
+    byte range lock on the file, so workers only contend when they
+    touch the same set. Values are stored as JSON, and values too
+    large for a slot are simply not cached.
+
+    Put the file on a tmpfs such as /dev/shm so that it never
+    touches the disk.
+
+    """
+
+    def __init__(self, path=None, slots=16384, slot_size=2048, ways=8):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.map = None
+        self.locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+
+    def init_app(self, app):
+        self.path = app.config['SHARED_CACHE_PATH']
+        self.slots = app.config['SHARED_CACHE_SLOTS']
+        self.slot_size = app.config['SHARED_CACHE_SLOT_SIZE']
+        self._open()
+        app.extensions['cache'] = self
+
+    def _open(self):
+        self.sets = self.slots // self.ways
+        size = HEADER_SIZE + self.sets * self.ways * self.slot_size
+        header = HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways)
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # Only one worker lays out a new file. A file left with
+        # another layout by an older configuration is wiped.
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            if os.fstat(self.fd).st_size != size or \
+               os.read(self.fd, HEADER.size) != header:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+        self.map = mmap.mmap(self.fd, size)
+
+    def _lock(self, index):
+        return _SetLock(self, index)
+
+    def _slots(self, index):
+        first = HEADER_SIZE + index * self.ways * self.slot_size
+        return range(first, first + self.ways * self.slot_size,
+                     self.slot_size)
+
+    def _find(self, index, key, digest):
+        """Return the offset of the slot holding key, or None."""
+
+        for offset in self._slots(index):
+            slot_hash, expires, used, key_len, value_len = \
+                SLOT_HEADER.unpack_from(self.map, offset)
+            start = offset + SLOT_HEADER.size
+            if slot_hash == digest and key_len == len(key) and \
+               self.map[start:start + key_len] == key:
+                return offset
+        return None
+
+    def _read(self, index, key, digest, now):
+        """Return the value cached for key, or None. Hold the set's lock."""
+
+        offset = self._find(index, key, digest)
+        if offset is None:
+            return None
+
+        slot_hash, expires, used, key_len, value_len = \
+            SLOT_HEADER.unpack_from(self.map, offset)
+        if expires < now:
+            return None
+
+        struct.pack_into("<d", self.map, offset + LAST_USED_OFFSET, now)
+        start = offset + SLOT_HEADER.size + key_len
+        return json.loads(self.map[start:start + value_len].decode("utf-8"))
+
+    def _write(self, index, key, digest, value, ttl, now):
+        """Store a value, encoded, for key. Hold the set's lock."""
+
+        offset = self._find(index, key, digest)
+
+        # Otherwise take a free or expired slot, or else
+        # evict the least recently used one.
+        if offset is None:
+            oldest = None
+            for slot in self._slots(index):
+                slot_hash, expires, used, key_len, value_len = \
+                    SLOT_HEADER.unpack_from(self.map, slot)
+                if key_len == 0 or expires < now:
+                    offset = slot
+                    break
+                if oldest is None or used < oldest:
+                    oldest = used
+                    offset = slot
+
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + len(key) + len(value)] = key + value
+        SLOT_HEADER.pack_into(self.map, offset, digest, now + ttl, now,
+                              len(key), len(value))
+
+    def get(self, key):
+        """Return the value cached for a key, or None."""
+
+        key = key.encode("utf-8")
+        digest = _hash(key)
+        index = digest % self.sets
+
+        with self._lock(index):
+            value = self._read(index, key, digest, time.time())
+
+        if value is None:
+            metrics.increment("cache.miss")
+        else:
+            metrics.increment("cache.hit")
+        return value
+
+    def set(self, key, value, ttl):
+        """Cache a value for ttl seconds.
+
+        Returns False if the value is too large to be cached.
+
+        """
+
+        key = key.encode("utf-8")
+        value = json.dumps(value).encode("utf-8")
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return False
+
+        digest = _hash(key)
+        index = digest % self.sets
+
+        with self._lock(index):
+            self._write(index, key, digest, value, ttl, time.time())
+
+        return True
+
+    def update(self, key, func, ttl):
+        """Replace the value of a key with one computed from it, atomically.
+
+        func is called with the current value, or None, and returns
+        the new value and a result, which is returned. No worker can
+        change the key in between. New values too large to be cached
+        leave the key as it was.
+
+        """
+
+        key = key.encode("utf-8")
+        digest = _hash(key)
+        index = digest % self.sets
+
+        with self._lock(index):
+            now = time.time()
+            value, result = func(self._read(index, key, digest, now))
+
+            value = json.dumps(value).encode("utf-8")
+            if SLOT_HEADER.size + len(key) + len(value) <= self.slot_size:
+                self._write(index, key, digest, value, ttl, now)
+
+        return result
+
+    def delete(self, key):
+        """Remove a key from the cache, if it is cached."""
+
+        key = key.encode("utf-8")
+        digest = _hash(key)
+        index = digest % self.sets
+
+        with self._lock(index):
+            offset = self._find(index, key, digest)
+            if offset is not None:
+                SLOT_HEADER.pack_into(self.map, offset, 0, 0, 0, 0, 0)
+
+
+class _SetLock(object):
+
+    # The file lock keeps out other processes, but POSIX locks are
+    # held by a whole process, so threads also need their own lock.
+
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.index = index
+        self.lock = cache.locks[index % LOCK_STRIPES]
+        self.offset = HEADER_SIZE + index * cache.ways * cache.slot_size
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self.cache.fd, fcntl.LOCK_EX, 1, self.offset)
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.lockf(self.cache.fd, fcntl.LOCK_UN, 1, self.offset)
+        finally:
+            self.lock.release()
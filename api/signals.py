@@ -0,0 +1,55 @@
+from blinker import NamedSignal
+
+from api.query_budget import counted_as
+
+
+class CountedSignal(NamedSignal):
+
+    """Signal whose receivers' queries are counted apart.
+
+    The statements run by receivers are reported as
+    queries.<endpoint>.signal.<name> rather than counted against the
+    budget of the route sending the signal, see api/query_budget.py.
+
+    """
+
+    def send(self, *sender, **kwargs):
+        with counted_as("signal." + self.name):
+            return NamedSignal.send(self, *sender, **kwargs)
+
+
+# Signals sent by the resources after events and sign-ups change.
+# Subsystems that keep state derived from events connect to these
+# instead of being called directly from every request handler.
+event_saved = CountedSignal('event-saved')
+"""Sent after an event is created or updated.
+
+Receivers get the ``event`` model, ``created``, which is True
+for new events, and ``previous``, the (lat, lon) the event had
+before an update.
+
+"""
+
+event_deleted = CountedSignal('event-deleted')
+"""Sent after an event is deleted.
+
+Receivers get the ``event_id`` and ``event``, a dict of the
+columns the deleted event had.
+
+"""
+
+signups_changed = CountedSignal('signups-changed')
+"""Sent after users join or leave an event.
+
+Receivers get the ``event_id``, the list of ``user_ids`` that
+changed and ``delta``, the change in the number of volunteers.
+
+"""
+
+user_saved = CountedSignal('user-saved')
+"""Sent after a user is created or updated.
+
+Receivers get the ``user`` model and ``created``, which is True
+for new users.
+
+"""
@@ -0,0 +1,414 @@
+import os
+import mmap
+import time
+import struct
+import threading
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from flask.ext.mysqldb import MySQLdb
+
+SNAPSHOT_FORMAT = 2
+"""Version of the snapshot file layout. Files of other versions are ignored."""
+
+HEADER = struct.Struct("<4sIId")
+"""File header: magic, format version, number of records, build time."""
+
+HEADER_SIZE = 64
+
+ZIP_MAGIC = b"VZIP"
+
+ZIP_RECORD = struct.Struct("<Idd48s16s")
+"""Zipcode record: zipcode, lat, lon, city and state."""
+
+EVENT_MAGIC = b"VEVT"
+
+EVENT_RECORD = struct.Struct("<Idd")
+"""Event record: id, lat and lon."""
+
+INDEX_RECORD = struct.Struct("<II")
+"""Index record: a key and the position of the record it points to."""
+
+SNAPSHOT_CATCHUP_OVERLAP = 60
+"""Seconds of changes read again at each catch up.
+
+Rows are stamped with the time they were written on the API host,
+not when they were committed, so a change may show up a little
+after its timestamp.
+
+"""
+
+
+def write_snapshot(path, magic, record, rows, built, index=None):
+    """Write rows to a snapshot file, replacing it atomically.
+
+    If index is given, a list of (key, position) pairs sorted by
+    key, it is written after the rows as INDEX_RECORDs, so that rows
+    can also be found by another key than the one they're sorted by.
+    Workers that already mapped the old file keep reading it.
+
+    """
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path + ".tmp", "wb") as f:
+        header = HEADER.pack(magic, SNAPSHOT_FORMAT, len(rows), built)
+        f.write(header + b"\0" * (HEADER_SIZE - len(header)))
+        for row in rows:
+            f.write(record.pack(*row))
+        for entry in index or ():
+            f.write(INDEX_RECORD.pack(*entry))
+    os.rename(path + ".tmp", path)
+
+
+def map_snapshot(path, magic, record, indexed=False):
+    """Map a snapshot file, returning (map, count, built) or None.
+
+    Returns None if the file is missing or of another format, in
+    which case callers fall back on the database. Pass indexed for
+    files written with an index.
+
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        size = os.fstat(fd).st_size
+        if size < HEADER_SIZE:
+            return None
+        data = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    record_size = record.size
+    if indexed:
+        record_size += INDEX_RECORD.size
+
+    file_magic, version, count, built = HEADER.unpack_from(data, 0)
+    if file_magic != magic or version != SNAPSHOT_FORMAT or \
+       size != HEADER_SIZE + count * record_size:
+        data.close()
+        return None
+
+    return data, count, built
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _text(value):
+    return value.rstrip(b"\0").decode("utf-8")
+
+
+def _bytes(value):
+    return (value or u"").encode("utf-8")
+
+
+class ZipSnapshot(object):
+
+    """Coordinates, city and state of every zipcode, from a snapshot file.
+
+    Records are sorted by zipcode and looked up by binary search
+    right in the mapped file, so loading takes no time and every
+    worker on the host shares the same pages. Zipcode locations
+    don't change, so there is nothing to catch up on.
+
+    """
+
+    def __init__(self, data, count, built):
+        self.data = data
+        self.count = count
+        self.built = built
+
+    @classmethod
+    def load(cls, path):
+        mapped = map_snapshot(path, ZIP_MAGIC, ZIP_RECORD)
+        return cls(*mapped) if mapped is not None else None
+
+    @staticmethod
+    def build(conn, path):
+        """Write a snapshot of the location table. Returns its size."""
+
+        cur = conn.cursor(MySQLdb.cursors.DictCursor)
+        cur.execute("SELECT zipcode, lat, lon, city, state FROM location \
+                    GROUP BY zipcode")
+        rows = sorted((int(row["zipcode"]), float(row["lat"]),
+                       float(row["lon"]), _bytes(row["city"])[:48],
+                       _bytes(row["state"])[:16])
+                      for row in cur.fetchall()
+                      if row["lat"] is not None and row["lon"] is not None)
+
+        write_snapshot(path, ZIP_MAGIC, ZIP_RECORD, rows, time.time())
+        return len(rows)
+
+    def get(self, zipcode):
+        """Return the location of a zipcode, like get_location_from_zip."""
+
+        zipcode = int(zipcode)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER_SIZE + mid * ZIP_RECORD.size
+            found = struct.unpack_from("<I", self.data, offset)[0]
+            if found < zipcode:
+                lo = mid + 1
+            elif found > zipcode:
+                hi = mid
+            else:
+                z, lat, lon, city, state = ZIP_RECORD.unpack_from(self.data,
+                                                                  offset)
+                return {"lat": lat, "lon": lon, "city": _text(city),
+                        "state": _text(state)}
+        return None
+
+
+class EventSnapshot(object):
+
+    """Coordinates of every event, from a snapshot file plus recent changes.
+
+    Records are sorted by latitude, so the events in a bounding box
+    are found by binary search and a scan right in the mapped file,
+    and are followed by an index of their positions sorted by id.
+    Events whose location differs from the snapshot's, because they
+    were created, moved or deleted since it was built, are kept in
+    an overlay, also sorted by latitude. The overlay is caught up
+    from last_updated_date and the tombstones at most every
+    SNAPSHOT_CATCHUP_INTERVAL seconds, so the locations are at most
+    that stale.
+
+    A catch up after a newer snapshot file was written maps it and
+    starts over with an empty overlay, so running `manage.py
+    snapshot` periodically keeps the overlays small.
+
+    """
+
+    def __init__(self, path, mapped, mtime, interval):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self._use(mapped, mtime)
+
+    def _use(self, mapped, mtime):
+        # The file and its overlay are replaced together, as one
+        # tuple, so that readers never see them half updated. The
+        # overlay maps the ids of changed events to their location,
+        # None for events without one, and lists the (lat, lon, id)
+        # of those with a location, sorted.
+        data, count, built = mapped
+        self.state = (data, count, {}, [])
+        self.mtime = mtime
+
+        # Catch up from when the snapshot was built
+        self.since = datetime.fromtimestamp(built)
+
+    @classmethod
+    def load(cls, path, interval):
+        mtime = _mtime(path)
+        mapped = map_snapshot(path, EVENT_MAGIC, EVENT_RECORD, indexed=True)
+        if mapped is None:
+            return None
+        return cls(path, mapped, mtime, interval)
+
+    @staticmethod
+    def build(conn, path):
+        """Write a snapshot of the event locations. Returns its size."""
+
+        # Changes made while this runs are caught up by the workers
+        built = time.time()
+
+        cur = conn.cursor()
+        cur.execute("SELECT id, lat, lon FROM event \
+                    WHERE lat IS NOT NULL AND lon IS NOT NULL")
+        rows = sorted(((int(event_id), float(lat), float(lon))
+                       for event_id, lat, lon in cur.fetchall()),
+                      key=lambda row: row[1])
+        index = sorted((row[0], position)
+                       for position, row in enumerate(rows))
+
+        write_snapshot(path, EVENT_MAGIC, EVENT_RECORD, rows, built, index)
+        return len(rows)
+
+    def _reload(self):
+        """Map the snapshot file if a newer one was written.
+
+        Returns True if it was.
+
+        """
+
+        mtime = _mtime(self.path)
+        if mtime is None or (self.mtime is not None and mtime <= self.mtime):
+            return False
+
+        mapped = map_snapshot(self.path, EVENT_MAGIC, EVENT_RECORD,
+                              indexed=True)
+        if mapped is None:
+            return False
+
+        # Readers still scanning the old map keep it open until done
+        self._use(mapped, mtime)
+        return True
+
+    def catch_up(self, conn):
+        """Read the events changed since the last catch up.
+
+        Returns True if the location of any event changed.
+
+        """
+
+        now = time.time()
+        if now - self.checked < self.interval:
+            return False
+
+        # Only one thread catches up, the others use what we have
+        if not self.lock.acquire(False):
+            return False
+
+        try:
+            reloaded = self._reload()
+
+            started = datetime.now()
+            since = self.since - timedelta(seconds=SNAPSHOT_CATCHUP_OVERLAP)
+            cur = conn.cursor()
+
+            # Events without a location are None
+            found = {}
+            cur.execute("SELECT id, lat, lon FROM event \
+                        WHERE last_updated_date>%s", (since,))
+            for event_id, lat, lon in cur.fetchall():
+                if lat is None or lon is None:
+                    found[int(event_id)] = None
+                else:
+                    found[int(event_id)] = (float(lat), float(lon))
+
+            cur.execute("SELECT event_id FROM event_tombstone \
+                        WHERE deleted_date>%s", (since,))
+            for row in cur.fetchall():
+                found[int(row[0])] = None
+
+            moved = self._apply(found) or reloaded
+            self.since = started
+            self.checked = now
+        finally:
+            self.lock.release()
+
+        return moved
+
+    def _apply(self, found):
+        """Update the overlay with the current locations of events.
+
+        Changes read again because of the overlap, or of events whose
+        sign-ups changed, leave the overlay as it is, and events back
+        where the snapshot has them are dropped from it. Returns True
+        if the location of any event changed.
+
+        """
+
+        data, count, changed, by_lat = self.state
+
+        moves = {}
+        for event_id, location in found.items():
+            if event_id in changed:
+                current = changed[event_id]
+            else:
+                current = self._located(data, count, event_id)
+            if location != current:
+                moves[event_id] = location
+
+        if len(moves) == 0:
+            return False
+
+        changed = dict(changed)
+        for event_id, location in moves.items():
+            if location == self._located(data, count, event_id):
+                changed.pop(event_id, None)
+            else:
+                changed[event_id] = location
+
+        by_lat = sorted((location[0], location[1], event_id)
+                        for event_id, location in changed.items()
+                        if location is not None)
+        self.state = (data, count, changed, by_lat)
+        return True
+
+    @staticmethod
+    def _located(data, count, event_id):
+        """Return the (lat, lon) of an event in the snapshot, or None."""
+
+        index = HEADER_SIZE + count * EVENT_RECORD.size
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, position = INDEX_RECORD.unpack_from(
+                data, index + mid * INDEX_RECORD.size)
+            if found < event_id:
+                lo = mid + 1
+            elif found > event_id:
+                hi = mid
+            else:
+                i, lat, lon = EVENT_RECORD.unpack_from(
+                    data, HEADER_SIZE + position * EVENT_RECORD.size)
+                return (lat, lon)
+        return None
+
+    @staticmethod
+    def _first_at_least(data, count, lat):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER_SIZE + mid * EVENT_RECORD.size + 4
+            if struct.unpack_from("<d", data, offset)[0] < lat:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def within(self, bounds):
+        """Yield the (id, lat, lon) of the events inside a bounding box.
+
+        bounds are (min lat, max lat, min lon, max lon).
+
+        """
+
+        min_lat, max_lat, min_lon, max_lon = bounds
+        data, count, changed, by_lat = self.state
+
+        for i in range(self._first_at_least(data, count, min_lat), count):
+            event_id, lat, lon = EVENT_RECORD.unpack_from(
+                data, HEADER_SIZE + i * EVENT_RECORD.size)
+            if lat > max_lat:
+                break
+            if min_lon <= lon <= max_lon and event_id not in changed:
+                yield event_id, lat, lon
+
+        for i in range(bisect_left(by_lat, (min_lat,)), len(by_lat)):
+            lat, lon, event_id = by_lat[i]
+            if lat > max_lat:
+                break
+            if min_lon <= lon <= max_lon:
+                yield event_id, lat, lon
+
+
+def init_app(app):
+    """Map the snapshots of zipcodes and event locations, if any.
+
+    Without snapshot files, built by `manage.py snapshot`, the
+    lookups they speed up read from the database as before.
+
+    """
+
+    directory = app.config['SNAPSHOT_DIR']
+    app.extensions['zip_snapshot'] = ZipSnapshot.load(
+        os.path.join(directory, "zipcodes.snapshot"))
+    app.extensions['event_snapshot'] = EventSnapshot.load(
+        os.path.join(directory, "events.snapshot"),
+        app.config['SNAPSHOT_CATCHUP_INTERVAL'])
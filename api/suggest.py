@@ -0,0 +1,226 @@
+import time
+import heapq
+import threading
+from datetime import datetime, timedelta
+
+from flask import *
+from flask_restful import Resource
+from sqlalchemy import or_
+from sqlalchemy.orm import subqueryload
+
+from models.models import Event as db_event, EventTombstone
+from api import *
+from api.signals import event_saved, event_deleted
+from api.admission import admission_control
+
+SUGGEST_MAX_RESULTS = 10
+"""Number of completions cached at each trie node.
+
+This is also the largest limit a client can ask for.
+
+"""
+
+SUGGEST_CATCH_UP_INTERVAL = 30
+"""Seconds between checks for events changed by other workers."""
+
+SUGGEST_CATCH_UP_OVERLAP = 60
+"""Seconds of changes read again at each catch up.
+
+A change is stamped when it is written but may be committed later,
+after a catch up has passed its time. Reading it again is harmless,
+as updating an event's terms first removes the ones it had.
+
+"""
+
+
+class _Node(object):
+
+    __slots__ = ("children", "text", "weight", "top")
+
+    def __init__(self):
+        self.children = {}
+        self.text = None
+        self.weight = 0
+        self.top = []
+
+
+class PrefixTrie(object):
+
+    """Trie of suggestion terms weighted by how often they occur.
+
+    Every node caches the best completions below it, so looking up
+    a prefix costs one step per character and no search. Adding or
+    removing a term refreshes the caches along its path only.
+
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, text, weight=1):
+        """Add weight to a term, inserting it if needed."""
+
+        self._update(text, weight)
+
+    def discard(self, text, weight=1):
+        """Take weight away from a term, removing it at zero."""
+
+        self._update(text, -weight)
+
+    def complete(self, prefix, limit=SUGGEST_MAX_RESULTS):
+        """Return the best completions of a prefix."""
+
+        node = self.root
+        for char in prefix.lower():
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return [text for weight, text in node.top[:limit]]
+
+    def _update(self, text, delta):
+        key = text.strip().lower()
+        if len(key) == 0:
+            return
+
+        path = [self.root]
+        node = self.root
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                if delta < 0:
+                    return
+                child = node.children[char] = _Node()
+            path.append(child)
+            node = child
+
+        node.weight = max(node.weight + delta, 0)
+        if node.text is None or delta > 0:
+            node.text = text.strip()
+
+        # Rebuild the cached completions from the bottom up,
+        # pruning branches left without any terms.
+        for depth in range(len(path) - 1, -1, -1):
+            node = path[depth]
+            candidates = []
+            if node.weight > 0:
+                candidates.append((node.weight, node.text))
+            for child in node.children.values():
+                candidates.extend(child.top)
+            node.top = heapq.nlargest(SUGGEST_MAX_RESULTS, candidates)
+
+            if depth > 0 and len(node.top) == 0:
+                del path[depth - 1].children[key[depth - 1]]
+
+
+class EventSuggestions(object):
+
+    """Completions for event names, organizations and skills.
+
+    Loaded from the database on first use in each worker and kept
+    up to date from the event signals. Changes made by other
+    workers are picked up from last_updated_date and tombstones.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trie = None
+        self.terms = {}
+        self.synced = None
+        self.checked = 0
+
+    def init_app(self, app):
+        app.extensions['suggest'] = self
+
+        event_saved.connect(self.on_event_saved, sender=app)
+        event_deleted.connect(self.on_event_deleted, sender=app)
+
+    def complete(self, prefix, limit):
+        with self.lock:
+            if self.trie is None:
+                self._load()
+            elif time.time() - self.checked > SUGGEST_CATCH_UP_INTERVAL:
+                self._catch_up()
+
+            return self.trie.complete(prefix, limit)
+
+    def on_event_saved(self, app, event, created, previous=None):
+        with self.lock:
+            if self.trie is not None:
+                self._update(event.id, self._event_terms(event))
+
+    def on_event_deleted(self, app, event_id, event):
+        with self.lock:
+            if self.trie is not None:
+                self._update(int(event_id), [])
+
+    def _event_terms(self, event):
+        terms = [event.name, event.organization]
+        terms.extend(skill.name for skill in event.skills)
+        return [t for t in terms if t is not None and len(t.strip()) > 0]
+
+    def _update(self, event_id, terms):
+        for term in self.terms.pop(event_id, []):
+            self.trie.discard(term)
+        for term in terms:
+            self.trie.add(term)
+        if len(terms) > 0:
+            self.terms[event_id] = terms
+
+    def _load(self):
+        self.synced = datetime.now()
+        self.checked = time.time()
+        self.trie = PrefixTrie()
+        self.terms = {}
+
+        events = db_event.query.options(subqueryload(db_event.skills))
+        for event in events:
+            self._update(event.id, self._event_terms(event))
+
+    def _catch_up(self):
+        since = self.synced - timedelta(seconds=SUGGEST_CATCH_UP_OVERLAP)
+        self.synced = datetime.now()
+        self.checked = time.time()
+
+        events = db_event.query.options(subqueryload(db_event.skills)) \
+            .filter(or_(db_event.created_date >= since,
+                        db_event.last_updated_date >= since))
+        for event in events:
+            self._update(event.id, self._event_terms(event))
+
+        tombstones = EventTombstone.query.filter(
+            EventTombstone.deleted_date >= since)
+        for tombstone in tombstones:
+            self._update(tombstone.event_id, [])
+
+
+class EventSuggest(Resource):
+
+    """Class providing autocompletion for the search box."""
+
+    query_budget = {"get": 4}
+
+    @admission_control("event_suggest")
+    @key_required
+    @auth_required
+    def get(self):
+        """Return completions of a prefix.
+
+        URL parameters:
+        - prefix: the text typed so far
+        - limit: max number of completions returned
+
+        """
+
+        prefix = request.values.get("prefix", "")
+        limit = request.values.get("limit")
+
+        try:
+            limit = min(int(limit), SUGGEST_MAX_RESULTS)
+        except (TypeError, ValueError):
+            limit = SUGGEST_MAX_RESULTS
+
+        suggestions = current_app.extensions['suggest']
+        return get_success_response({
+            "suggestions": suggestions.complete(prefix.strip(), limit)
+        })
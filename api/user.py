@@ -10,22 +10,50 @@ from flask.ext.security import utils
 
 from sqlalchemy.exc import IntegrityError
 from models.models import Event as db_event, User as db_user
+from models.queries import get_user, get_user_by_email
 from werkzeug import secure_filename
 from geopy.geocoders import Nominatim
 
 from globals import *
 import requests
 from api import *
+from api.signals import signups_changed, user_saved
+from api.admission import admission_control
+from api.analytics import count_signups
+from jobs import enqueue
+
+GROUP_SIGNUP_MAX_USERS = 500
+"""Max number of users signed up to an event in one request."""
 
 def allowed_file(filename):
     """Check if the file type is allowed."""
 
     return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
+def set_location_if_known(user, zipcode):
+    """Set a user's zipcode and coordinates, if this host has them cached.
+
+    Returns False if the zipcode has to be looked up in the
+    database first.
+
+    """
+
+    coordinates = get_location_from_zip(int(zipcode), cached_only=True)
+    if coordinates is None:
+        return False
+
+    user.lat = coordinates["lat"]
+    user.lon = coordinates["lon"]
+    user.zipcode = zipcode
+    return True
+
 class Login(Resource):
 
     """Class to handle user login route"""        
 
+    query_budget = {"post": 2}
+
+    @admission_control("login")
     @key_required
     def post(self):
         """Log user in.
@@ -39,7 +67,7 @@ class Login(Resource):
         email = req_json["email"]
         password = req_json["password"]
 
-        user = db_user.query.filter_by(email=str(email)).first()
+        user = get_user_by_email(str(email))
 
         if user is not None:
             if utils.verify_password(password,user.password):
@@ -54,6 +82,9 @@ class ProfilePic(Resource):
 
     """Class to handle profile pic routes."""
 
+    query_budget = {"post": 3}
+
+    @admission_control("profile_pic", max_concurrent=2)
     @key_required
     @auth_required
     def post(self,user_id):
@@ -72,17 +103,18 @@ class ProfilePic(Resource):
             # Updated user's pic url
             db = app.db
 
-            user = db_user.query.filter_by(id=str(user_id)).first()
-
-            # Make sure to delete the old pic if there was one
-            if user.profile_pic_url is not None:
-                os.remove(os.path.join(app.config['UPLOAD_FOLDER'],
-                          user.profile_pic_url))
+            user = get_user(user_id)
+            old_pic_url = user.profile_pic_url
 
             user.profile_pic_url = filename
 
             db.session.commit()
 
+            # Make sure to delete the old pic if there was one
+            if old_pic_url is not None:
+                enqueue("remove_file", os.path.join(app.config['UPLOAD_FOLDER'],
+                                                    old_pic_url))
+
             result = {
                 "filename":filename
             }
@@ -96,6 +128,9 @@ class UserList(Resource):
 
     """Class to handle user creation routes."""
 
+    query_budget = {"post": 8}
+
+    @admission_control("user_create")
     @key_required
     @auth_required
     def post(self):
@@ -135,23 +170,8 @@ class UserList(Resource):
 
         # If the user provided a zipcode, set their coordinates
         zipcode = req_json.get("zipcode", None)
-        if zipcode is not None:
-
-            try: 
-
-                zip = int(zipcode)
-                coordinates = get_location_from_zip(zip)        
-
-                # Coorindates will be None if no coordinates
-                # were found that match the provided zipcode
-                if coordinates is not None: 
-
-                    user.lat = coordinates["lat"]
-                    user.lon = coordinates["lon"]
-                    user.zipcode = zipcode
-
-            except (ValueError, IndexError):
-                user.zipcode = None
+        pending = is_valid_zipcode(zipcode) and \
+            not set_location_if_known(user, zipcode)
 
         try:
             # Save the user
@@ -162,8 +182,16 @@ class UserList(Resource):
             msg = "Foreign key error."
             return get_error_response(msg)
 
+        user_saved.send(app, user=user, created=True)
+
+        # Zipcodes this host doesn't know yet are looked up, and
+        # set along with their coordinates, in the background.
+        if pending:
+            enqueue("resolve_user_location", user.id, zipcode)
+
         result = {
-            "user": user.serialize
+            "user": user.serialize,
+            "location_pending": pending
         }
 
         return get_success_response(result)
@@ -173,18 +201,22 @@ class User(Resource):
 
     """Class to handle fetching, updating and deleting users."""
 
+    query_budget = {"get": 8, "post": 12, "delete": 10}
+
+    @admission_control("user")
     @key_required
     @auth_required
     def get(self,user_id):
         """Return user."""
 
-        u = db_user.query.filter_by(id=str(user_id)).first()
+        u = get_user(user_id)
 
         if u is not None:
             return get_success_response({"user": u.serialize})
 
         return get_error_response("User not found.")
 
+    @admission_control("user_update")
     @key_required
     @auth_required
     def post(self, user_id):
@@ -195,7 +227,7 @@ class User(Resource):
 
         req_json = request.get_json()
 
-        user = db_user.query.filter_by(id=str(user_id)).first()
+        user = get_user(user_id)
 
         # Make sure the user exists
         if user is not None:
@@ -255,28 +287,21 @@ class User(Resource):
 
             # Update user location
             zipcode = req_json.get("zipcode", None)
-            if zipcode is not None:
-
-                try: 
-
-                    zip = int(zipcode)
-                    coordinates = get_location_from_zip(zip)        
+            pending = is_valid_zipcode(zipcode) and \
+                not set_location_if_known(user, zipcode)
 
-                    # coorindates will be None if no coordinates
-                    # were found that match the provided zipcode
-                    if coordinates is not None: 
-
-                        user.lat = coordinates["lat"]
-                        user.lon = coordinates["lon"]
-                        user.zipcode = zipcode
+            db.session.commit()
 
-                except (ValueError, IndexError):
-                    zipcode = None
+            user_saved.send(app, user=user, created=False)
 
-            db.session.commit()
+            # Zipcodes this host doesn't know yet are looked up in
+            # the background, and until then the response still
+            # shows the old location.
+            if pending:
+                enqueue("resolve_user_location", user.id, zipcode)
 
             # Return the updated user
-            result = {"user": user.serialize}
+            result = {"user": user.serialize, "location_pending": pending}
             return get_success_response(result)
 
         else:
@@ -288,7 +313,7 @@ class User(Resource):
         app = current_app._get_current_object()
         db = app.db
 
-        user = db_user.query.filter_by(id=str(user_id)).first()
+        user = get_user(user_id)
 
         if user is None:
             return get_error_response("User not found.")
@@ -303,6 +328,9 @@ class EventsUsers(Resource):
 
     """Class for adding and removing users to events."""
 
+    query_budget = {"get": 0, "post": 12, "delete": 14}
+
+    @admission_control("events_users")
     @key_required
     @auth_required
     def get(self, user_id):
@@ -310,6 +338,7 @@ class EventsUsers(Resource):
 
         return get_success_response()
 
+    @admission_control("events_users_join")
     @key_required
     @auth_required
     def post(self, event_id, user_id):
@@ -321,13 +350,20 @@ class EventsUsers(Resource):
 
         cur.execute("INSERT INTO events_users (event_id,user_id) VALUES (%s, %s)",
                     ({event_id}, {user_id}))
-        cur.execute("UPDATE event SET current_num_volunteers=current_num\
-                    _volunteers+1 WHERE id=%s", ({event_id}))
+        cur.execute("UPDATE event SET current_num_volunteers=\
+                    current_num_volunteers+1, last_updated_date=%s \
+                    WHERE id=%s", (datetime.now(), event_id))
+
+        count_signups(conn, event_id, 1)
 
         conn.commit()
 
+        signups_changed.send(app, event_id=event_id, user_ids=[user_id],
+                             delta=1)
+
         return get_success_response()
 
+    @admission_control("events_users_leave")
     @key_required
     @auth_required
     def delete(self, event_id, user_id):
@@ -339,9 +375,129 @@ class EventsUsers(Resource):
 
         cur.execute("DELETE FROM events_users WHERE event_id=%s and user_id=%s",
                     ({event_id}, {user_id}))
-        cur.execute("UPDATE event SET current_num_volunteers=current_num\
-                    _volunteers-1 WHERE id=%s", ({event_id}))
+        cur.execute("UPDATE event SET current_num_volunteers=\
+                    current_num_volunteers-1, last_updated_date=%s \
+                    WHERE id=%s", (datetime.now(), event_id))
+
+        count_signups(conn, event_id, -1)
 
         conn.commit()
 
+        signups_changed.send(app, event_id=event_id, user_ids=[user_id],
+                             delta=-1)
+
         return get_success_response()
+
+
+class EventSignups(Resource):
+
+    """Class for signing up a group of users to an event at once."""
+
+    query_budget = {"post": 16}
+
+    @admission_control("event_signups", max_concurrent=4)
+    @key_required
+    @auth_required
+    def post(self, event_id):
+        """Sign up a list of users to an event.
+
+        Post body parameters:
+        - user_ids: list of ids of the users to sign up
+        - partial: JSON boolean. If true, sign up as many users as
+          there are open slots for, in the order given. Otherwise
+          sign up either every user or, if there aren't enough
+          slots, none of them.
+
+        All sign-ups are made in one transaction, holding a lock on
+        the event so that concurrent sign-ups can't overfill it.
+        Returns the outcome for each user: signed_up,
+        already_signed_up, not_found or full.
+
+        """
+
+        app = current_app._get_current_object()
+        req_json = request.get_json(silent=True) or {}
+
+        user_ids = req_json.get("user_ids")
+        if not isinstance(user_ids, list):
+            return get_error_response("Invalid user ids.")
+
+        partial = req_json.get("partial", False)
+        if not isinstance(partial, bool):
+            return get_error_response("Invalid partial.")
+
+        try:
+            user_ids = [int(user_id) for user_id in user_ids]
+        except (TypeError, ValueError):
+            return get_error_response("Invalid user ids.")
+
+        if len(user_ids) == 0 or len(user_ids) > GROUP_SIGNUP_MAX_USERS:
+            return get_error_response("Invalid user ids.")
+
+        # Drop repeated ids, keeping the first of each
+        seen = set()
+        user_ids = [u for u in user_ids if not (u in seen or seen.add(u))]
+        placeholders = ", ".join(["%s"] * len(user_ids))
+
+        conn = app.mysql.connection
+        cur = conn.cursor(MySQLdb.cursors.DictCursor)
+
+        cur.execute("SELECT current_num_volunteers, max_volunteers_needed \
+                    FROM event WHERE id=%s FOR UPDATE", (event_id,))
+        event = cur.fetchone()
+        if event is None:
+            conn.rollback()
+            return get_error_response("Event not found.")
+
+        cur.execute("SELECT id FROM user WHERE id IN (" + placeholders + ")",
+                    user_ids)
+        found = set(row["id"] for row in cur.fetchall())
+
+        cur.execute("SELECT user_id FROM events_users WHERE event_id=%s \
+                    AND user_id IN (" + placeholders + ")",
+                    [event_id] + user_ids)
+        already = set(row["user_id"] for row in cur.fetchall())
+
+        outcomes = {}
+        candidates = []
+        for user_id in user_ids:
+            if user_id not in found:
+                outcomes[user_id] = "not_found"
+            elif user_id in already:
+                outcomes[user_id] = "already_signed_up"
+            else:
+                candidates.append(user_id)
+
+        accepted = candidates
+        if event["max_volunteers_needed"] is not None:
+            slots = max(event["max_volunteers_needed"] -
+                        (event["current_num_volunteers"] or 0), 0)
+            if len(candidates) > slots:
+                accepted = candidates[:slots] if partial else []
+
+        for user_id in candidates:
+            outcomes[user_id] = "signed_up" if user_id in accepted else "full"
+
+        results = [{"user_id": user_id, "status": outcomes[user_id]}
+                   for user_id in user_ids]
+
+        if len(accepted) == 0:
+            conn.rollback()
+            return get_success_response({"signed_up": 0, "results": results})
+
+        cur.executemany("INSERT INTO events_users (event_id, user_id) \
+                        VALUES (%s, %s)",
+                        [(event_id, user_id) for user_id in accepted])
+        cur.execute("UPDATE event SET current_num_volunteers=\
+                    IFNULL(current_num_volunteers, 0)+%s, \
+                    last_updated_date=%s WHERE id=%s",
+                    (len(accepted), datetime.now(), event_id))
+        count_signups(conn, event_id, len(accepted))
+
+        conn.commit()
+
+        signups_changed.send(app, event_id=event_id, user_ids=accepted,
+                             delta=len(accepted))
+
+        return get_success_response({"signed_up": len(accepted),
+                                     "results": results})
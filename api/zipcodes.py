@@ -0,0 +1,125 @@
+from math import cos, radians, floor
+
+from flask import current_app
+from flask.ext.mysqldb import MySQLdb
+
+from api import calculate_equirectangular_distance
+
+ZIP_NEIGHBOR_RADII = (5, 10, 25, 50)
+"""Standard search radii, in miles, covered by the zip_neighbor table."""
+
+ZIP_NEIGHBOR_BATCH_SIZE = 5000
+"""Number of rows written to zip_neighbor per statement."""
+
+
+def get_neighbor_zipcodes(zipcode, radius):
+    """Get the zipcodes near a zipcode from the zip_neighbor table.
+
+    The table only covers the standard radii, so the result may
+    include zipcodes up to the next standard radius away and callers
+    must still check distances. Returns None if the radius is larger
+    than every standard radius or the table doesn't have the zipcode.
+
+    Zipcodes are returned as strings, both with and without leading
+    zeros, to match the event zipcode column.
+
+    """
+
+    radii = [r for r in ZIP_NEIGHBOR_RADII if r >= radius]
+    if len(radii) == 0:
+        return None
+
+    app = current_app._get_current_object()
+    cur = app.mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    cur.execute("SELECT neighbor FROM zip_neighbor WHERE zipcode=%s \
+                AND radius<=%s", (zipcode, radii[0]))
+    rows = cur.fetchall()
+
+    if len(rows) == 0:
+        return None
+
+    neighbors = set()
+    for row in rows:
+        neighbors.add(str(row["neighbor"]))
+        neighbors.add("%05d" % row["neighbor"])
+    return list(neighbors)
+
+
+def find_zip_neighbors(locations, radii=ZIP_NEIGHBOR_RADII):
+    """Find the pairs of zipcodes within the standard radii.
+
+    Takes a list of (zipcode, lat, lon) and yields (zipcode,
+    neighbor, radius) for every pair of zipcodes within the largest
+    radius, where radius is the smallest standard radius containing
+    the neighbor. Every zipcode is its own neighbor.
+
+    """
+
+    max_radius = max(radii)
+
+    # Bucket zipcodes in a grid of cells one max radius high so
+    # that we only compare zipcodes in nearby cells.
+    cell = max_radius / 69.0
+    grid = {}
+    for zipcode, lat, lon in locations:
+        key = (int(floor(lat / cell)), int(floor(lon / cell)))
+        grid.setdefault(key, []).append((zipcode, lat, lon))
+
+    for zipcode, lat, lon in locations:
+        row = int(floor(lat / cell))
+        col = int(floor(lon / cell))
+
+        # Degrees of longitude shrink away from the equator, so
+        # look further east and west at high latitudes.
+        span = int(1 / max(cos(radians(lat)), 0.05)) + 1
+
+        for r in range(row - 1, row + 2):
+            for c in range(col - span, col + span + 1):
+                for neighbor, n_lat, n_lon in grid.get((r, c), ()):
+                    miles = 0.62 * calculate_equirectangular_distance(
+                        lat, lon, n_lat, n_lon)
+                    for radius in radii:
+                        if miles <= radius:
+                            yield (zipcode, neighbor, radius)
+                            break
+
+
+def build_zip_neighbors(conn, radii=ZIP_NEIGHBOR_RADII):
+    """Rebuild the zip_neighbor table from the location table.
+
+    The new table is filled on the side and swapped in atomically,
+    so searches keep using the old one while this runs. Returns
+    the number of rows written.
+
+    """
+
+    cur = conn.cursor()
+    cur.execute("SELECT zipcode, lat, lon FROM location GROUP BY zipcode")
+    locations = [(int(z), float(lat), float(lon))
+                 for z, lat, lon in cur.fetchall()
+                 if lat is not None and lon is not None]
+
+    cur.execute("DROP TABLE IF EXISTS zip_neighbor_new")
+    cur.execute("CREATE TABLE zip_neighbor_new LIKE zip_neighbor")
+
+    rows = 0
+    batch = []
+    for pair in find_zip_neighbors(locations, radii):
+        batch.append(pair)
+        if len(batch) == ZIP_NEIGHBOR_BATCH_SIZE:
+            cur.executemany("INSERT INTO zip_neighbor_new (zipcode, neighbor, \
+                            radius) VALUES (%s, %s, %s)", batch)
+            rows += len(batch)
+            batch = []
+
+    if len(batch) > 0:
+        cur.executemany("INSERT INTO zip_neighbor_new (zipcode, neighbor, \
+                        radius) VALUES (%s, %s, %s)", batch)
+        rows += len(batch)
+
+    cur.execute("RENAME TABLE zip_neighbor TO zip_neighbor_old, \
+                zip_neighbor_new TO zip_neighbor")
+    cur.execute("DROP TABLE zip_neighbor_old")
+    conn.commit()
+
+    return rows
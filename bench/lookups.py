@@ -0,0 +1,106 @@
+"""Measure the Python overhead of the hot lookups in models/queries.py.
+
+Fills an in-memory SQLite database with generated users and events,
+then times each lookup done three ways:
+
+- building a Query on every call, the way the routes used to,
+- with the baked query of models/queries.py,
+- with the instance already in the session, found in the identity
+  map without any query.
+
+SQLite answers these lookups in a few microseconds, so the times are
+mostly the Python work SQLAlchemy does around each statement. The
+session is emptied before each lookup of the first two kinds, and
+that is included in their times.
+
+    python bench/lookups.py --lookups 20000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from flask import Flask
+
+from models.models import User, Event, db
+from models.queries import get_user, get_event, get_user_by_email
+
+
+def populate(users, events):
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {"id": i, "email": "user%d@example.com" % i, "current_hours": i % 50}
+        for i in range(1, users + 1)])
+    db.session.execute(Event.__table__.insert(), [
+        {"id": i, "name": "event %d" % i, "creator_id": i % users + 1}
+        for i in range(1, events + 1)])
+    db.session.commit()
+
+
+def per_lookup(f, keys, empty_session):
+    """Return the microseconds f takes per key, best of three runs."""
+
+    best = None
+    for run in range(3):
+        started = time.time()
+        for key in keys:
+            if empty_session:
+                db.session.expunge_all()
+            f(key)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+    db.init_app(app)
+
+    rng = random.Random(481)
+    with app.app_context():
+        populate(args.users, args.events)
+
+        user_ids = [rng.randint(1, args.users) for i in range(args.lookups)]
+        event_ids = [rng.randint(1, args.events) for i in range(args.lookups)]
+        emails = ["user%d@example.com" % i for i in user_ids]
+
+        cases = [
+            ("user by id", user_ids,
+             lambda i: User.query.filter_by(id=str(i)).first(), get_user),
+            ("event by id", event_ids,
+             lambda i: Event.query.filter_by(id=str(i)).first(), get_event),
+            ("user by email", emails,
+             lambda e: User.query.filter_by(email=e).first(),
+             get_user_by_email),
+        ]
+
+        for name, keys, built, baked in cases:
+            print("%s:" % name)
+            print("  query built per call: %7.1fus" %
+                  per_lookup(built, keys, True))
+            print("  baked query:          %7.1fus" %
+                  per_lookup(baked, keys, True))
+
+            # Emails aren't primary keys, so they always query
+            if baked is not get_user_by_email:
+                print("  identity map:         %7.1fus" %
+                      per_lookup(baked, keys, False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Measure the memory nearest_events uses as the number of events grows.
+
+For each --sizes count of generated event locations, a new process
+streams them through nearest_events, which keeps the --limit nearest
+in a bounded heap, and reports its time and peak memory. With
+--materialize, the sizes are run again loading every location into
+a list sorted by distance, the way searches used to, for comparison.
+
+The locations come from a generator standing in for the event
+snapshot or the batched database query, so that only the search
+itself is measured. Peak memory should stay flat as the sizes grow.
+
+    python bench/nearest_events.py --sizes 10000,100000,1000000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import subprocess
+from itertools import count, islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+CENTER = (42.28, -83.74)
+"""Location searched around, Ann Arbor."""
+
+
+def max_rss():
+    """Return the peak memory of this process, in MB."""
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024.0 * 1024)
+    return rss / 1024.0
+
+
+class GeneratedLocations(object):
+
+    """Stand-in for EventSnapshot yielding generated locations."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def catch_up(self, conn):
+        return False
+
+    def within(self, bounds):
+        rng = random.Random(481)
+        for event_id in islice(count(1), self.size):
+            yield (event_id, CENTER[0] + rng.uniform(-0.5, 0.5),
+                   CENTER[1] + rng.uniform(-0.5, 0.5))
+
+
+class NoDatabase(object):
+
+    connection = None
+
+
+def run(size, radius, limit, materialize):
+    """Search size generated events, in this process."""
+
+    from flask import Flask
+    from api import calculate_equirectangular_distance
+    from api.event import nearest_events
+
+    app = Flask(__name__)
+    app.mysql = NoDatabase()
+    app.extensions['event_snapshot'] = GeneratedLocations(size)
+
+    rss_before = max_rss()
+    with app.app_context():
+        started = time.time()
+        if materialize:
+            locations = list(app.extensions['event_snapshot'].within(None))
+            ranked = sorted(
+                (0.62 * calculate_equirectangular_distance(
+                    CENTER[0], CENTER[1], lat, lon), event_id)
+                for event_id, lat, lon in locations)
+            event_ids = [event_id for miles, event_id in ranked
+                         if miles < radius][:limit]
+        else:
+            event_ids = nearest_events(CENTER[0], CENTER[1], radius, limit)
+        elapsed = time.time() - started
+
+    print("%d %.3f %.1f %d" % (size, elapsed, max_rss() - rss_before,
+                               len(event_ids)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--radius", type=int, default=25)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--materialize", action="store_true")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args.run, args.radius, args.limit, args.materialize)
+        return
+
+    modes = [False, True] if args.materialize else [False]
+    for materialize in modes:
+        print("sorted list:" if materialize else "bounded heap:")
+        for size in args.sizes.split(","):
+            command = [sys.executable, os.path.abspath(__file__),
+                       "--run", size, "--radius", str(args.radius),
+                       "--limit", str(args.limit)]
+            if materialize:
+                command.append("--materialize")
+
+            # Each size gets a new process, so peak memory is its own
+            output = subprocess.check_output(command).decode("utf-8")
+            size, elapsed, rss, found = output.splitlines()[-1].split()
+            print("  %9s events: %7.3fs, %7.1f MB more peak memory, "
+                  "%s found" % (size, float(elapsed), float(rss), found))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Measure the organization stats counters against computing stats on read.
+
+Fills a scratch MySQL database with generated users, events and
+sign-ups, then times:
+
+- reading an organization's stats from the maintained counters,
+  as /organization/<organization>/stats does,
+- computing the same stats from the event and sign-up tables,
+- a sign-up with and without the counter update in its transaction,
+- a full reconcile-org-stats run,
+
+and checks that the counters still match the source tables after
+the sign-ups. The database given by --database is dropped and
+created again, so never point this at real data.
+
+    python bench/org_stats.py --events 100000 --signups 500000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+try:
+    import MySQLdb
+except ImportError:
+    import pymysql
+    pymysql.install_as_MySQLdb()
+    import MySQLdb
+
+from api.analytics import count_signups, reconcile_organization_stats
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                       "sql")
+
+SOURCE_STATS = "SELECT COUNT(*), SUM(IFNULL(e.max_volunteers_needed, 0)), \
+    SUM(IFNULL(s.signups, 0)), SUM(e.end_date > %s), \
+    SUM(IF(e.end_date > %s, IFNULL(e.max_volunteers_needed, 0), 0)), \
+    SUM(IF(e.end_date > %s, IFNULL(s.signups, 0), 0)) \
+    FROM event e LEFT JOIN (SELECT event_id, COUNT(*) AS signups \
+    FROM events_users GROUP BY event_id) s ON s.event_id=e.id \
+    WHERE e.organization=%s"
+"""Stats of one organization computed from the source tables."""
+
+
+def run_script(cur, name):
+    with open(os.path.join(SQL_DIR, name)) as f:
+        for statement in f.read().split(";"):
+            if statement.strip():
+                cur.execute(statement)
+
+
+def populate(conn, args, rng):
+    cur = conn.cursor()
+    now = datetime.now()
+
+    cur.executemany("INSERT INTO user (email) VALUES (%s)",
+                    [("user%d@example.com" % i,) for i in range(args.users)])
+
+    organizations = ["org%d" % i for i in range(args.organizations)]
+    events = []
+    for i in range(args.events):
+        end = now + timedelta(days=rng.randint(-180, 180))
+        events.append((rng.choice(organizations), rng.randint(1, 50),
+                       end - timedelta(hours=3), end))
+    for start in range(0, len(events), 5000):
+        cur.executemany("INSERT INTO event (organization, \
+                        max_volunteers_needed, current_num_volunteers, \
+                        start_date, end_date) VALUES (%s, %s, 0, %s, %s)",
+                        events[start:start + 5000])
+
+    signups = [(rng.randint(1, args.events), rng.randint(1, args.users))
+               for i in range(args.signups)]
+    for start in range(0, len(signups), 5000):
+        cur.executemany("INSERT INTO events_users (event_id, user_id) \
+                        VALUES (%s, %s)", signups[start:start + 5000])
+    cur.execute("UPDATE event e SET current_num_volunteers=(SELECT COUNT(*) \
+                FROM events_users s WHERE s.event_id=e.id)")
+    conn.commit()
+
+    return organizations
+
+
+def timed(f, repeat):
+    """Return the median seconds f takes, over repeat runs."""
+
+    times = []
+    for i in range(repeat):
+        started = time.time()
+        f()
+        times.append(time.time() - started)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="volunteer_bench")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--organizations", type=int, default=200)
+    parser.add_argument("--signups", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(481)
+    conn = MySQLdb.connect(host=args.host, user=args.user,
+                           passwd=args.password)
+    cur = conn.cursor()
+    cur.execute("DROP DATABASE IF EXISTS `%s`" % args.database)
+    cur.execute("CREATE DATABASE `%s`" % args.database)
+    conn.select_db(args.database)
+    run_script(cur, "create_tables.sql")
+
+    started = time.time()
+    organizations = populate(conn, args, rng)
+    print("generated %d events and %d sign-ups in %.1fs" % (
+        args.events, args.signups, time.time() - started))
+
+    print("reconcile-org-stats: %.3fs" % timed(
+        lambda: reconcile_organization_stats(conn), 3))
+
+    def from_counters():
+        organization = rng.choice(organizations)
+        cur.execute("SELECT * FROM organization_stats WHERE organization=%s",
+                    (organization,))
+        cur.fetchall()
+        cur.execute("SELECT day, signups FROM organization_signups_daily \
+                    WHERE organization=%s AND day>=%s ORDER BY day",
+                    (organization, datetime.now() - timedelta(days=30)))
+        cur.fetchall()
+
+    def from_source():
+        now = datetime.now()
+        cur.execute(SOURCE_STATS, (now, now, now, rng.choice(organizations)))
+        cur.fetchall()
+
+    print("stats from counters: %.3fms" % (
+        timed(from_counters, args.repeat) * 1000))
+    print("stats from source tables: %.3fms" % (
+        timed(from_source, args.repeat) * 1000))
+
+    def signup(counted):
+        event_id = rng.randint(1, args.events)
+        cur.execute("INSERT INTO events_users (event_id, user_id) \
+                    VALUES (%s, %s)", (event_id, rng.randint(1, args.users)))
+        cur.execute("UPDATE event SET current_num_volunteers=\
+                    current_num_volunteers+1 WHERE id=%s", (event_id,))
+        if counted:
+            count_signups(conn, event_id, 1)
+        conn.commit()
+
+    print("sign-up without counters: %.3fms" % (
+        timed(lambda: signup(False), args.repeat) * 1000))
+
+    # The uncounted sign-ups are folded in before counting the rest
+    reconcile_organization_stats(conn)
+    print("sign-up with counters: %.3fms" % (
+        timed(lambda: signup(True), args.repeat) * 1000))
+
+    now = datetime.now()
+    cur.execute("SELECT organization, num_events, total_capacity, \
+                total_signups, upcoming_events, upcoming_capacity, \
+                upcoming_signups FROM organization_stats")
+    drifted = 0
+    for row in cur.fetchall():
+        cur.execute(SOURCE_STATS, (now, now, now, row[0]))
+        source = tuple(int(value or 0) for value in cur.fetchone())
+        if source != tuple(int(value) for value in row[1:]):
+            drifted += 1
+    print("organizations whose counters drifted: %d" % drifted)
+
+    cur.execute("DROP DATABASE `%s`" % args.database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Measure how long PushHub takes to fan a change out to many streams.
+
+Subscribes --subscribers queues, the way open /events/stream
+requests do, spread over --events events, then publishes changes to
+those events and reports how long each takes to reach every queue
+subscribed to it, and the memory held by the subscriptions.
+
+The local broker delivers in process, as in tests. With --broker
+unix, changes go through a UnixSocketBroker in a temporary
+directory and come back through its receiving thread, as they do
+between Gunicorn workers.
+
+    python bench/push_fanout.py --subscribers 10000 --events 100
+
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from api.push import PushHub, LocalBroker, UnixSocketBroker, PUSH_MAX_EVENTS
+
+
+def max_rss():
+    """Return the peak memory of this process, in MB."""
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024.0 * 1024)
+    return rss / 1024.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--ids-per-stream", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--broker", choices=("local", "unix"),
+                        default="local")
+    args = parser.parse_args()
+
+    socket_dir = None
+    if args.broker == "unix":
+        socket_dir = tempfile.mkdtemp()
+        broker = UnixSocketBroker(socket_dir)
+    else:
+        broker = LocalBroker()
+
+    hub = PushHub(broker)
+    rng = random.Random(481)
+    ids_per_stream = min(args.ids_per_stream, args.events, PUSH_MAX_EVENTS)
+
+    rss_before = max_rss()
+    started = time.time()
+    queues = {}
+    for i in range(args.subscribers):
+        event_ids = rng.sample(range(args.events), ids_per_stream)
+        q = hub.subscribe(event_ids)
+        for event_id in event_ids:
+            queues.setdefault(event_id, []).append(q)
+    subscribe_time = time.time() - started
+
+    print("subscribed %d streams to %d events each in %.3fs, "
+          "%.1f MB more peak memory" % (args.subscribers, ids_per_stream,
+                                        subscribe_time,
+                                        max_rss() - rss_before))
+
+    latencies = []
+    publish_times = []
+    for i in range(args.messages):
+        event_id = rng.randrange(args.events)
+        message = {"type": "volunteers", "event_id": event_id,
+                   "current_num_volunteers": i, "max_volunteers_needed": 0}
+
+        started = time.time()
+        hub.publish(event_id, message)
+        publish_times.append(time.time() - started)
+
+        # Wait for the last queue to get it, then empty them all
+        subscribed = queues.get(event_id, [])
+        for q in subscribed:
+            q.get(timeout=5)
+        latencies.append(time.time() - started)
+
+    print("publish, on the request thread: median %.3fms, p99 %.3fms" % (
+        percentile(publish_times, 0.5) * 1000,
+        percentile(publish_times, 0.99) * 1000))
+    print("delivered to every subscriber: median %.3fms, p99 %.3fms, "
+          "%.0f streams per event" % (
+              percentile(latencies, 0.5) * 1000,
+              percentile(latencies, 0.99) * 1000,
+              float(args.subscribers * ids_per_stream) / args.events))
+
+    if socket_dir is not None:
+        shutil.rmtree(socket_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Compare the Whoosh and SQLite FTS5 search backends on generated events.
+
+Builds each backend's index of --events generated events in a
+temporary directory, and reports:
+
+- the time taken by rebuild, which is what `manage.py rebuild-index`
+  runs,
+- the time taken to add --updates events one at a time, as the job
+  workers do when events change,
+- the latency of --queries searches, with and without a location,
+  ranked as EventList.get ranks them,
+- the size of the index on disk.
+
+    python bench/search_backends.py --events 100000 --queries 500
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from api.fts import Fts5Index
+from api.shards import ShardedIndex
+from api.ranking import Ranker
+from models.models import Event
+
+WORDS = ("food bank park cleanup tutoring reading shelter animal garden "
+         "river trail library senior center youth soccer coaching blood "
+         "drive habitat build meal delivery clothing sort recycling beach "
+         "church school museum hospital hospice refugee literacy").split()
+"""Vocabulary the names and descriptions of the events are drawn from."""
+
+ORGANIZATIONS = ["org%d" % i for i in range(200)]
+
+CENTER = (42.28, -83.74)
+"""Location the events are spread around, Ann Arbor."""
+
+
+class GeneratedEvent(object):
+
+    """Stand-in for an Event row, with the columns the indexes read."""
+
+    def __init__(self, event_id, rng, now):
+        self.id = event_id
+        self.name = " ".join(rng.sample(WORDS, 3))
+        self.description = " ".join(rng.choice(WORDS) for i in range(20))
+        self.organization = rng.choice(ORGANIZATIONS)
+        self.lat = CENTER[0] + rng.uniform(-2, 2)
+        self.lon = CENTER[1] + rng.uniform(-2, 2)
+        self.start_date = now + timedelta(days=rng.randint(-30, 90))
+        self.max_volunteers_needed = rng.randint(1, 50)
+        self.current_num_volunteers = rng.randint(0,
+                                                  self.max_volunteers_needed)
+
+
+def disk_size(path):
+    """Return the bytes used by a file or the files below a directory."""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for directory, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def run_queries(index, queries, limit):
+    """Return the latencies of the queries, with and without a location."""
+
+    plain = []
+    located = []
+    for query, radius in queries:
+        if radius is None:
+            ranker = Ranker()
+            started = time.time()
+            index.search(query, limit, ranker=ranker)
+            plain.append(time.time() - started)
+        else:
+            ranker = Ranker(located=True)
+            started = time.time()
+            index.search(query, limit, CENTER[0], CENTER[1], radius, ranker)
+            located.append(time.time() - started)
+    return plain, located
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--backend", choices=("whoosh", "fts5", "both"),
+                        default="both")
+    args = parser.parse_args()
+
+    rng = random.Random(481)
+    now = datetime.now()
+    events = [GeneratedEvent(i, rng, now) for i in range(1, args.events + 1)]
+    updates = [GeneratedEvent(rng.randint(1, args.events), rng, now)
+               for i in range(args.updates)]
+    queries = [(" ".join(rng.sample(WORDS, rng.randint(1, 2))),
+                rng.choice([None, 10, 25, 50]))
+               for i in range(args.queries)]
+
+    base = tempfile.mkdtemp()
+    backends = []
+    if args.backend in ("whoosh", "both"):
+        backends.append(("whoosh", os.path.join(base, "whoosh"),
+                         lambda path: ShardedIndex(path,
+                                                   Event.__searchable__)))
+    if args.backend in ("fts5", "both"):
+        backends.append(("fts5", os.path.join(base, "events.sqlite3"),
+                         lambda path: Fts5Index(path, Event.__searchable__)))
+
+    try:
+        for name, path, create in backends:
+            index = create(path)
+
+            started = time.time()
+            index.rebuild(events)
+            build = time.time() - started
+
+            locations = dict((event.id, (event.lat, event.lon))
+                             for event in events)
+            started = time.time()
+            for event in updates:
+                index.add(event, locations[event.id])
+                locations[event.id] = (event.lat, event.lon)
+            update = (time.time() - started) / max(len(updates), 1)
+
+            # Once to warm up caches, then measured
+            run_queries(index, queries, args.limit)
+            plain, located = run_queries(index, queries, args.limit)
+
+            size = disk_size(path)
+            if name == "fts5" and os.path.exists(path + "-wal"):
+                size += disk_size(path + "-wal")
+
+            print("%s:" % name)
+            print("  rebuild of %d events: %.2fs" % (args.events, build))
+            print("  update of one event: %.1fms" % (update * 1000))
+            for kind, latencies in (("without location", plain),
+                                    ("with location", located)):
+                if len(latencies) > 0:
+                    print("  search %s: median %.2fms, p99 %.2fms" % (
+                        kind, percentile(latencies, 0.5) * 1000,
+                        percentile(latencies, 0.99) * 1000))
+            print("  index size: %.1f MB" % (size / (1024.0 * 1024)))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
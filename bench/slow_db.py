@@ -0,0 +1,149 @@
+"""Load test of Gunicorn workers serving requests that wait on MySQL.
+
+This module is both a WSGI app standing in for a route with a slow
+query, each request running SELECT SLEEP(delay) on MySQL, and a
+client sending it many requests at once and reporting throughput.
+
+Serve the app with the API's Gunicorn config, in the default mode
+and then in cooperative mode:
+
+    gunicorn -c gunicorn_config.py --pythonpath bench slow_db:app
+    VOLUNTEER_COOPERATIVE=1 gunicorn -c gunicorn_config.py --pythonpath bench slow_db:app
+
+and run the client against each:
+
+    python bench/slow_db.py --concurrency 200 --requests 2000
+
+Sync workers serve one request each at a time, so throughput is
+capped at workers / delay requests per second. Gevent workers keep
+serving while requests wait on the database, until MySQL's
+max_connections is reached.
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from globals import COOPERATIVE
+
+if COOPERATIVE and __name__ != "__main__":
+
+    # Same as wsgi.py
+    from gevent import monkey
+    monkey.patch_all()
+
+    import pymysql
+    pymysql.install_as_MySQLdb()
+
+try:
+    from urllib2 import urlopen
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.parse import parse_qs
+
+SLOW_DB_DELAY = 0.1
+"""Default seconds each request waits on MySQL."""
+
+
+def app(environ, start_response):
+    """Run SELECT SLEEP(delay) and respond with the worker's pid.
+
+    URL parameters:
+    - delay: seconds to sleep in MySQL, SLOW_DB_DELAY by default
+
+    """
+
+    import MySQLdb
+
+    params = parse_qs(environ.get("QUERY_STRING", ""))
+    delay = float(params.get("delay", [SLOW_DB_DELAY])[0])
+
+    # A connection per request, like flask_mysqldb
+    conn = MySQLdb.connect(host=os.environ.get("MYSQL_HOST", "localhost"),
+                           user=os.environ.get("MYSQL_USER", "root"),
+                           passwd=os.environ.get("MYSQL_PASSWORD", ""))
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT SLEEP(%s)", (delay,))
+        cur.fetchall()
+    finally:
+        conn.close()
+
+    body = ("%d\n" % os.getpid()).encode("utf-8")
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def run_client(url, concurrency, requests):
+    """Send requests to url from concurrency threads.
+
+    Returns the latencies of the successful requests, the number of
+    failures and the total time taken.
+
+    """
+
+    lock = threading.Lock()
+    latencies = []
+    failures = [0]
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+
+            started = time.time()
+            try:
+                urlopen(url, timeout=60).read()
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                continue
+
+            with lock:
+                latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, failures[0], time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8889/")
+    parser.add_argument("--delay", type=float, default=SLOW_DB_DELAY)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    url = "%s?delay=%s" % (args.url, args.delay)
+    latencies, failures, elapsed = run_client(url, args.concurrency,
+                                              args.requests)
+
+    latencies.sort()
+    print("%d requests, %d failed, in %.2fs: %.1f requests/s" % (
+        args.requests, failures, elapsed, len(latencies) / elapsed))
+    if len(latencies) > 0:
+        print("latency: median %.0fms, p99 %.0fms" % (
+            latencies[len(latencies) // 2] * 1000,
+            latencies[min(int(len(latencies) * 0.99),
+                          len(latencies) - 1)] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,10 @@ UPLOAD_FOLDER = "static/images/profile_pics"
 EVENT_PIC_UPLOAD_FOLDER = "static/images/event_pics"
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 
+# Run with gevent workers and the PyMySQL driver so that requests
+# waiting on I/O share a worker. See wsgi.py and gunicorn_config.py.
+COOPERATIVE = os.environ.get("VOLUNTEER_COOPERATIVE") == "1"
+
 # If server software environment variable is not set,
 # then we currently running on localhost
 if os.environ.get("SERVER_SOFTWARE") is None:
@@ -0,0 +1,14 @@
+import multiprocessing
+
+from globals import COOPERATIVE
+
+# Nginx forwards requests to this address
+bind = "127.0.0.1:8889"
+workers = multiprocessing.cpu_count() * 2 + 1
+
+if COOPERATIVE:
+
+    # Each gevent worker serves many requests at once, switching
+    # between them whenever one waits on the database or a socket.
+    worker_class = "gevent"
+    worker_connections = 1000
@@ -0,0 +1,250 @@
+import json
+import time
+import sqlite3
+from collections import namedtuple
+
+from flask import current_app
+
+TASKS = {}
+"""Functions that can be run as jobs, by name."""
+
+Job = namedtuple("Job", ["id", "name", "args", "attempts", "created_at"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  args TEXT NOT NULL,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_at REAL NOT NULL,
+  created_at REAL NOT NULL,
+  started_at REAL,
+  heartbeat_at REAL,
+  finished_at REAL,
+  error TEXT
+);
+CREATE INDEX IF NOT EXISTS job_ready ON job (status, run_at);
+"""
+
+
+def task(f):
+    """Decorator to register a function that can be run as a job."""
+
+    TASKS[f.__name__] = f
+    return f
+
+
+def enqueue(name, *args):
+    """Queue a job on the current application's job queue."""
+
+    current_app.extensions['jobs'].enqueue(name, *args)
+
+
+class JobQueue(object):
+
+    """Queue of jobs persisted in a local SQLite file.
+
+    Jobs are run by the worker processes started with
+    ``python manage.py jobs work``. A job that raises is retried
+    with exponential backoff, up to max_attempts times, and then
+    left as failed.
+
+    If eager is set, jobs are run right away when they are queued
+    instead, which is handy for development and tests.
+
+    """
+
+    def __init__(self, path=None, max_attempts=5, backoff=2, eager=False):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.eager = eager
+
+    def init_app(self, app):
+        self.path = app.config['JOBS_DATABASE']
+        self.max_attempts = app.config['JOBS_MAX_ATTEMPTS']
+        self.backoff = app.config['JOBS_RETRY_BACKOFF']
+        self.eager = app.config['JOBS_EAGER']
+        app.extensions['jobs'] = self
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+
+        # WAL lets workers claim jobs while requests queue them.
+        # It is kept in the file, so only needs setting once.
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        # Queues created before jobs sent heartbeats
+        columns = [row["name"] for row
+                   in conn.execute("PRAGMA table_info(job)")]
+        if "heartbeat_at" not in columns:
+            conn.execute("ALTER TABLE job ADD COLUMN heartbeat_at REAL")
+        conn.close()
+
+        # Report queue depth and job latency with the other metrics.
+        # Imported here so the queue can be used without the API.
+        from api.metrics import metrics
+        metrics.gauge("jobs", self.stats)
+
+    def _connect(self):
+        # Connections are opened per operation, so they are
+        # never shared between threads or forked processes.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        # With WAL, a commit is durable once the log is synced at a
+        # checkpoint, which saves an fsync on every queued job.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def enqueue(self, name, *args):
+        if name not in TASKS:
+            raise KeyError("Unknown task: %s" % name)
+
+        if self.eager:
+            TASKS[name](*args)
+            return
+
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT INTO job (name, args, status, run_at, created_at) \
+                     VALUES (?, ?, 'queued', ?, ?)",
+                     (name, json.dumps(args), now, now))
+        conn.close()
+
+    def claim(self):
+        """Mark the next job that is due as running and return it.
+
+        Returns None if no job is due.
+
+        """
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            # Take the write lock before looking, so that two
+            # workers can't claim the same job.
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, name, args, attempts, created_at \
+                               FROM job WHERE status='queued' AND run_at<=? \
+                               ORDER BY run_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute("UPDATE job SET status='running', started_at=?, \
+                         heartbeat_at=?, attempts=attempts+1 WHERE id=?",
+                         (now, now, row["id"]))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return Job(row["id"], row["name"], json.loads(row["args"]),
+                   row["attempts"] + 1, row["created_at"])
+
+    def complete(self, job):
+        conn = self._connect()
+        conn.execute("UPDATE job SET status='done', finished_at=?, error=NULL \
+                     WHERE id=?", (time.time(), job.id))
+        conn.close()
+
+    def fail(self, job, error):
+        """Schedule a retry of a failed job, or give up on it."""
+
+        now = time.time()
+        conn = self._connect()
+        if job.attempts < self.max_attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            conn.execute("UPDATE job SET status='queued', run_at=?, error=? \
+                         WHERE id=?", (now + delay, error, job.id))
+        else:
+            conn.execute("UPDATE job SET status='failed', finished_at=?, \
+                         error=? WHERE id=?", (now, error, job.id))
+        conn.close()
+
+    def heartbeat(self, job):
+        """Record that a running job is still being worked on."""
+
+        conn = self._connect()
+        conn.execute("UPDATE job SET heartbeat_at=? \
+                     WHERE id=? AND status='running'", (time.time(), job.id))
+        conn.close()
+
+    def requeue_stale(self, timeout):
+        """Put back jobs left running by a worker that died.
+
+        Jobs are stale once their worker hasn't sent a heartbeat
+        for timeout seconds, however long they have been running.
+        Returns the number of jobs put back.
+
+        """
+
+        conn = self._connect()
+        cur = conn.execute("UPDATE job SET status='queued', run_at=? \
+                           WHERE status='running' AND \
+                           IFNULL(heartbeat_at, started_at)<?",
+                           (time.time(), time.time() - timeout))
+        conn.close()
+        return cur.rowcount
+
+    def retry(self, job_id):
+        """Queue a failed job to run again. Returns False if not found."""
+
+        conn = self._connect()
+        cur = conn.execute("UPDATE job SET status='queued', run_at=?, \
+                           attempts=0 WHERE id=? AND status='failed'",
+                           (time.time(), job_id))
+        conn.close()
+        return cur.rowcount > 0
+
+    def purge(self, older_than):
+        """Delete finished jobs older than the given number of seconds."""
+
+        conn = self._connect()
+        cur = conn.execute("DELETE FROM job WHERE status IN ('done', 'failed') \
+                           AND finished_at<?", (time.time() - older_than,))
+        conn.close()
+        return cur.rowcount
+
+    def jobs(self, status=None, limit=20):
+        """Return the most recent jobs, optionally with the given status."""
+
+        conn = self._connect()
+        if status is None:
+            rows = conn.execute("SELECT * FROM job ORDER BY id DESC LIMIT ?",
+                                (limit,)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM job WHERE status=? \
+                                ORDER BY id DESC LIMIT ?",
+                                (status, limit)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    def stats(self, window=3600):
+        """Return queue depth by status and job latency.
+
+        Latencies are averages over the jobs finished in the last
+        window seconds: wait is the time from queueing to the last
+        start, latency the time from queueing to finishing.
+
+        """
+
+        conn = self._connect()
+        stats = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        for status, count in conn.execute("SELECT status, COUNT(*) FROM job \
+                                          GROUP BY status"):
+            stats[status] = count
+
+        row = conn.execute("SELECT COUNT(*), AVG(started_at - created_at), \
+                           AVG(finished_at - created_at), \
+                           MAX(finished_at - created_at) FROM job \
+                           WHERE status='done' AND finished_at>?",
+                           (time.time() - window,)).fetchone()
+        conn.close()
+
+        stats["finished_recently"] = row[0]
+        stats["avg_wait"] = row[1]
+        stats["avg_latency"] = row[2]
+        stats["max_latency"] = row[3]
+        return stats
@@ -0,0 +1,87 @@
+import os
+
+from flask import current_app
+
+from jobs import task
+from models.models import db
+from models.queries import get_user, get_event
+from api import get_location_from_zip
+from api import feed
+from api.signals import user_saved
+
+
+@task
+def remove_file(path):
+    """Delete a file that is no longer referenced, like an old picture."""
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@task
+def index_event(event_id, previous=None):
+    """Bring an event's search index entry up to date."""
+
+    event = get_event(event_id)
+    if event is not None:
+        current_app.extensions['search'].add(event, previous)
+        current_app.extensions['search_cache'].bump()
+
+
+@task
+def unindex_event(event_id, lat, lon):
+    """Remove a deleted event from the search index."""
+
+    current_app.extensions['search'].remove(event_id, lat, lon)
+    current_app.extensions['search_cache'].bump()
+
+
+@task
+def resolve_user_location(user_id, zipcode):
+    """Set a user's zipcode and the coordinates it resolves to.
+
+    Invalid zipcodes are ignored, leaving the user's location as
+    it was.
+
+    """
+
+    coordinates = get_location_from_zip(int(zipcode))
+    if coordinates is None:
+        return
+
+    user = get_user(user_id)
+    if user is None:
+        return
+
+    user.lat = coordinates["lat"]
+    user.lon = coordinates["lon"]
+    user.zipcode = zipcode
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    user_saved.send(app, user=user, created=False)
+
+
+@task
+def update_event_feeds(event_id, previous=None):
+    """Apply a change to an event to the feeds of the users near it."""
+
+    event = get_event(event_id)
+    if event is not None:
+        feed.update_event_feeds(event, previous)
+
+
+@task
+def remove_event_from_feeds(event_id, lat, lon, zipcode):
+    """Remove a deleted event from the feeds of the users near it."""
+
+    feed.update_feeds(event_id=event_id, lat=lat, lon=lon, zipcode=zipcode)
+
+
+@task
+def rebuild_feed(user_id):
+    """Rebuild a user's feed after their zipcode changed."""
+
+    user = get_user(user_id)
+    if user is not None:
+        feed.rebuild_feed(user)
@@ -0,0 +1,83 @@
+import time
+import signal
+import threading
+import traceback
+import multiprocessing
+
+from jobs import TASKS
+
+STALE_JOB_TIMEOUT = 600
+"""Seconds without a heartbeat before a running job is taken as abandoned."""
+
+JOB_HEARTBEAT_INTERVAL = 60
+"""Seconds between the heartbeats of a running job."""
+
+
+def run_job(app, queue, job):
+    """Run a single job and record the outcome.
+
+    A thread sends heartbeats while the job runs, so that long jobs
+    aren't taken for abandoned and run a second time.
+
+    """
+
+    done = threading.Event()
+
+    def beat():
+        while not done.wait(JOB_HEARTBEAT_INTERVAL):
+            queue.heartbeat(job)
+
+    heartbeat = threading.Thread(target=beat)
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    try:
+        with app.app_context():
+            TASKS[job.name](*job.args)
+    except Exception:
+        queue.fail(job, traceback.format_exc())
+    else:
+        queue.complete(job)
+    finally:
+        done.set()
+
+
+def work_loop(app, queue, poll_interval):
+    """Run jobs as they become due, forever."""
+
+    # Let the supervisor handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        run_job(app, queue, job)
+
+
+def work(app, queue, processes, poll_interval=1.0):
+    """Run a pool of worker processes, restarting any that die."""
+
+    def start():
+        process = multiprocessing.Process(target=work_loop,
+                                          args=(app, queue, poll_interval))
+        process.daemon = True
+        process.start()
+        return process
+
+    pool = [start() for i in range(processes)]
+
+    try:
+        while True:
+            queue.requeue_stale(STALE_JOB_TIMEOUT)
+
+            for i, process in enumerate(pool):
+                if not process.is_alive():
+                    pool[i] = start()
+
+            time.sleep(10)
+    except KeyboardInterrupt:
+        for process in pool:
+            process.terminate()
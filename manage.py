@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Command line tasks for maintaining the API's derived data.
+
+Run from the repository root, for example:
+
+    python manage.py rebuild-index
+
+The background job workers are started with ``jobs work``.
+Commands like reconcile-org-stats, leaderboards and archive are meant
+to be run periodically from cron, and snapshot before restarting the
+API as well as periodically.
+
+"""
+
+from __future__ import print_function
+
+import os
+import argparse
+from datetime import datetime, timedelta
+
+from wsgi import app
+from models.models import Event, ArchivedEvent
+from api.zipcodes import build_zip_neighbors
+from api.analytics import reconcile_organization_stats
+from api.archive import archive_events
+from api.leaderboard import write_leaderboards
+from api.snapshot import ZipSnapshot, EventSnapshot
+from jobs.worker import work
+
+
+def rebuild_index(args):
+    """Rebuild the event search index from the database."""
+
+    with app.app_context():
+        if args.archive:
+            events = ArchivedEvent.query.yield_per(args.batch_size)
+            count = app.extensions['archive_search'].rebuild(events)
+        else:
+            events = Event.query.yield_per(args.batch_size)
+            count = app.extensions['search'].rebuild(events)
+
+    print("Indexed %d events." % count)
+
+
+def build_zip_neighbor_table(args):
+    """Precompute the zipcodes near each zipcode for radius searches."""
+
+    with app.app_context():
+        rows = build_zip_neighbors(app.mysql.connection)
+
+    print("Wrote %d zipcode neighbors." % rows)
+
+
+def reconcile_org_stats(args):
+    """Recompute the organization analytics counters from the source tables."""
+
+    with app.app_context():
+        count = reconcile_organization_stats(app.mysql.connection)
+
+    print("Reconciled %d organizations." % count)
+
+
+def archive(args):
+    """Move events that ended a while ago to the archive."""
+
+    grace_days = args.grace_days
+    if grace_days is None:
+        grace_days = app.config['ARCHIVE_GRACE_DAYS']
+    cutoff = datetime.now() - timedelta(days=grace_days)
+
+    count = 0
+    with app.app_context():
+        cache = app.extensions['cache']
+        search_index = app.extensions['search']
+        archive_index = app.extensions['archive_search']
+
+        for events in archive_events(app.mysql.connection, cutoff,
+                                     args.batch_size):
+            for e in events:
+                cache.delete("event:%d" % e["id"])
+            search_index.remove_many([(e["id"], e["lat"], e["lon"])
+                                      for e in events])
+            archive_index.add_many(ArchivedEvent.query.filter(
+                ArchivedEvent.id.in_([e["id"] for e in events])))
+            count += len(events)
+
+    print("Archived %d events." % count)
+
+
+def leaderboards(args):
+    """Write the rows the API workers reload their leaderboards from."""
+
+    path = os.path.join(app.config['SNAPSHOT_DIR'], "leaderboards.json")
+    with app.app_context():
+        count = write_leaderboards(path)
+
+    print("Wrote the leaderboards of %d users." % count)
+
+
+def snapshot(args):
+    """Write the zipcode and event location snapshots loaded by workers."""
+
+    directory = app.config['SNAPSHOT_DIR']
+    with app.app_context():
+        conn = app.mysql.connection
+        zipcodes = ZipSnapshot.build(conn,
+            os.path.join(directory, "zipcodes.snapshot"))
+        events = EventSnapshot.build(conn,
+            os.path.join(directory, "events.snapshot"))
+
+    print("Wrote %d zipcodes and %d events." % (zipcodes, events))
+
+
+def jobs(args):
+    """Run, inspect and manage the background jobs."""
+
+    queue = app.extensions['jobs']
+
+    if args.action == "work":
+        work(app, queue, args.processes)
+
+    elif args.action == "stats":
+        for name, value in sorted(queue.stats().items()):
+            print("%s: %s" % (name, value))
+
+    elif args.action == "list":
+        for job in queue.jobs(args.status, args.limit):
+            created = datetime.fromtimestamp(job["created_at"])
+            print("%d %s %s attempts=%d created=%s" % (job["id"], job["name"],
+                  job["status"], job["attempts"], created.strftime("%c")))
+            if args.verbose and job["error"] is not None:
+                print(job["error"])
+
+    elif args.action == "retry":
+        for job_id in args.ids:
+            if not queue.retry(job_id):
+                print("Job %d is not a failed job." % job_id)
+
+    elif args.action == "purge":
+        count = queue.purge(args.days * 86400)
+        print("Purged %d jobs." % count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser("rebuild-index", help=rebuild_index.__doc__)
+    command.add_argument("--batch-size", type=int, default=500)
+    command.add_argument("--archive", action="store_true",
+                         help="rebuild the index of archived events instead")
+    command.set_defaults(func=rebuild_index)
+
+    command = commands.add_parser("build-zip-neighbors",
+                                  help=build_zip_neighbor_table.__doc__)
+    command.set_defaults(func=build_zip_neighbor_table)
+
+    command = commands.add_parser("reconcile-org-stats",
+                                  help=reconcile_org_stats.__doc__)
+    command.set_defaults(func=reconcile_org_stats)
+
+    command = commands.add_parser("archive", help=archive.__doc__)
+    command.add_argument("--batch-size", type=int, default=500)
+    command.add_argument("--grace-days", type=int,
+                         help="days after their end that events are kept")
+    command.set_defaults(func=archive)
+
+    command = commands.add_parser("leaderboards", help=leaderboards.__doc__)
+    command.set_defaults(func=leaderboards)
+
+    command = commands.add_parser("snapshot", help=snapshot.__doc__)
+    command.set_defaults(func=snapshot)
+
+    command = commands.add_parser("jobs", help=jobs.__doc__)
+    actions = command.add_subparsers(dest="action")
+    actions.required = True
+    action = actions.add_parser("work", help="start the worker processes")
+    action.add_argument("--processes", type=int, default=2)
+    actions.add_parser("stats", help="show queue depth and job latency")
+    action = actions.add_parser("list", help="list recent jobs")
+    action.add_argument("--status",
+                        choices=["queued", "running", "done", "failed"])
+    action.add_argument("--limit", type=int, default=20)
+    action.add_argument("--verbose", action="store_true",
+                        help="also show the last error of each job")
+    action = actions.add_parser("retry", help="run failed jobs again")
+    action.add_argument("ids", type=int, nargs="+")
+    action = actions.add_parser("purge", help="delete old finished jobs")
+    action.add_argument("--days", type=int, default=7)
+    command.set_defaults(func=jobs)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
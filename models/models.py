@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 
 from flask.ext.sqlalchemy import SQLAlchemy
@@ -7,10 +8,13 @@ from flask.ext.security import (Security, SQLAlchemyUserDatastore,
 from itsdangerous import (TimedJSONWebSignatureSerializer
     as Serializer, BadSignature, SignatureExpired)
 
+from models.routing import RoutingSQLAlchemy
+
 # We won't initialize the datastore yet, we'll let the 
 # application do it. This allows multiple applications to
-# share this models file.
-db = SQLAlchemy()
+# share this models file. Reads made by GET requests are
+# routed to read replicas when any are configured.
+db = RoutingSQLAlchemy()
 
 # Define necessary relationary tables
 roles_users = db.Table('roles_users',
@@ -25,6 +29,10 @@ events_users = db.Table('events_users',
     db.Column('user_id', db.Integer(), db.ForeignKey('user.id')),
     db.Column('event_id', db.Integer(), db.ForeignKey('event.id')))
 
+events_users_archive = db.Table('events_users_archive',
+    db.Column('user_id', db.Integer()),
+    db.Column('event_id', db.Integer()))
+
 class Role(db.Model, RoleMixin):
 
     """Class to define user roles.
@@ -86,19 +94,23 @@ class User(db.Model, UserMixin):
             'lon': self.lon
        }
 
+    # Each event serializes its skills, so they are loaded
+    # up front instead of with one query per event. The queries
+    # are baked, see models/queries.py, which imports this module.
     @property
     def serialize_created_events(self):
-        return [ event.serialize for event in self.created_events]
+        from models import queries
+        return [ event.serialize for event in queries.created_events(self.id)]
 
     @property
     def serialize_upcoming_events(self):
-        upcoming = self.attending_events.filter(Event.end_date > datetime.now())  
-        return [ event.serialize for event in upcoming]
+        from models import queries
+        return [ event.serialize for event in queries.upcoming_events(self.id)]
 
     @property
     def serialize_recent_events(self):
-        recent = self.attending_events.filter(Event.end_date < datetime.now())    
-        return [event.serialize for event in recent]
+        from models import queries
+        return [event.serialize for event in queries.recent_events(self.id)]
 
     def generate_auth_token(self, app, expiration = 600):
         s = Serializer(app.config['SECRET_KEY'])
@@ -108,12 +120,12 @@ class Event(db.Model):
 
     """Class to represent events
 
-    This class is indexed by WhooshAlchemy and is 
-    thus searchable.
+    This class is indexed by the search index of
+    api/search.py and is thus searchable.
 
     """
 
-    # Define searchable fields to be indexed by WhooshAlchemy
+    # Define searchable fields to be indexed by Whoosh
     __tablename__ = 'event'
     __searchable__ = ['description', 'organization', 'name']
 
@@ -209,3 +221,110 @@ class Skill(db.Model):
     def __init__(self, name):
         self.name=name
 
+class EventTombstone(db.Model):
+
+    """Class to record the deletion of an event.
+
+    Events are removed from the event table outright, whether
+    deleted or archived, so a tombstone is the only trace a syncing
+    client can use to learn that an event it has cached no longer
+    exists.
+
+    """
+
+    __tablename__ = 'event_tombstone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer)
+    deleted_date = db.Column(db.DateTime())
+
+    def __init__(self, event_id, deleted_date):
+        self.event_id = event_id
+        self.deleted_date = deleted_date
+
+class UserFeed(db.Model):
+
+    """Class to store a user's materialized feed of nearby events.
+
+    Entries are a JSON list of [event id, distance in miles] pairs,
+    nearest first, for upcoming events with open slots near the
+    zipcode the feed was built for.
+
+    """
+
+    __tablename__ = 'user_feed'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    zipcode = db.Column(db.Integer)
+    entries = db.Column(db.Text)
+    updated_date = db.Column(db.DateTime())
+
+class ArchivedEvent(db.Model):
+
+    """Class to represent events moved out of the event table.
+
+    Events are archived some time after they end, see
+    api/archive.py. Their skills are kept as a JSON list of names,
+    and their sign-ups in events_users_archive. Archived events are
+    indexed in their own, cold, search index.
+
+    """
+
+    __tablename__ = 'event_archive'
+    __searchable__ = ['description', 'organization', 'name']
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(255))
+    short_desc = db.Column(db.String(255))
+    organization = db.Column(db.String(255))
+    description = db.Column(db.String(255))
+    start_date = db.Column(db.DateTime())
+    end_date = db.Column(db.DateTime())
+    max_volunteers_needed = db.Column(db.Integer)
+    current_num_volunteers = db.Column(db.Integer)
+    close_date = db.Column(db.DateTime())
+    creator_id = db.Column(db.Integer)
+    created_date = db.Column(db.DateTime())
+    last_updated_date = db.Column(db.DateTime())
+    pic_url = db.Column(db.String(255))
+    street_addr = db.Column(db.String(255))
+    city = db.Column(db.String(255))
+    state = db.Column(db.String(255))
+    zipcode = db.Column(db.String(10))
+    lat = db.Column(db.Float(precision="20,17"))
+    lon = db.Column(db.Float(precision="20,17"))
+    skills = db.Column(db.Text)
+    archived_date = db.Column(db.DateTime())
+
+    @property
+    def serialize(self):
+       """Return object data in the same format as live events"""
+
+       def date(value):
+           return value.strftime("%m/%d/%Y") if value is not None else None
+
+       return {
+            'id': self.id,
+            'name': self.name,
+            'short_desc': self.short_desc,
+            'description': self.description,
+            'organization': self.organization,
+            'start_date': date(self.start_date),
+            'end_date': date(self.end_date),
+            'current_num_volunteers': self.current_num_volunteers,
+            'max_volunteers_needed': self.max_volunteers_needed,
+            'skills': json.loads(self.skills or "[]"),
+            'close_date': date(self.close_date),
+            'creator_id': self.creator_id,
+            'street_addr': self.street_addr,
+            'city': self.city,
+            'state': self.state,
+            'zipcode': self.zipcode,
+            'created_date': date(self.created_date),
+            'last_updated_date': date(self.last_updated_date),
+            'lat': self.lat,
+            'lon': self.lon,
+            'pic_url': self.pic_url,
+            'archived': True
+       }
@@ -0,0 +1,112 @@
+from datetime import datetime
+
+from sqlalchemy import bindparam, inspect
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+
+from models.models import User, Event, events_users, db
+
+bakery = baked.bakery()
+"""Cache of the compiled SQL of the queries below.
+
+A baked query is only built and compiled the first time it runs,
+after which each call just binds its parameters. Keys are the
+code of the lambdas, so the queries must be defined once, here,
+and not inside the functions.
+
+"""
+
+_user_by_id = bakery(lambda session: session.query(User))
+_user_by_id += lambda q: q.filter(User.id == bindparam("id"))
+
+_user_by_email = bakery(lambda session: session.query(User))
+_user_by_email += lambda q: q.filter(User.email == bindparam("email"))
+
+_event_by_id = bakery(lambda session: session.query(Event))
+_event_by_id += lambda q: q.filter(Event.id == bindparam("id"))
+
+# Skills are joined in, since each serialized event includes them.
+# A subquery load would lose the parameters of a baked query.
+_created_events = bakery(lambda session: session.query(Event))
+_created_events += lambda q: q.filter(Event.creator_id == bindparam("user_id")) \
+    .options(joinedload(Event.skills))
+
+_attending_events = bakery(lambda session: session.query(Event))
+_attending_events += lambda q: q \
+    .join(events_users, events_users.c.event_id == Event.id) \
+    .filter(events_users.c.user_id == bindparam("user_id")) \
+    .options(joinedload(Event.skills))
+
+_upcoming_events = _attending_events.with_criteria(
+    lambda q: q.filter(Event.end_date > bindparam("now")))
+
+_recent_events = _attending_events.with_criteria(
+    lambda q: q.filter(Event.end_date < bindparam("now")))
+
+
+def _from_identity_map(session, model, pk):
+    """Return the instance with primary key pk if the session has it.
+
+    This is the check Query.get makes before querying, without
+    building a Query. Expired instances, such as every instance
+    after a commit, aren't returned, so that the caller's query
+    refreshes them or finds that they were deleted.
+
+    """
+
+    key = inspect(model).identity_key_from_primary_key([pk])
+    instance = session.identity_map.get(key)
+    if instance is None or inspect(instance).expired:
+        return None
+    return instance
+
+
+def _get_by_id(model, query, pk):
+    try:
+        pk = int(pk)
+    except (TypeError, ValueError):
+        return None
+
+    session = db.session()
+    instance = _from_identity_map(session, model, pk)
+    if instance is None:
+        instance = query(session).params(id=pk).first()
+    return instance
+
+
+def get_user(user_id):
+    """Return the user with the given id, or None."""
+
+    return _get_by_id(User, _user_by_id, user_id)
+
+
+def get_event(event_id):
+    """Return the event with the given id, or None."""
+
+    return _get_by_id(Event, _event_by_id, event_id)
+
+
+def get_user_by_email(email):
+    """Return the user with the given email, or None."""
+
+    return _user_by_email(db.session()).params(email=email).first()
+
+
+def created_events(user_id):
+    """Return the events created by a user."""
+
+    return _created_events(db.session()).params(user_id=user_id).all()
+
+
+def upcoming_events(user_id):
+    """Return the events a user signed up for that haven't ended."""
+
+    return _upcoming_events(db.session()) \
+        .params(user_id=user_id, now=datetime.now()).all()
+
+
+def recent_events(user_id):
+    """Return the events a user signed up for that have ended."""
+
+    return _recent_events(db.session()) \
+        .params(user_id=user_id, now=datetime.now()).all()
@@ -0,0 +1,215 @@
+import os
+import time
+import hashlib
+import threading
+from itertools import count
+
+from flask import request, current_app, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+
+USE_PRIMARY = "volunteer.use_primary"
+"""WSGI environ key making a GET request read from the primary."""
+
+PIN_KEY = "primary:%s"
+"""Shared cache key marking a client as reading from the primary."""
+
+
+def client_key():
+    """Return a key telling apart the clients of the API."""
+
+    token = request.headers.get("authorization")
+    if token is not None:
+        return hashlib.sha1(token.encode("utf-8")).hexdigest()
+    return request.remote_addr
+
+
+class ReplicaPool(object):
+
+    """Round robin pool of read replica engines with health checks.
+
+    Replicas are checked with a trivial query every check_interval
+    seconds by a background thread, and only healthy replicas are
+    handed out, so requests never wait on a check. Until the first
+    check is done, reads go to the primary. Engines are created by
+    the thread so that every forked worker opens its own
+    connections, and MySQL replicas that don't answer within
+    connect_timeout seconds are taken as down.
+
+    """
+
+    def __init__(self, uris, check_interval, connect_timeout):
+        self.uris = uris
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.engines = None
+        self.healthy = []
+        self.counter = count()
+        self.lock = threading.Lock()
+        self.check_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+
+    def get(self):
+        """Return a healthy replica engine, or None if there is none."""
+
+        self._ensure_checker()
+
+        healthy = self.healthy
+        if len(healthy) == 0:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+    def _ensure_checker(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self.thread is None or self.thread_pid != os.getpid():
+            with self.lock:
+                if self.thread is None or self.thread_pid != os.getpid():
+                    # Engines of the parent process can't be shared
+                    if self.thread_pid is not None:
+                        self.engines = None
+                        self.healthy = []
+
+                    self.thread = threading.Thread(target=self._check_loop)
+                    self.thread.daemon = True
+                    self.thread_pid = os.getpid()
+                    self.thread.start()
+
+    def _check_loop(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def _create_engine(self, uri):
+        url = make_url(uri)
+        connect_args = {}
+        if url.drivername.startswith("mysql"):
+            connect_args["connect_timeout"] = self.connect_timeout
+        return create_engine(url, connect_args=connect_args)
+
+    def check(self):
+        """Check every replica and update the list of healthy ones."""
+
+        with self.check_lock:
+            if self.engines is None:
+                self.engines = [self._create_engine(uri)
+                                for uri in self.uris]
+
+            healthy = []
+            for engine in self.engines:
+                try:
+                    conn = engine.connect()
+                    conn.execute("SELECT 1")
+                    conn.close()
+                    healthy.append(engine)
+                except Exception:
+                    pass
+
+            self.healthy = healthy
+
+
+class RoutingSession(SignallingSession):
+
+    """Session sending the reads of GET requests to read replicas.
+
+    Everything else goes to the primary: writes, all queries made
+    while handling other methods, and any read made after this
+    session has started flushing, so that a request reads its own
+    writes. Requests can also ask for the primary by setting
+    USE_PRIMARY in their WSGI environ.
+
+    Clients also read from the primary for a few seconds after any
+    request other than a GET, see RoutingSQLAlchemy.pin.
+
+    """
+
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.db = db
+        self.use_primary = False
+        self.pinned = None
+        event.listen(self, "before_flush", self.on_before_flush)
+
+    def on_before_flush(self, session, flush_context, instances):
+        self.use_primary = True
+
+    def _reads_from_replica(self):
+        if self.use_primary or not has_request_context():
+            return False
+
+        if request.method not in ('GET', 'HEAD') or \
+           request.environ.get(USE_PRIMARY):
+            return False
+
+        # Sessions last a request, so this is checked once per request
+        if self.pinned is None:
+            self.pinned = self.db.is_pinned(self.app)
+        return not self.pinned
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reads_from_replica():
+            engine = self.db.get_replica(self.app)
+            if engine is not None:
+                return engine
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    """SQLAlchemy extension routing reads to replicas.
+
+    Replicas are configured with the SQLALCHEMY_REPLICA_URIS list.
+    Without any, every query goes to SQLALCHEMY_DATABASE_URI.
+
+    """
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 10)
+        app.config.setdefault('SQLALCHEMY_REPLICA_CONNECT_TIMEOUT', 2)
+        app.config.setdefault('SQLALCHEMY_REPLICA_PIN_SECONDS', 5)
+
+        uris = app.config['SQLALCHEMY_REPLICA_URIS']
+        if len(uris) > 0:
+            app.extensions['replicas'] = ReplicaPool(
+                uris, app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'],
+                app.config['SQLALCHEMY_REPLICA_CONNECT_TIMEOUT'])
+            app.after_request(self.pin)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_replica(self, app):
+        pool = app.extensions.get('replicas')
+        if pool is None:
+            return None
+        return pool.get()
+
+    def pin(self, response):
+        """Send the client's reads to the primary for a few seconds.
+
+        Run after every request other than a GET, so that clients
+        read their own writes, wherever they were made, until the
+        replicas have caught up with them.
+
+        """
+
+        app = current_app._get_current_object()
+        cache = app.extensions.get('cache')
+
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and \
+           cache is not None:
+            cache.set(PIN_KEY % client_key(), True,
+                      app.config['SQLALCHEMY_REPLICA_PIN_SECONDS'])
+        return response
+
+    def is_pinned(self, app):
+        cache = app.extensions.get('cache')
+        if cache is None:
+            return False
+        return cache.get(PIN_KEY % client_key()) is not None
@@ -18,7 +18,8 @@ CREATE TABLE user (
   lat float(20,17) DEFAULT NULL,
   lon float(20,17) DEFAULT NULL,
   PRIMARY KEY (id),
-  UNIQUE KEY email (email)
+  UNIQUE KEY email (email),
+  KEY zipcode (zipcode)
 );
 
 CREATE TABLE event (
@@ -44,6 +45,10 @@ CREATE TABLE event (
   lon float(20,17) DEFAULT NULL,
   PRIMARY KEY (id),
   KEY creator_id (creator_id),
+  KEY created_date (created_date),
+  KEY last_updated_date (last_updated_date),
+  KEY zipcode (zipcode),
+  KEY end_date (end_date),
   CONSTRAINT event_ibfk_1 FOREIGN KEY (creator_id) REFERENCES user (id)
 );
 
@@ -86,4 +91,82 @@ CREATE TABLE skills_events (
   KEY skills_events_ibfk_2 (event_id),
   CONSTRAINT skills_events_ibfk_1 FOREIGN KEY (skill_id) REFERENCES skill (id),
   CONSTRAINT skills_events_ibfk_2 FOREIGN KEY (event_id) REFERENCES event (id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+CREATE TABLE event_tombstone (
+  id int(11) NOT NULL AUTO_INCREMENT,
+  event_id int(11) NOT NULL,
+  deleted_date datetime DEFAULT NULL,
+  PRIMARY KEY (id),
+  KEY deleted_date (deleted_date)
+);
+
+CREATE TABLE zip_neighbor (
+  zipcode int(5) NOT NULL,
+  neighbor int(5) NOT NULL,
+  radius smallint(6) NOT NULL,
+  PRIMARY KEY (zipcode, radius, neighbor)
+);
+
+CREATE TABLE user_feed (
+  user_id int(11) NOT NULL,
+  zipcode int(5) DEFAULT NULL,
+  entries text,
+  updated_date datetime DEFAULT NULL,
+  PRIMARY KEY (user_id),
+  CONSTRAINT user_feed_ibfk_1 FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE
+);
+
+CREATE TABLE organization_stats (
+  organization varchar(255) NOT NULL,
+  num_events int(11) NOT NULL DEFAULT '0',
+  total_capacity int(11) NOT NULL DEFAULT '0',
+  total_signups int(11) NOT NULL DEFAULT '0',
+  upcoming_events int(11) NOT NULL DEFAULT '0',
+  upcoming_capacity int(11) NOT NULL DEFAULT '0',
+  upcoming_signups int(11) NOT NULL DEFAULT '0',
+  reconciled_date datetime DEFAULT NULL,
+  PRIMARY KEY (organization)
+);
+
+CREATE TABLE organization_signups_daily (
+  organization varchar(255) NOT NULL,
+  day date NOT NULL,
+  signups int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (organization, day)
+);
+
+CREATE TABLE event_archive (
+  id int(11) NOT NULL,
+  name varchar(255) DEFAULT NULL,
+  short_desc varchar(255) DEFAULT NULL,
+  description varchar(255) DEFAULT NULL,
+  start_date datetime DEFAULT NULL,
+  end_date datetime DEFAULT NULL,
+  max_volunteers_needed int(11) DEFAULT NULL,
+  current_num_volunteers int(11) DEFAULT NULL,
+  close_date datetime DEFAULT NULL,
+  creator_id int(11) DEFAULT NULL,
+  created_date datetime DEFAULT NULL,
+  last_updated_date datetime DEFAULT NULL,
+  pic_url varchar(255) DEFAULT NULL,
+  street_addr varchar(255) DEFAULT NULL,
+  city varchar(255) DEFAULT NULL,
+  state varchar(255) DEFAULT NULL,
+  zipcode varchar(10) DEFAULT NULL,
+  organization varchar(255) DEFAULT NULL,
+  lat float(20,17) DEFAULT NULL,
+  lon float(20,17) DEFAULT NULL,
+  skills text,
+  archived_date datetime DEFAULT NULL,
+  PRIMARY KEY (id),
+  KEY creator_id (creator_id),
+  KEY end_date (end_date)
+);
+
+CREATE TABLE events_users_archive (
+  event_id int(11) NOT NULL,
+  user_id int(11) NOT NULL,
+  PRIMARY KEY (user_id, event_id),
+  KEY event_id (event_id)
+);
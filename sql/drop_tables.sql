@@ -1,3 +1,10 @@
+DROP TABLE IF EXISTS events_users_archive;
+DROP TABLE IF EXISTS event_archive;
+DROP TABLE IF EXISTS organization_signups_daily;
+DROP TABLE IF EXISTS organization_stats;
+DROP TABLE IF EXISTS user_feed;
+DROP TABLE IF EXISTS zip_neighbor;
+DROP TABLE IF EXISTS event_tombstone;
 DROP TABLE IF EXISTS skills_events;
 DROP TABLE IF EXISTS skill;
 DROP TABLE IF EXISTS roles_users;
@@ -0,0 +1,137 @@
+"""Tests of the query budgets in strict mode, see api/query_budget.py.
+
+The routes run their statements on an in-memory SQLite database,
+which are counted the same way as those sent to MySQL.
+
+    python -m unittest discover tests
+
+"""
+
+import json
+import unittest
+
+from flask import Flask, current_app
+from flask_restful import Api, Resource
+from sqlalchemy import create_engine
+
+from api import query_budget
+from api.metrics import metrics
+from api.signals import signups_changed
+
+engine = create_engine("sqlite://")
+
+
+def run_queries(count, statement="SELECT %d"):
+    conn = engine.connect()
+    try:
+        for i in range(count):
+            conn.execute(statement % i)
+    finally:
+        conn.close()
+
+
+class WithinBudget(Resource):
+
+    query_budget = {"get": 2}
+
+    def get(self):
+        run_queries(2)
+        return {"success": True}
+
+
+class OverBudget(Resource):
+
+    query_budget = {"get": 2}
+
+    def get(self):
+        run_queries(3)
+        return {"success": True}
+
+
+class RepeatedSelect(Resource):
+
+    query_budget = {"get": 10}
+
+    def get(self):
+        run_queries(5, "SELECT 1")
+        return {"success": True}
+
+
+class SendsSignal(Resource):
+
+    query_budget = {"get": 1}
+
+    def get(self):
+        run_queries(1)
+        signups_changed.send(current_app._get_current_object(), event_id=1,
+                             user_ids=[1], delta=1)
+        return {"success": True}
+
+
+def on_signups_changed(sender, event_id, user_ids, delta):
+    run_queries(5, "SELECT 1")
+
+
+class StrictQueryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        # Connect outside of a request, so that the statements SQLAlchemy
+        # runs on a new connection aren't counted against the routes
+        engine.connect().close()
+
+        self.app = Flask(__name__)
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        self.app.config['QUERY_REPEAT_LIMIT'] = 3
+
+        # Registered first, so it runs after the budget check
+        @self.app.after_request
+        def mark(response):
+            response.headers["X-After-Request"] = "1"
+            return response
+
+        query_budget.init_app(self.app)
+        signups_changed.connect(on_signups_changed, sender=self.app)
+
+        api = Api(self.app)
+        api.add_resource(WithinBudget, "/within")
+        api.add_resource(OverBudget, "/over")
+        api.add_resource(RepeatedSelect, "/repeated")
+        api.add_resource(SendsSignal, "/signal")
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        signups_changed.disconnect(on_signups_changed, sender=self.app)
+
+    def test_within_budget(self):
+        response = self.client.get("/within")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Query-Count"], "2")
+
+    def test_over_budget_fails_cleanly(self):
+        response = self.client.get("/over")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.headers["X-Query-Count"], "3")
+        self.assertEqual(response.headers["X-After-Request"], "1")
+
+        body = json.loads(response.data.decode("utf-8"))
+        self.assertFalse(body["success"])
+        self.assertIn("budget is 2", body["error"])
+
+    def test_repeated_select_fails(self):
+        response = self.client.get("/repeated")
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("5 times: SELECT 1", response.data.decode("utf-8"))
+
+    def test_signal_receivers_are_counted_apart(self):
+        response = self.client.get("/signal")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Query-Count"], "1")
+
+        report = metrics.snapshot()
+        self.assertEqual(
+            report["queries.sendssignal.signal.signups-changed.max"], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
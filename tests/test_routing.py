@@ -0,0 +1,114 @@
+"""Tests of the routing of reads to replicas, see models/routing.py.
+
+The primary and the replica are two SQLite databases holding a row
+that says which one it is in, so each test can tell where a read
+went.
+
+    python -m unittest discover tests
+
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from flask import Flask, request
+
+from api.shmcache import SharedCache
+from models.routing import RoutingSQLAlchemy
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.primary = os.path.join(self.dir, "primary.db")
+        self.replica = os.path.join(self.dir, "replica.db")
+
+        for path, source in ((self.primary, "primary"),
+                             (self.replica, "replica")):
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE note (id INTEGER PRIMARY KEY, \
+                         source TEXT)")
+            conn.execute("INSERT INTO note (id, source) VALUES (1, ?)",
+                         (source,))
+            conn.commit()
+            conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_app(self, replica_uri=None, pin_seconds=5):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + self.primary
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [
+            replica_uri or "sqlite:///" + self.replica]
+        app.config['SQLALCHEMY_REPLICA_PIN_SECONDS'] = pin_seconds
+        app.config['SHARED_CACHE_PATH'] = os.path.join(self.dir, "cache")
+        app.config['SHARED_CACHE_SLOTS'] = 64
+        app.config['SHARED_CACHE_SLOT_SIZE'] = 256
+
+        db = RoutingSQLAlchemy()
+
+        class Note(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+            source = db.Column(db.String(16))
+
+        db.init_app(app)
+        SharedCache().init_app(app)
+
+        # Check the replicas now rather than waiting on the thread
+        app.extensions['replicas'].check()
+
+        @app.route("/note", methods=["GET", "POST"])
+        def note():
+            return Note.query.get(1).source
+
+        @app.route("/write", methods=["GET"])
+        def write():
+            db.session.add(Note(id=2, source="written"))
+            db.session.flush()
+            source = Note.query.get(1).source
+            db.session.rollback()
+            return source
+
+        return app
+
+    def get(self, client, path, token=None, method="get"):
+        headers = {"authorization": token} if token is not None else {}
+        response = getattr(client, method)(path, headers=headers)
+        return response.data.decode("utf-8")
+
+    def test_get_reads_from_replica(self):
+        client = self.create_app().test_client()
+        self.assertEqual(self.get(client, "/note"), "replica")
+
+    def test_other_methods_read_from_primary(self):
+        client = self.create_app().test_client()
+        self.assertEqual(self.get(client, "/note", method="post"), "primary")
+
+    def test_reads_after_flush_go_to_primary(self):
+        client = self.create_app().test_client()
+        self.assertEqual(self.get(client, "/write"), "primary")
+
+    def test_writer_reads_from_primary_for_a_while(self):
+        client = self.create_app(pin_seconds=0.5).test_client()
+
+        self.get(client, "/note", "writer", method="post")
+        self.assertEqual(self.get(client, "/note", "writer"), "primary")
+        self.assertEqual(self.get(client, "/note", "other"), "replica")
+
+        time.sleep(0.6)
+        self.assertEqual(self.get(client, "/note", "writer"), "replica")
+
+    def test_unhealthy_replica_is_skipped(self):
+        missing = os.path.join(self.dir, "missing", "replica.db")
+        client = self.create_app("sqlite:///" + missing).test_client()
+        self.assertEqual(self.get(client, "/note"), "primary")
+
+
+if __name__ == "__main__":
+    unittest.main()
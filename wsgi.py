@@ -0,0 +1,34 @@
+"""WSGI entry point for Gunicorn.
+
+The api package shadows api.py, so the application module cannot
+be imported by name and is loaded from its path instead. It is
+loaded with imp rather than runpy, which on Python 2 clears the
+globals of the module it ran once it returns, leaving every import
+in api.py None to the functions defined there.
+
+    gunicorn -c gunicorn_config.py wsgi:app
+
+"""
+
+import os
+import imp
+
+from globals import COOPERATIVE
+
+if COOPERATIVE:
+
+    # Patch the standard library before anything opens a socket. The
+    # MySQLdb C extension blocks the whole worker while waiting on the
+    # database, so it is replaced by the pure Python PyMySQL driver,
+    # which gevent can make cooperative.
+    from gevent import monkey
+    monkey.patch_all()
+
+    import pymysql
+    pymysql.install_as_MySQLdb()
+
+# Kept in sys.modules as "application", so its globals stay alive
+application = imp.load_source(
+    "application",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py"))
+app = application.app